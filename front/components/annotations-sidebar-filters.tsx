@@ -6,7 +6,7 @@ import { Checkbox, Button, Label } from "@/components/ui"
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "@/components/ui/select"
 import { ChevronDown, Loader2, ArrowRight } from "lucide-react"
 import { getAssembliesStats } from "@/lib/api/assemblies"
-import { getAnnotationsFrequencies } from "@/lib/api/annotations"
+import { getAnnotationsFacets } from "@/lib/api/annotations"
 import { getTaxon, getTaxonRankFrequencies, listTaxons } from "@/lib/api/taxons"
 import { useAnnotationsFiltersStore } from "@/lib/stores/annotations-filters"
 import { AssemblyRecord, OrganismRecord, TaxonRecord, BioProjectRecord } from "@/lib/api/types"
@@ -43,6 +43,9 @@ const FILTER_FIELD_NAME_MAP: Record<string, string> = {
   'refseq-categories': 'refseq_category'
 }
 
+// Sections whose options are annotation frequencies, loaded together with a single /annotations/facets request
+const ANNOTATION_FACET_SECTIONS = ['biotype', 'feature-types', 'feature-sources', 'pipelines', 'providers', 'database-sources']
+
 const TAXON_SORT_PARAMS = {
   sort_by: 'annotations_count',
   sort_order: 'desc'
@@ -490,7 +493,22 @@ export function AnnotationsSidebarFilters() {
 
       let result: Record<string, number> = {}
       if (type === 'annotation') {
-        result = await getAnnotationsFrequencies(apiFieldName, params).catch(() => ({}))
+        // One request for every annotation section: the backend does not apply the filter of a field to its own counts
+        const facets = await getAnnotationsFacets(
+          ANNOTATION_FACET_SECTIONS.map(section => FILTER_FIELD_NAME_MAP[section]),
+          buildFilterParams()
+        ).catch(() => ({} as Record<string, Record<string, number>>))
+        const timestamp = Date.now()
+        ANNOTATION_FACET_SECTIONS.forEach(section => {
+          const sectionResult = facets[FILTER_FIELD_NAME_MAP[section]]
+          if (!sectionResult) return
+          const sectionCacheKey = `${section}-${type}-${JSON.stringify(buildFilterParams(section))}`
+          filterCacheRef.current.set(sectionCacheKey, { data: sectionResult, timestamp })
+          if (section !== field && Object.keys(sectionResult).length > 0) {
+            filterOptionSetters[section]?.(sectionResult)
+          }
+        })
+        result = facets[apiFieldName] || {}
       } else {
         result = await getAssembliesStats(params, apiFieldName).catch(() => ({}))
       }
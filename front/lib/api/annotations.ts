@@ -77,6 +77,10 @@ export function getAnnotationsFrequencies(field: string, params?: Query) {
   return apiGet<Record<string, number>>(`/annotations/frequencies/${encodeURIComponent(field)}`, params)
 }
 
+export function getAnnotationsFacets(fields: string[], params?: Query, topK?: number) {
+  return apiGet<Record<string, Record<string, number>>>('/annotations/facets', { ...params, fields: fields.join(','), top_k: topK })
+}
+
 export function listAnnotationErrors(offset = 0, limit = 20) {
   return apiGet<Pagination<any>>('/annotations/errors', { offset, limit })
 }
@@ -162,7 +166,19 @@ export function getGeneCategoryDetails(category: string, params?: Query) {
   return apiPost<GeneCategoryDetails>(`/annotations/gene-stats/${encodeURIComponent(category)}`, params)
 }
 
-export interface GeneCategoryMetricValues {
+export interface MetricHistogram {
+  count: number
+  mean: number | null
+  min: number | null
+  max: number | null
+  quantiles: Record<string, number>
+  histogram: {
+    edges: number[]
+    counts: number[]
+  }
+}
+
+export interface GeneCategoryMetricValues extends Partial<MetricHistogram> {
   category: string
   metric: string
   values: number[]
@@ -173,7 +189,7 @@ export interface GeneCategoryMetricValues {
 export function getGeneCategoryMetricValues(
   category: string,
   metric: string,
-  params?: Query & { include_annotations?: boolean }
+  params?: Query & { include_annotations?: boolean; bins?: number }
 ) {
   return apiPost<GeneCategoryMetricValues>(
     `/annotations/gene-stats/${encodeURIComponent(category)}/${encodeURIComponent(metric)}`,
@@ -212,7 +228,7 @@ export function getTranscriptTypeDetails(type: string, params?: Query) {
   return apiPost<TranscriptTypeDetails>(`/annotations/transcript-stats/${encodeURIComponent(type)}`, params)
 }
 
-export interface TranscriptTypeMetricValues {
+export interface TranscriptTypeMetricValues extends Partial<MetricHistogram> {
   type: string
   metric: string
   values: number[]
@@ -223,7 +239,7 @@ export interface TranscriptTypeMetricValues {
 export function getTranscriptTypeMetricValues(
   type: string,
   metric: string,
-  params?: Query & { include_annotations?: boolean }
+  params?: Query & { include_annotations?: boolean; bins?: number }
 ) {
   return apiPost<TranscriptTypeMetricValues>(
     `/annotations/transcript-stats/${encodeURIComponent(type)}/${encodeURIComponent(metric)}`,
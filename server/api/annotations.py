@@ -1,12 +1,22 @@
-from fastapi import APIRouter, Depends, Body, HTTPException, Response
+from fastapi import APIRouter, Depends, Body, HTTPException, Response, Request
+from fastapi.responses import ORJSONResponse
 from typing import Optional, Dict, Any
 from services import annotations_service
 from helpers import parameters as params_helper
 from helpers import query_visitors as query_visitors_helper
+from helpers import response as response_helper
+from helpers import id_dictionary
 from jobs.import_annotations import import_annotations
 
 router = APIRouter()
 
+@router.get("/annotations/import/status")
+async def get_import_status():
+    """
+    Get the progress of the last import job: annotations per stage, throughput and ETA
+    """
+    return annotations_service.get_import_status()
+
 @router.get("/annotations/import/{auth_key}")
 async def trigger_import_annotations(auth_key: str):
     """
@@ -21,6 +31,13 @@ async def trigger_annotation_fields_update(auth_key: str):
     """
     return annotations_service.trigger_annotation_fields_update(auth_key)
 
+@router.get("/annotations/cleanup/{auth_key}")
+async def trigger_collect_garbage(auth_key: str, dry_run: bool = True):
+    """
+    Remove (or only report with dry_run) the annotation files and sequence maps not referenced by any annotation
+    """
+    return annotations_service.trigger_collect_garbage(auth_key, dry_run)
+
 @router.get("/annotations")
 @router.post("/annotations")
 async def get_annotations(commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
@@ -52,16 +69,46 @@ async def get_frequency_fields():
 @router.post("/annotations/frequencies/{field}")
 async def get_annotations_frequencies(field: str, commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
     """
-    Get annotations frequencies for a given field
+    Get annotations frequencies for a given field, sorted by count.
+    Use top_k to return only the k most frequent values
     """
     params = params_helper.handle_request_params(commons, payload)
     
     return annotations_service.get_annotations(params, response_type='frequencies', field=field)
 
+@router.get("/annotations/facets")
+@router.post("/annotations/facets")
+async def get_annotations_facets(commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
+    """
+    Get the frequencies of several fields in one request (the sidebar filters).
+
+    Parameters:
+    - fields: comma separated fields (default: database, provider, pipeline, feature_type, feature_source, biotype)
+    - top_k: return only the k most frequent values of each field
+    - the annotations filters, the selected values of a field do not filter its own counts
+
+    Returns:
+    - a dict of field -> {value: count}, sorted by count
+    """
+    params = params_helper.handle_request_params(commons, payload)
+    return annotations_service.get_annotations_facets(params)
 
 
 
 
+
+@router.get("/annotations/ids")
+async def get_annotation_ids(request: Request):
+    """
+    Get the sorted annotation ids of the catalogue, the packed metric values refer to annotations by their index in this list.
+    The ETag changes with the catalogue, send it as If-None-Match to get a 304 while the list is unchanged
+    """
+    dictionary = id_dictionary.get_id_dictionary()
+    headers = {'ETag': dictionary.etag, 'Cache-Control': 'public, max-age=0, must-revalidate'}
+    if request.headers.get('if-none-match') == dictionary.etag:
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(dictionary.annotation_ids, headers=headers)
+
 @router.get("/annotations/errors")
 async def get_annotation_errors(offset: int = 0, limit: int = 20):
     """
@@ -100,12 +147,13 @@ async def get_gene_category_details(category: str, commons: Dict[str, Any] = Dep
 
 @router.get("/annotations/gene-stats/{category}/{metric}")
 @router.post("/annotations/gene-stats/{category}/{metric}")
-async def get_gene_category_metric_values(category: str, metric: str, commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
+async def get_gene_category_metric_values(category: str, metric: str, request: Request, commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
     """
     Get raw values for a specific metric in a specific gene category (for plotting histograms).
     
     Parameters:
     - include_annotations: If True, include annotation_ids list (default: False). Can be passed as query param or in payload.
+    - bins: If set, return a histogram with this number of bins, the quantiles and the mean instead of the values.
     
     Returns:
     - category: The gene category name
@@ -113,6 +161,10 @@ async def get_gene_category_metric_values(category: str, metric: str, commons: D
     - values: List of values (ordered by annotation_id)
     - annotation_ids: List of annotation_ids (only if include_annotations=True, ordered to match values)
     - missing: List of annotation_ids missing this metric
+    - count, mean, min, max, quantiles, histogram (edges, counts): only with bins
+
+    With Accept: application/octet-stream the values are returned as little-endian float64, followed by the uint32 indices
+    of annotation_ids (if included) and of missing in the id dictionary of /annotations/ids (see the X-*-Count headers)
     """
     # Extract include_annotations from payload (preferred) or query params
     include_annotations = False
@@ -123,7 +175,9 @@ async def get_gene_category_metric_values(category: str, metric: str, commons: D
         include_annotations = commons.pop('include_annotations')
         include_annotations = params_helper.format_boolean_param(include_annotations)
     
-    return annotations_service.get_gene_category_metric_values(category, metric, include_annotations, commons, payload)
+    bins = pop_bins_param(commons, payload)
+    packed = response_helper.accepts_packed(request.headers.get('accept'))
+    return orjson_response(annotations_service.get_gene_category_metric_values(category, metric, include_annotations, commons, payload, bins, packed))
 
 @router.get("/annotations/transcript-stats")
 @router.post("/annotations/transcript-stats")
@@ -156,12 +210,13 @@ async def get_transcript_type_details(type: str, commons: Dict[str, Any] = Depen
 
 @router.get("/annotations/transcript-stats/{type}/{metric}")
 @router.post("/annotations/transcript-stats/{type}/{metric}")
-async def get_transcript_type_metric_values(type: str, metric: str, commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
+async def get_transcript_type_metric_values(type: str, metric: str, request: Request, commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
     """
     Get raw values for a specific metric in a specific transcript type (for plotting histograms).
     
     Parameters:
     - include_annotations: If True, include annotation_ids list (default: False). Can be passed as query param or in payload.
+    - bins: If set, return a histogram with this number of bins, the quantiles and the mean instead of the values.
     
     Returns:
     - type: The transcript type name
@@ -169,6 +224,10 @@ async def get_transcript_type_metric_values(type: str, metric: str, commons: Dic
     - values: List of values (ordered by annotation_id)
     - annotation_ids: List of annotation_ids (only if include_annotations=True, ordered to match values)
     - missing: List of annotation_ids missing this metric
+    - count, mean, min, max, quantiles, histogram (edges, counts): only with bins
+
+    With Accept: application/octet-stream the values are returned as little-endian float64, followed by the uint32 indices
+    of annotation_ids (if included) and of missing in the id dictionary of /annotations/ids (see the X-*-Count headers)
     """
     # Extract include_annotations from payload (preferred) or query params
     include_annotations = False
@@ -180,9 +239,29 @@ async def get_transcript_type_metric_values(type: str, metric: str, commons: Dic
         include_annotations = commons.pop('include_annotations')
         include_annotations = params_helper.format_boolean_param(include_annotations)
     
-    return annotations_service.get_transcript_type_metric_values(type, metric, include_annotations, commons, payload)
+    bins = pop_bins_param(commons, payload)
+    packed = response_helper.accepts_packed(request.headers.get('accept'))
+    return orjson_response(annotations_service.get_transcript_type_metric_values(type, metric, include_annotations, commons, payload, bins, packed))
 
 
+def orjson_response(result):
+    """
+    The values lists are serialized by orjson directly, skipping the jsonable_encoder pass over every value
+    """
+    if isinstance(result, Response):
+        return result
+    return ORJSONResponse(result)
+
+def pop_bins_param(commons: Optional[Dict[str, Any]], payload: Optional[Dict[str, Any]]):
+    """
+    Extract bins from the payload (preferred) or the query params, so it is not taken as an annotations filter
+    """
+    if payload and 'bins' in payload:
+        return payload.pop('bins')
+    if commons and 'bins' in commons:
+        return commons.pop('bins')
+    return None
+
 @router.get("/annotations/{md5_checksum}")
 async def get_annotation(md5_checksum: str):
     """
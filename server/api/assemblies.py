@@ -23,7 +23,7 @@ async def get_assemblies_frequencies(field: str, commons: Dict[str, Any] = Depen
 
 @router.get("/assemblies/{assembly_accession}")
 async def get_assembly(assembly_accession: str):
-    return assemblies_service.get_assembly(assembly_accession).to_mongo().to_dict()
+    return assemblies_service.get_assembly(assembly_accession)
 
 @router.get("/assemblies/{assembly_accession}/chr_aliases")
 async def get_chr_aliases(assembly_accession: str):
@@ -35,4 +35,4 @@ async def get_assembled_molecules(assembly_accession: str, offset: int = 0, limi
 
 @router.get("/assemblies/{assembly_accession}/paired") 
 async def get_paired_assembly(assembly_accession: str):
-    return assemblies_service.get_paired_assembly(assembly_accession).to_mongo().to_dict()
+    return assemblies_service.get_paired_assembly(assembly_accession)
@@ -0,0 +1,32 @@
+from fastapi import APIRouter
+from services import jobs_service
+
+router = APIRouter()
+
+@router.get("/jobs/locks")
+async def get_locks_status():
+    """
+    Get the background tasks currently running (lock holder and last heartbeat) or queued
+    """
+    return jobs_service.get_locks_status()
+
+@router.get("/jobs/ncbi/metrics")
+async def get_ncbi_metrics():
+    """
+    Get the NCBI datasets client metrics: calls, time waited for the rate limiter, errors and calls in flight
+    """
+    return jobs_service.get_ncbi_metrics()
+
+@router.get("/jobs/index-advisor")
+async def get_index_advisor_report():
+    """
+    Get the last index advisor report: recorded query shapes per endpoint, their plans and the proposed indexes
+    """
+    return jobs_service.get_index_advisor_report()
+
+@router.get("/jobs/index-advisor/{auth_key}")
+async def trigger_index_advisor(auth_key: str, create: bool = False):
+    """
+    Replay the recorded query shapes with explain and propose (or create, with create=true) the missing indexes
+    """
+    return jobs_service.trigger_index_advisor(auth_key, create)
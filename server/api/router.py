@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from api import annotations, assemblies, taxons, organisms, bioprojects
+from api import annotations, assemblies, taxons, organisms, bioprojects, jobs
 
 router = APIRouter()
 
@@ -8,3 +8,4 @@ router.include_router(assemblies.router, tags=["assemblies"])
 router.include_router(taxons.router, tags=["taxons"])
 router.include_router(organisms.router, tags=["organisms"])
 router.include_router(bioprojects.router, tags=["bioprojects"])
+router.include_router(jobs.router, tags=["jobs"])
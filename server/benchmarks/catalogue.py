@@ -0,0 +1,165 @@
+import random
+from datetime import datetime, timedelta
+from mongoengine import connect, disconnect
+from db.models import GenomeAnnotation, GenomeAssembly, TaxonNode, Organism, BioProject, drop_all_collections
+from db.embedded_documents import SourceFileInfo, IndexedFileInfo, PipelineInfo
+from jobs.services.utils import create_batches
+
+DEFAULT_MONGO_URI = 'mongomock://localhost'
+DATABASES = ['RefSeq', 'GenBank', 'Ensembl']
+PROVIDERS = ['NCBI RefSeq', 'Ensembl', 'WormBase', 'FlyBase', 'Submitter']
+PIPELINES = ['NCBI Eukaryotic Genome Annotation Pipeline', 'Ensembl Genebuild', 'BRAKER', 'MAKER']
+ASSEMBLY_LEVELS = ['Chromosome', 'Scaffold', 'Contig', 'Complete Genome']
+REFSEQ_CATEGORIES = ['reference genome', 'representative genome', None]
+#rank, number of nodes of this rank under each parent
+TAXONOMY_SHAPE = [('kingdom', 2), ('phylum', 3), ('class', 3), ('order', 3), ('family', 2), ('genus', 2)]
+
+def connect_to_benchmark_db(mongo_uri: str = DEFAULT_MONGO_URI, db_name: str = 'annotrieve_benchmark'):
+    """
+    Connect mongoengine to a local mongod (mongodb://...) or to an in-memory mongomock (mongomock://...)
+    """
+    disconnect()
+    connect(db=db_name, host=mongo_uri)
+
+def build_taxonomy(rng: random.Random, organisms: int) -> tuple[list[TaxonNode], list[list[str]]]:
+    """
+    Build a balanced taxonomy tree and return its nodes and the lineages (species to root) of the organisms
+    """
+    root = TaxonNode(taxid='1', scientific_name='root', rank='no rank', children=[])
+    nodes = [root]
+    parents = [root]
+    next_taxid = 2
+    for rank, per_parent in TAXONOMY_SHAPE:
+        level = []
+        for parent in parents:
+            for _ in range(per_parent):
+                node = TaxonNode(taxid=str(next_taxid), scientific_name=f"{rank.capitalize()} {next_taxid}", rank=rank, children=[])
+                parent.children.append(node.taxid)
+                level.append(node)
+                next_taxid += 1
+        nodes.extend(level)
+        parents = level
+
+    lineage_by_taxid = {root.taxid: [root.taxid]}
+    for node in nodes:
+        for child in node.children:
+            lineage_by_taxid[child] = [child] + lineage_by_taxid[node.taxid]
+
+    lineages = []
+    for idx in range(organisms):
+        genus = parents[idx % len(parents)] if idx < len(parents) else rng.choice(parents)
+        species = TaxonNode(taxid=str(next_taxid), scientific_name=f"{genus.scientific_name.split()[-1]} species {next_taxid}", rank='species', children=[])
+        genus.children.append(species.taxid)
+        nodes.append(species)
+        lineages.append([species.taxid] + lineage_by_taxid[genus.taxid])
+        next_taxid += 1
+    return nodes, lineages
+
+def load_catalogue(
+    annotations: int = 1000,
+    annotations_per_assembly: int = 2,
+    assemblies_per_organism: int = 2,
+    stats_pool: list[tuple] | None = None,
+    batch_size: int = 1000,
+    seed: int = 42,
+) -> dict:
+    """
+    Replace the catalogue with N synthetic annotations and the assemblies, organisms, taxon nodes and bioprojects they reference.
+    stats_pool is a list of (features_summary, features_statistics) computed from synthetic GFFs, assigned round-robin
+    (annotations without an entry have no stats, as annotations still to be processed).
+    Return the number of documents inserted per collection
+    """
+    rng = random.Random(seed)
+    drop_all_collections()
+    stats_pool = stats_pool or []
+
+    assemblies_count = max(1, -(-annotations // annotations_per_assembly))
+    organisms_count = max(1, -(-assemblies_count // assemblies_per_organism))
+    taxon_nodes, lineages = build_taxonomy(rng, organisms_count)
+    bioprojects = [BioProject(accession=f"PRJNA{100000 + idx}", title=f"Synthetic bioproject {idx}") for idx in range(max(1, organisms_count // 5))]
+
+    organisms = []
+    for idx, lineage in enumerate(lineages):
+        organisms.append(Organism(taxid=lineage[0], organism_name=f"Synthetic organism {lineage[0]}", common_name=f"synthetic {idx}", taxon_lineage=lineage))
+
+    assemblies = []
+    base_date = datetime(2015, 1, 1)
+    for idx in range(assemblies_count):
+        organism = organisms[idx % organisms_count]
+        accession = f"GCA_{idx + 1:09d}.1"
+        assemblies.append(GenomeAssembly(
+            assembly_accession=accession,
+            assembly_name=f"asm{idx + 1}",
+            source_database=rng.choice(['SOURCE_DATABASE_GENBANK', 'SOURCE_DATABASE_REFSEQ']),
+            assembly_level=rng.choice(ASSEMBLY_LEVELS),
+            assembly_status='current',
+            assembly_type='haploid',
+            refseq_category=rng.choice(REFSEQ_CATEGORIES),
+            taxid=organism.taxid,
+            organism_name=organism.organism_name,
+            taxon_lineage=organism.taxon_lineage,
+            release_date=base_date + timedelta(days=rng.randint(0, 3650)),
+            bioprojects=rng.sample([bioproject.accession for bioproject in bioprojects], k=min(2, len(bioprojects))),
+            download_url=f"https://ftp.ncbi.nlm.nih.gov/genomes/all/GCA/{accession}",
+        ))
+
+    genome_annotations = []
+    for idx in range(annotations):
+        assembly = assemblies[idx % assemblies_count]
+        annotation_id = f"{rng.getrandbits(128):032x}"
+        release_date = base_date + timedelta(days=rng.randint(0, 3650))
+        bgzipped_path = f"{annotation_id[:2]}/{annotation_id}.gff.gz" #the file paths are unique
+        annotation = GenomeAnnotation(
+            annotation_id=annotation_id,
+            assembly_accession=assembly.assembly_accession,
+            assembly_name=assembly.assembly_name,
+            refseq_category=assembly.refseq_category,
+            assembly_level=assembly.assembly_level,
+            assembly_status=assembly.assembly_status,
+            assembly_type=assembly.assembly_type,
+            bioprojects=assembly.bioprojects,
+            organism_name=assembly.organism_name,
+            taxid=assembly.taxid,
+            taxon_lineage=assembly.taxon_lineage,
+            mapped_regions=[f"chr{region}" for region in range(1, rng.randint(2, 12))],
+            source_file_info=SourceFileInfo(
+                database=rng.choice(DATABASES),
+                provider=rng.choice(PROVIDERS),
+                release_date=release_date,
+                url_path=f"https://ftp.example.org/annotations/{annotation_id}.gff.gz",
+                last_modified=release_date,
+                uncompressed_md5=annotation_id,
+                pipeline=PipelineInfo(name=rng.choice(PIPELINES), version=str(rng.randint(1, 10))),
+            ),
+            indexed_file_info=IndexedFileInfo(
+                bgzipped_path=bgzipped_path,
+                csi_path=f"{bgzipped_path}.csi",
+                uncompressed_md5=annotation_id,
+                file_size=rng.randint(10**6, 10**8),
+                processed_at=release_date,
+            ),
+        )
+        if stats_pool and idx % (len(stats_pool) + 1) != len(stats_pool):
+            features_summary, features_statistics = stats_pool[idx % (len(stats_pool) + 1)]
+            annotation.features_summary = features_summary
+            annotation.features_statistics = features_statistics
+        genome_annotations.append(annotation)
+
+    for document, documents in [
+        (TaxonNode, taxon_nodes),
+        (BioProject, bioprojects),
+        (Organism, organisms),
+        (GenomeAssembly, assemblies),
+        (GenomeAnnotation, genome_annotations),
+    ]:
+        for batch in create_batches(documents, batch_size):
+            document.objects.insert(batch, load_bulk=False)
+
+    return {
+        'taxon_nodes': len(taxon_nodes),
+        'bioprojects': len(bioprojects),
+        'organisms': len(organisms),
+        'assemblies': len(assemblies),
+        'annotations': len(genome_annotations),
+        'annotations_with_stats': sum(1 for annotation in genome_annotations if annotation.features_statistics),
+    }
@@ -0,0 +1,132 @@
+"""
+Local stub of the ENA browser XML API, to fetch taxonomies offline.
+
+    python -m benchmarks.ena_stub --port 8099
+    ENA_BROWSER_URL=http://127.0.0.1:8099 ...
+
+Every numeric taxid is answered with a synthetic organism and a deterministic lineage (species to root),
+non numeric accessions are left out of the TAXON_SET as ENA does for unknown ones.
+"""
+import gzip
+import json
+import time
+import argparse
+import threading
+from xml.sax.saxutils import quoteattr
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#rank, number of distinct taxa of this rank, taxid offset
+LINEAGE_SHAPE = [('genus', 500, 9_000_000), ('family', 100, 9_100_000), ('order', 30, 9_200_000), ('class', 10, 9_300_000), ('phylum', 4, 9_400_000), ('kingdom', 2, 9_500_000)]
+
+def taxon_xml(taxid: str) -> str | None:
+    if not taxid.isdigit():
+        return None
+    lineage = []
+    for rank, count, offset in LINEAGE_SHAPE:
+        lineage_taxid = offset + int(taxid) % count
+        lineage.append(f'<taxon scientificName={quoteattr(f"{rank.capitalize()} {lineage_taxid}")} taxId="{lineage_taxid}" rank="{rank}"/>')
+    lineage.append('<taxon scientificName="root" taxId="1"/>')
+    return (
+        f'<taxon scientificName="Species {taxid}" commonName="species {taxid}" taxId="{taxid}" rank="species">'
+        f'<lineage>{"".join(lineage)}</lineage>'
+        '</taxon>'
+    )
+
+def taxon_set_xml(accessions: list[str]) -> bytes:
+    taxons = [xml for xml in (taxon_xml(str(accession).strip()) for accession in accessions) if xml]
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<TAXON_SET>' + ''.join(taxons) + '</TAXON_SET>\n').encode()
+
+class EnaStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        #GET /xml/{taxid}
+        if not self.path.startswith('/xml/'):
+            return self.send_error(404)
+        self.reply(taxon_set_xml([self.path.rsplit('/', 1)[-1]]), compress=False)
+
+    def do_POST(self):
+        #POST /xml {"accessions": [...] or "a,b,c", "gzip": true}
+        if self.path.rstrip('/') != '/xml':
+            return self.send_error(404)
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            return self.send_error(400)
+        accessions = payload.get('accessions') or []
+        if isinstance(accessions, str):
+            accessions = accessions.split(',')
+        self.reply(taxon_set_xml(accessions), compress=bool(payload.get('gzip')))
+
+    def reply(self, body: bytes, compress: bool):
+        stub = self.server.stub
+        if stub.take_failure():
+            return self.send_error(503)
+        if stub.latency:
+            time.sleep(stub.latency)
+        if compress:
+            body = gzip.compress(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/gzip' if compress else 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class EnaStubServer:
+    """
+    Stub server running in a background thread, `url` is the value of ENA_BROWSER_URL.
+    latency (seconds) is added to every response, the first `failures` requests are answered with a 503
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, failures: int = 0):
+        self.httpd = ThreadingHTTPServer((host, port), EnaStubHandler)
+        self.httpd.stub = self
+        self.latency = latency
+        self.failures = failures
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def take_failure(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='ena-stub', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stub of the ENA browser XML API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    args = parser.parse_args(argv)
+    server = EnaStubServer(args.host, args.port, args.latency)
+    print(f"ENA browser stub listening on {server.url}, export ENA_BROWSER_URL={server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+if __name__ == '__main__':
+    main()
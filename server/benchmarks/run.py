@@ -0,0 +1,282 @@
+"""
+Run the benchmark scenarios and write the timings as JSON.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --mongo-uri mongodb://localhost:27017 --annotations 20000 --baseline results.json
+
+See benchmarks/README.md
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import asyncio
+import tempfile
+from datetime import datetime
+
+#the settings are read at import time, the benchmarks connect to their own database
+for key, value in {
+    'DB_NAME': 'annotrieve_benchmark',
+    'DB_HOST': 'localhost',
+    'DB_PORT': '27017',
+    'DB_USER': '',
+    'DB_PASS': '',
+    'CELERY_BROKER_URL': 'redis://localhost:6379/0',
+    'CELERY_RESULT_BACKEND': 'redis://localhost:6379/0',
+}.items():
+    os.environ.setdefault(key, value)
+
+from benchmarks import synthetic_gff, catalogue, ena_stub
+from db.models import GenomeAnnotation, GenomeAssembly
+from helpers import pysam_helper
+from jobs.services.feature_stats import compute_features_statistics
+from jobs.services.feature_summary import compute_features_summary
+from jobs.services.stats import update_db_stats
+from fastapi.encoders import jsonable_encoder
+from helpers import response as response_helper
+from services import annotations_service, assemblies_service
+from clients import ebi_client
+from jobs.services import taxonomy as taxonomy_service
+from jobs.services.utils import create_batches
+
+def timeit(name: str, func, repeat: int, warmup: int = 1, clock=time.perf_counter, **params) -> dict:
+    """
+    Run func warmup + repeat times and return the timings of the repeated runs, in seconds.
+    With clock=time.process_time the CPU time of the process is measured instead of the wall time
+    """
+    result = None
+    for _ in range(warmup):
+        result = func()
+    timings = []
+    for _ in range(repeat):
+        start = clock()
+        result = func()
+        timings.append(clock() - start)
+    entry = {
+        'name': name,
+        'params': params,
+        'repeat': repeat,
+        'min_s': round(min(timings), 6),
+        'median_s': round(statistics.median(timings), 6),
+        'mean_s': round(statistics.mean(timings), 6),
+        'max_s': round(max(timings), 6),
+        'result': summarize(result),
+    }
+    print(f"{name:<60} median {entry['median_s'] * 1000:>10.2f} ms  min {entry['min_s'] * 1000:>10.2f} ms")
+    return entry
+
+def summarize(result):
+    """
+    Keep a small fingerprint of a scenario result, so that a faster run returning something else is noticed
+    """
+    if isinstance(result, (int, float, str)) or result is None:
+        return result
+    if isinstance(result, dict):
+        return {'keys': sorted(result.keys())[:20], 'total_annotations': result.get('total_annotations'), 'values': len(result.get('values') or [])}
+    return type(result).__name__
+
+def consume(iterable) -> int:
+    return sum(1 for _ in iterable)
+
+def gff_scenarios(bgzipped_path: str, repeat: int, gff_params: dict) -> list[dict]:
+    first_contig = next(pysam_helper.stream_contigs_names(bgzipped_path))
+    return [
+        timeit('gff.compute_features_statistics', lambda: compute_features_statistics(bgzipped_path), repeat, **gff_params),
+        timeit('gff.compute_features_summary', lambda: compute_features_summary(bgzipped_path), repeat, **gff_params),
+        timeit('gff.stream_gff_file', lambda: consume(pysam_helper.stream_gff_file(bgzipped_path)), repeat, **gff_params),
+        timeit('gff.stream_gff_file.region', lambda: consume(pysam_helper.stream_gff_file(bgzipped_path, seqid=first_contig, start=0, end=1_000_000)), repeat, seqid=first_contig, **gff_params),
+        timeit('gff.stream_gff_file.feature_type', lambda: consume(pysam_helper.stream_gff_file(bgzipped_path, feature_type='exon')), repeat, feature_type='exon', **gff_params),
+        timeit('gff.stream_gff_file.biotype', lambda: consume(pysam_helper.stream_gff_file(bgzipped_path, biotype='lncRNA')), repeat, biotype='lncRNA', **gff_params),
+    ]
+
+def stats_endpoint_scenarios(repeat: int) -> list[dict]:
+    """
+    Time the services behind every /annotations/*-stats endpoint, on the whole catalogue and on a taxon subtree
+    """
+    filters = {'all': {}, 'taxon': {'taxids': '3'}}
+    results = []
+    for filter_name, commons in filters.items():
+        def call(func, *args):
+            #the services pop keys from the params
+            return lambda: func(*args, dict(commons), None)
+        results.extend([
+            timeit(f'api.gene-stats[{filter_name}]', call(annotations_service.get_gene_stats_summary), repeat, **commons),
+            timeit(f'api.gene-stats/coding[{filter_name}]', call(annotations_service.get_gene_category_details, 'coding'), repeat, **commons),
+            timeit(f'api.gene-stats/coding/total_count[{filter_name}]', call(annotations_service.get_gene_category_metric_values, 'coding', 'total_count', True), repeat, **commons),
+            timeit(f'api.gene-stats/coding/total_count?bins=50[{filter_name}]', lambda: annotations_service.get_gene_category_metric_values('coding', 'total_count', False, dict(commons), None, 50), repeat, bins=50, **commons),
+            timeit(f'api.transcript-stats[{filter_name}]', call(annotations_service.get_transcript_stats_summary), repeat, **commons),
+            timeit(f'api.transcript-stats/mRNA[{filter_name}]', call(annotations_service.get_transcript_type_details, 'mRNA'), repeat, **commons),
+            timeit(f'api.transcript-stats/mRNA/exon_total_count[{filter_name}]', call(annotations_service.get_transcript_type_metric_values, 'mRNA', 'exon_total_count', True), repeat, **commons),
+            timeit(f'api.transcript-stats/mRNA/exon_total_count?bins=50[{filter_name}]', lambda: annotations_service.get_transcript_type_metric_values('mRNA', 'exon_total_count', False, dict(commons), None, 50), repeat, bins=50, **commons),
+        ])
+    return results
+
+def legacy_json_bytes(content) -> bytes:
+    #what FastAPI does with a returned dict: jsonable_encoder, then json.dumps
+    return json.dumps(jsonable_encoder(content)).encode()
+
+def serialization_scenarios(repeat: int) -> list[dict]:
+    """
+    CPU time of the list and document endpoints (query + encoding) and of the encoding alone,
+    orjson from the raw documents against the jsonable_encoder path
+    """
+    annotation_id = GenomeAnnotation.objects().scalar('annotation_id').first()
+    assembly_accession = GenomeAssembly.objects().scalar('assembly_accession').first()
+    results = [
+        timeit('cpu.annotations?limit=100', lambda: annotations_service.get_annotations({'limit': 100, 'offset': 0}), repeat, clock=time.process_time, limit=100),
+        timeit('cpu.annotations/{md5_checksum}', lambda: annotations_service.get_annotation_metadata(annotation_id), repeat, clock=time.process_time),
+        timeit('cpu.assemblies?limit=100', lambda: assemblies_service.get_assemblies(offset=0, limit=100), repeat, clock=time.process_time, limit=100),
+        timeit('cpu.assemblies/{assembly_accession}', lambda: assemblies_service.get_assembly(assembly_accession), repeat, clock=time.process_time),
+    ]
+    payloads = {
+        'annotations?limit=100': {'total': 100, 'offset': 0, 'limit': 100, 'results': list(GenomeAnnotation.objects().exclude('id').limit(100).as_pymongo())},
+        'annotations/{md5_checksum}': GenomeAnnotation._get_collection().find_one({'annotation_id': annotation_id}, {'_id': 0}),
+    }
+    for name, payload in payloads.items():
+        for encoder_name, encoder in [('orjson', response_helper.json_bytes), ('jsonable_encoder', legacy_json_bytes)]:
+            results.append(timeit(f'encode.{name}[{encoder_name}]', lambda: encoder(payload), repeat, clock=time.process_time, bytes=len(encoder(payload))))
+    return results
+
+def ena_scenarios(repeat: int, taxids: int, batch_size: int, latency: float) -> list[dict]:
+    """
+    Fetch and parse the taxonomy of synthetic taxids from the local ENA stub, sequentially and with the default concurrency
+    """
+    taxid_list = [str(10_000_000 + idx) for idx in range(taxids)]
+    batches = create_batches(taxid_list, batch_size)
+    ena_url = ebi_client.ENA_BROWSER_URL
+    results = []
+    with ena_stub.EnaStubServer(latency=latency) as stub:
+        ebi_client.ENA_BROWSER_URL = stub.url
+        try:
+            for concurrency in sorted({1, taxonomy_service.ENA_CONCURRENCY}):
+                fetch = lambda: sum(len(batch) for batch in asyncio.run(taxonomy_service.fetch_organisms_batches(batches, concurrency)))
+                results.append(timeit(f'ena.fetch_organisms_batches[concurrency={concurrency}]', fetch, repeat, taxids=taxids, batch_size=batch_size, latency_s=latency))
+        finally:
+            ebi_client.ENA_BROWSER_URL = ena_url
+    return results
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(results: list[dict], baseline_path: str, max_regression: float) -> list[dict]:
+    """
+    Compare the medians with a previous run, return the scenarios slower than max_regression times the baseline
+    """
+    with open(baseline_path) as f:
+        baseline = {entry['name']: entry for entry in json.load(f)['results']}
+    regressions = []
+    for entry in results:
+        previous = baseline.get(entry['name'])
+        if not previous or not previous['median_s']:
+            continue
+        ratio = entry['median_s'] / previous['median_s']
+        entry['baseline_median_s'] = previous['median_s']
+        entry['ratio'] = round(ratio, 3)
+        if ratio > max_regression:
+            regressions.append(entry)
+            print(f"REGRESSION {entry['name']}: {previous['median_s'] * 1000:.2f} ms -> {entry['median_s'] * 1000:.2f} ms ({ratio:.2f}x)")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Annotrieve benchmark suite')
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON file with the timings')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare the medians with')
+    parser.add_argument('--max-regression', type=float, default=1.25, help='exit with an error if a median is slower than this ratio of the baseline')
+    parser.add_argument('--mongo-uri', default=catalogue.DEFAULT_MONGO_URI, help='mongodb://host:port for a local mongod, mongomock://localhost for an in-memory one')
+    parser.add_argument('--workdir', help='directory of the synthetic GFF files (a temporary one by default)')
+    parser.add_argument('--scenarios', default='gff,api,db,cpu,ena', help='comma separated groups to run: gff, api, db, cpu, ena')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    #synthetic GFF
+    parser.add_argument('--genes', type=int, default=5000)
+    parser.add_argument('--transcripts-per-gene', type=int, default=2)
+    parser.add_argument('--exons', type=int, default=6, help='exons per transcript')
+    parser.add_argument('--contigs', type=int, default=20)
+    parser.add_argument('--attribute-richness', type=int, default=3, help=f'extra attributes per feature, 0 to {len(synthetic_gff.EXTRA_ATTRIBUTES)}')
+    parser.add_argument('--gff-variants', type=int, default=4, help='distinct GFF files whose stats are spread over the catalogue')
+    #local ENA browser stub
+    parser.add_argument('--taxids', type=int, default=20000, help='synthetic taxids fetched from the ENA stub')
+    parser.add_argument('--ena-batch-size', type=int, default=9000)
+    parser.add_argument('--ena-latency', type=float, default=0.2, help='seconds added to every stub response, to emulate the network')
+    #synthetic catalogue
+    parser.add_argument('--annotations', type=int, default=2000)
+    parser.add_argument('--annotations-per-assembly', type=int, default=2)
+    parser.add_argument('--assemblies-per-organism', type=int, default=2)
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    groups = set(args.scenarios.split(','))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='annotrieve-benchmark-')
+    gff_params = {
+        'genes': args.genes,
+        'transcripts_per_gene': args.transcripts_per_gene,
+        'exons_per_transcript': args.exons,
+        'contigs': args.contigs,
+        'attribute_richness': args.attribute_richness,
+    }
+    results = []
+
+    print(f"Generating {args.gff_variants} synthetic GFF files in {workdir}")
+    gff_files = []
+    for variant in range(args.gff_variants):
+        bgzipped_path, counts = synthetic_gff.generate_indexed_gff(workdir, f"synthetic_{variant}", seed=args.seed + variant, **gff_params)
+        gff_files.append((bgzipped_path, counts))
+
+    if 'gff' in groups:
+        results.extend(gff_scenarios(gff_files[0][0], args.repeat, {**gff_params, 'lines': sum(gff_files[0][1].values())}))
+
+    catalogue_counts = None
+    if groups & {'api', 'db', 'cpu'}:
+        catalogue.connect_to_benchmark_db(args.mongo_uri)
+        stats_pool = [(compute_features_summary(path), compute_features_statistics(path)) for path, _ in gff_files]
+        start = time.perf_counter()
+        catalogue_counts = catalogue.load_catalogue(
+            annotations=args.annotations,
+            annotations_per_assembly=args.annotations_per_assembly,
+            assemblies_per_organism=args.assemblies_per_organism,
+            stats_pool=stats_pool,
+            seed=args.seed,
+        )
+        print(f"Loaded catalogue {catalogue_counts} in {time.perf_counter() - start:.2f}s")
+
+    if 'api' in groups:
+        results.extend(stats_endpoint_scenarios(args.repeat))
+
+    if 'cpu' in groups:
+        results.extend(serialization_scenarios(args.repeat))
+
+    if 'ena' in groups:
+        results.extend(ena_scenarios(args.repeat, args.taxids, args.ena_batch_size, args.ena_latency))
+
+    if 'db' in groups:
+        annotation_ids = list(GenomeAnnotation.objects().scalar('annotation_id'))
+        results.append(timeit('db.update_db_stats', lambda: update_db_stats(annotation_ids), max(1, args.repeat // 2), annotations=len(annotation_ids)))
+
+    regressions = compare(results, args.baseline, args.max_regression) if args.baseline else []
+    output = {
+        'generated_at': datetime.now().isoformat(),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mongo_uri': args.mongo_uri.split('@')[-1],
+        'seed': args.seed,
+        'gff': gff_params,
+        'catalogue': catalogue_counts,
+        'results': results,
+        'regressions': [entry['name'] for entry in regressions],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f"Results written to {args.output}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import os
+import random
+import pysam
+
+SOURCES = ['RefSeq', 'Gnomon', 'BestRefSeq', 'ensembl', 'havana']
+#gene feature type, gene biotype, transcript type, transcript biotype, has CDS
+GENE_KINDS = {
+    'coding': ('gene', 'protein_coding', 'mRNA', 'protein_coding', True),
+    'non_coding': ('ncRNA_gene', 'lncRNA', 'lncRNA', 'lncRNA', False),
+    'pseudogene': ('pseudogene', 'pseudogene', 'transcript', 'processed_pseudogene', False),
+}
+#extra attributes added to every feature, attribute_richness picks how many of them
+EXTRA_ATTRIBUTES = [
+    ('Name', lambda rng, feature_id: feature_id.split(':', 1)[-1]),
+    ('Dbxref', lambda rng, feature_id: f"GeneID:{rng.randint(1, 10**8)}"),
+    ('gbkey', lambda rng, feature_id: rng.choice(['Gene', 'mRNA', 'ncRNA', 'exon', 'CDS'])),
+    ('description', lambda rng, feature_id: f"synthetic feature {rng.randint(1, 10**6)}"),
+    ('product', lambda rng, feature_id: f"protein {rng.randint(1, 10**4)} isoform X{rng.randint(1, 9)}"),
+    ('tag', lambda rng, feature_id: rng.choice(['basic', 'Ensembl_canonical', 'MANE_Select'])),
+    ('version', lambda rng, feature_id: str(rng.randint(1, 20))),
+    ('Note', lambda rng, feature_id: 'x' * rng.randint(10, 200)),
+]
+
+def generate_gff(
+    path: str,
+    genes: int = 1000,
+    transcripts_per_gene: int = 2,
+    exons_per_transcript: int = 5,
+    contigs: int = 10,
+    attribute_richness: int = 2,
+    category_weights: tuple[float, float, float] = (0.7, 0.2, 0.1),
+    seed: int = 42,
+) -> dict:
+    """
+    Write a deterministic GFF3 file sorted by contig and start (ready for tabix).
+    The same parameters and seed always produce the same file.
+    Return the number of lines written per feature type
+    """
+    rng = random.Random(seed)
+    attribute_richness = max(0, min(attribute_richness, len(EXTRA_ATTRIBUTES)))
+    kinds = list(GENE_KINDS)
+    counts = {}
+
+    def attributes(feature_id: str, parent: str | None, biotype_key: str | None, biotype: str | None) -> str:
+        items = [f"ID={feature_id}"]
+        if parent:
+            items.append(f"Parent={parent}")
+        if biotype_key:
+            items.append(f"{biotype_key}={biotype}")
+        for key, value in EXTRA_ATTRIBUTES[:attribute_richness]:
+            items.append(f"{key}={value(rng, feature_id)}")
+        return ';'.join(items)
+
+    def feature(contig: str, source: str, feature_type: str, start: int, end: int, strand: str, phase: str, attrs: str) -> str:
+        counts[feature_type] = counts.get(feature_type, 0) + 1
+        return f"{contig}\t{source}\t{feature_type}\t{start}\t{end}\t.\t{strand}\t{phase}\t{attrs}"
+
+    genes_per_contig = [genes // contigs + (1 if idx < genes % contigs else 0) for idx in range(contigs)]
+    with open(path, 'w') as gff:
+        gff.write('##gff-version 3\n')
+        for contig_idx, contig_genes in enumerate(genes_per_contig, start=1):
+            contig = f"chr{contig_idx}"
+            rows = [] #(start, order, line), sorted before writing
+            position = 1
+            for gene_idx in range(contig_genes):
+                kind = rng.choices(kinds, weights=category_weights)[0]
+                gene_type, gene_biotype, transcript_type, transcript_biotype, has_cds = GENE_KINDS[kind]
+                source = rng.choice(SOURCES)
+                strand = rng.choice('+-')
+                gene_id = f"gene:{contig}_{gene_idx}"
+                gene_start = position + rng.randint(500, 20000)
+                exon_count = max(1, exons_per_transcript + rng.randint(-1, 1)) if kind == 'coding' else max(1, exons_per_transcript // 2)
+                exons = []
+                exon_start = gene_start
+                for _ in range(exon_count):
+                    exon_end = exon_start + rng.randint(50, 600)
+                    exons.append((exon_start, exon_end))
+                    exon_start = exon_end + rng.randint(80, 5000)
+                gene_end = exons[-1][1]
+                position = gene_end
+                rows.append((gene_start, 0, feature(contig, source, gene_type, gene_start, gene_end, strand, '.', attributes(gene_id, None, 'biotype', gene_biotype))))
+
+                for transcript_idx in range(transcripts_per_gene if kind == 'coding' else 1):
+                    transcript_id = f"transcript:{contig}_{gene_idx}_{transcript_idx}"
+                    #alternative transcripts skip some internal exons
+                    transcript_exons = [exon for idx, exon in enumerate(exons) if idx in (0, len(exons) - 1) or rng.random() > 0.2 * transcript_idx]
+                    transcript_start, transcript_end = transcript_exons[0][0], transcript_exons[-1][1]
+                    rows.append((transcript_start, 1, feature(contig, source, transcript_type, transcript_start, transcript_end, strand, '.', attributes(transcript_id, gene_id, 'biotype', transcript_biotype))))
+                    for exon_idx, (start, end) in enumerate(transcript_exons):
+                        rows.append((start, 2, feature(contig, source, 'exon', start, end, strand, '.', attributes(f"exon:{transcript_id}_{exon_idx}", transcript_id, None, None))))
+                        if has_cds:
+                            cds_start = start + (rng.randint(0, (end - start) // 2) if exon_idx == 0 else 0)
+                            rows.append((cds_start, 3, feature(contig, source, 'CDS', cds_start, end, strand, str(rng.randint(0, 2)), attributes(f"cds:{transcript_id}", transcript_id, None, None))))
+
+            contig_length = position + 10000
+            gff.write(f"##sequence-region {contig} 1 {contig_length}\n")
+            gff.write(feature(contig, 'RefSeq', 'region', 1, contig_length, '+', '.', f"ID={contig}:1..{contig_length}") + '\n')
+            rows.sort(key=lambda row: (row[0], row[1]))
+            for _, _, line in rows:
+                gff.write(line + '\n')
+    return counts
+
+def bgzip_and_index(path: str) -> str:
+    """
+    Compress the sorted GFF with bgzip and index it with a csi index, as the import does.
+    Return the path of the bgzipped file (the csi index is next to it)
+    """
+    bgzipped_path = pysam.tabix_index(path, preset='gff', csi=True, force=True, keep_original=False)
+    return bgzipped_path
+
+def generate_indexed_gff(directory: str, name: str, **params) -> tuple[str, dict]:
+    """
+    Generate a synthetic GFF in the directory, bgzip and index it.
+    Return the bgzipped path and the counts of the features written
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.gff")
+    counts = generate_gff(path, **params)
+    return bgzip_and_index(path), counts
@@ -1,8 +1,21 @@
+from celery.signals import worker_ready
 from .celery_utils import create_celery
+from . import task_lock
 from db.database import connect_to_db
 from jobs.import_annotations import import_annotations
-from jobs.updates import update_assembly_fields, update_annotation_fields, update_feature_stats, update_bioprojects
+from jobs.updates import update_assembly_fields, update_annotation_fields, sync_annotation_assembly_fields, update_feature_stats, update_feature_stats_batch, update_bioprojects, compact_sequence_maps
+from jobs.cleanup import collect_garbage
+from jobs.indexes import advise_indexes
+from jobs.services import assembly as assembly_service
 
 app = create_celery()
 
 connect_to_db()
+
+@worker_ready.connect
+def backfill_annotation_assembly_fields(**kwargs):
+    """
+    One-shot migration run on deploy: the annotations saved before the assembly fields were copied to them are backfilled
+    """
+    if not assembly_service.annotation_assembly_fields_synced() and task_lock.enqueue_once(sync_annotation_assembly_fields):
+        print("Queued the backfill of the annotation assembly fields")
@@ -0,0 +1,200 @@
+import os
+import json
+import uuid
+import socket
+import threading
+from datetime import datetime
+from functools import wraps
+from celery import current_task
+from db.database import get_redis_client
+
+LOCK_PREFIX = 'annotrieve:lock:'
+QUEUED_PREFIX = 'annotrieve:queued:'
+LEASE_PREFIX = 'annotrieve:lease:'
+CHECKPOINT_PREFIX = 'annotrieve:checkpoint:'
+FANOUT_PREFIX = 'annotrieve:fanout:'
+LOCK_TTL = int(os.getenv('TASK_LOCK_TTL', '300')) #seconds, renewed by the heartbeat while the task runs
+QUEUED_TTL = int(os.getenv('TASK_QUEUED_TTL', '86400')) #a queued task that never starts does not block the next trigger forever
+LEASE_TTL = int(os.getenv('TASK_LEASE_TTL', '3600'))
+FANOUT_TTL = int(os.getenv('TASK_FANOUT_TTL', '86400')) #renewed by every finished subtask, subtasks lost by a dead worker do not block the task forever
+#tasks that must never run twice at the same time
+SINGLETON_TASKS = ['import_annotations', 'update_feature_stats', 'update_annotation_fields', 'sync_annotation_assembly_fields', 'update_bioprojects', 'collect_garbage', 'compact_sequence_maps', 'advise_indexes']
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+#compare-and-delete / compare-and-set, a lock or lease is only touched by its owner
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return nil
+"""
+
+class TaskLock:
+    """
+    Redis lock held by a single task run, its ttl is renewed by a heartbeat thread:
+    if the worker dies the lock expires after LOCK_TTL seconds
+    """
+    def __init__(self, name: str, ttl: int = LOCK_TTL):
+        self.name = name
+        self.key = f"{LOCK_PREFIX}{name}"
+        self.ttl = ttl
+        self.value = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self, task_id: str | None = None) -> bool:
+        now = datetime.now().isoformat()
+        info = {
+            'token': uuid.uuid4().hex,
+            'task': self.name,
+            'task_id': task_id,
+            'worker': WORKER_ID,
+            'acquired_at': now,
+            'heartbeat_at': now,
+        }
+        value = json.dumps(info)
+        if not get_redis_client().set(self.key, value, nx=True, ex=self.ttl):
+            return False
+        self.value = value
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name=f"lock-heartbeat-{self.name}", daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            info = json.loads(self.value)
+            info['heartbeat_at'] = datetime.now().isoformat()
+            value = json.dumps(info)
+            try:
+                if not get_redis_client().eval(RENEW_SCRIPT, 1, self.key, self.value, value, self.ttl):
+                    print(f"Lock {self.name} lost, stopping heartbeat")
+                    return
+                self.value = value
+            except Exception as e:
+                print(f"Error renewing lock {self.name}: {e}")
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self.value:
+            get_redis_client().eval(RELEASE_SCRIPT, 1, self.key, self.value)
+            self.value = None
+
+def get_lock_info(name: str) -> dict | None:
+    """
+    Return the holder of the lock of a task (without the token) or None if the task is not running
+    """
+    value = get_redis_client().get(f"{LOCK_PREFIX}{name}")
+    if not value:
+        return None
+    info = json.loads(value)
+    info.pop('token', None)
+    return info
+
+def get_locks_status() -> dict:
+    """
+    Report for every singleton task whether it is running (with the lock holder and heartbeat) or queued
+    """
+    client = get_redis_client()
+    status = {}
+    for name in SINGLETON_TASKS:
+        status[name] = {
+            'running': get_lock_info(name),
+            'queued': client.get(f"{QUEUED_PREFIX}{name}"),
+            'pending_subtasks': get_fanout_pending(name),
+            'checkpoint': get_checkpoint(name),
+        }
+    return status
+
+def singleton(name: str):
+    """
+    Decorator for celery tasks that must not run concurrently: a run that finds the lock taken exits without doing anything
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            task_id = current_task.request.id if current_task else None
+            get_redis_client().delete(f"{QUEUED_PREFIX}{name}")
+            pending = get_fanout_pending(name)
+            if pending:
+                print(f"Task {name} still has {pending} subtasks queued or running, skipping")
+                return {'skipped': True, 'pending_subtasks': pending}
+            lock = TaskLock(name)
+            if not lock.acquire(task_id):
+                print(f"Task {name} is already running ({get_lock_info(name)}), skipping")
+                return {'skipped': True, 'running': get_lock_info(name)}
+            try:
+                return func(*args, **kwargs)
+            finally:
+                lock.release()
+        return wrapper
+    return decorator
+
+def enqueue_once(task, *args, **kwargs):
+    """
+    Queue the task unless it is already running or waiting in the queue, return the AsyncResult or None if deduplicated
+    """
+    if get_lock_info(task.name) or get_fanout_pending(task.name):
+        return None
+    if not get_redis_client().set(f"{QUEUED_PREFIX}{task.name}", datetime.now().isoformat(), nx=True, ex=QUEUED_TTL):
+        return None
+    return task.delay(*args, **kwargs)
+
+def start_fanout(name: str, subtasks: int):
+    """
+    Record the subtasks queued by a run of a singleton task: the task is not run again until all of them finished
+    """
+    get_redis_client().set(f"{FANOUT_PREFIX}{name}", subtasks, ex=FANOUT_TTL)
+
+def finish_fanout_subtask(name: str):
+    """
+    Called by every subtask when it ends, successful or not
+    """
+    client = get_redis_client()
+    key = f"{FANOUT_PREFIX}{name}"
+    if not client.exists(key):
+        return
+    if client.decr(key) <= 0:
+        client.delete(key)
+    else:
+        client.expire(key, FANOUT_TTL)
+
+def get_fanout_pending(name: str) -> int:
+    return int(get_redis_client().get(f"{FANOUT_PREFIX}{name}") or 0)
+
+def acquire_lease(scope: str, key: str, ttl: int = LEASE_TTL) -> bool:
+    """
+    Lease a single item of a run (e.g. an annotation) to this worker, so that parallel workers never process the same item
+    """
+    return bool(get_redis_client().set(f"{LEASE_PREFIX}{scope}:{key}", WORKER_ID, nx=True, ex=ttl))
+
+def release_leases(scope: str, keys: list[str]):
+    """
+    Release the leases owned by this worker
+    """
+    client = get_redis_client()
+    for key in keys:
+        client.eval(RELEASE_SCRIPT, 1, f"{LEASE_PREFIX}{scope}:{key}", WORKER_ID)
+
+def get_checkpoint(name: str) -> dict | None:
+    """
+    Return the progress saved by an interrupted run of a task, None if there is nothing to resume
+    """
+    value = get_redis_client().get(f"{CHECKPOINT_PREFIX}{name}")
+    return json.loads(value) if value else None
+
+def set_checkpoint(name: str, checkpoint: dict):
+    get_redis_client().set(f"{CHECKPOINT_PREFIX}{name}", json.dumps(checkpoint))
+
+def clear_checkpoint(name: str):
+    get_redis_client().delete(f"{CHECKPOINT_PREFIX}{name}")
@@ -1,10 +1,15 @@
+import os
+import zlib
 import requests
+import aiohttp
+
+ENA_BROWSER_URL = os.getenv('ENA_BROWSER_URL', 'https://www.ebi.ac.uk/ena/browser/api')
 
 
 def get_taxon_from_ena_browser(taxon_id):
     data=None
     try:
-        response = requests.get(f"https://www.ebi.ac.uk/ena/browser/api/xml/{taxon_id}") ## 
+        response = requests.get(f"{ENA_BROWSER_URL}/xml/{taxon_id}") ## 
         response.raise_for_status()
         data = response.content
     except Exception as e:
@@ -33,7 +38,7 @@ def get_assemblies_metadata_from_ena_browser_and_store_in_file(accessions, path_
     """
     payload = {"accessions": accessions, "download": True, "gzip": True}
     try:
-        response = requests.post(f"https://www.ebi.ac.uk/ena/browser/api/xml", json=payload)
+        response = requests.post(f"{ENA_BROWSER_URL}/xml", json=payload)
         response.raise_for_status()
         with open(path_to_gzipped_xml_file, "wb") as f:
             f.write(response.content)
@@ -43,23 +48,40 @@ def get_assemblies_metadata_from_ena_browser_and_store_in_file(accessions, path_
         print(e)
         return False
 
-def get_xml_from_ena_browser(accessions, path_to_gzipped_xml_file):
+async def stream_xml_from_ena_browser(session: aiohttp.ClientSession, accessions: list[str], chunk_size: int = 1024 * 1024):
     """
-    Get XML from ENA browser and store it in a file, via post request up to 10k accessions at a time
+    Stream the XML of the accessions from ENA browser, via post request up to 10k accessions at a time.
+    The gzipped response is decompressed on the fly and the XML chunks are yielded as they arrive,
+    the session must be created with auto_decompress=False
     """
     payload = {"accessions": accessions, "download": True, "gzip": True}
-    try:
-        with requests.post(f"https://www.ebi.ac.uk/ena/browser/api/xml", json=payload, stream=True) as response:
-            response.raise_for_status()
-            with open(path_to_gzipped_xml_file, "wb") as f:
-                for chunk in response.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        f.write(chunk)
-        return True
-    except Exception as e:
-        print(f"Error occurred while fetching XML from ENA browser")
-        print(e)
-        return None
+    async with session.post(f"{ENA_BROWSER_URL}/xml", json=payload) as response:
+        response.raise_for_status()
+        decompressor = None
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if decompressor is None:
+                if not chunk.startswith(b'\x1f\x8b'):
+                    #plain XML response
+                    decompressor = False
+                else:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if decompressor is False:
+                yield chunk
+                continue
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+                if decompressor.eof:
+                    #concatenated gzip members
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    chunk = b''
+        if decompressor:
+            data = decompressor.flush()
+            if data:
+                yield data
 
 def search_accessions_with_post_request(result, accessions, fields):
     """
@@ -1,80 +1,189 @@
 import subprocess
+import asyncio
 import json
+import math
 import time
 import os
+import socket
+import threading
 import requests
-# Global rate limiting state
-_rate_counter = 0
-_last_reset_time = time.time()
-_total_api_calls = 0
-_total_wait_time = 0
+import redis
+from db.database import get_redis_client
 
-# Rate limiting configuration
-RATE_LIMIT_CALLS = int(os.getenv('NCBI_RATE_LIMIT_CALLS', '3'))  # Calls before waiting
-RATE_LIMIT_WAIT = float(os.getenv('NCBI_RATE_LIMIT_WAIT', '1.0'))  # Seconds to wait
+# Rate limiting configuration: NCBI allows 3 requests per second without an api key, 10 with it
+NCBI_API_KEY = os.getenv('NCBI_API_KEY')
+RATE_LIMIT_PER_SECOND = float(os.getenv('NCBI_RATE_LIMIT_PER_SECOND', '10' if NCBI_API_KEY else '3'))
+RATE_LIMIT_BURST = int(os.getenv('NCBI_RATE_LIMIT_BURST', str(max(int(RATE_LIMIT_PER_SECOND), 1))))
+CONCURRENCY = int(os.getenv('NCBI_DATASETS_CONCURRENCY', '3')) #datasets subprocesses running at the same time
+#accessions sent by the datasets CLI in each API request, a call with an input file costs one token per request
+ACCESSIONS_PER_REQUEST = int(os.getenv('NCBI_ACCESSIONS_PER_REQUEST', '1000'))
+
+BUCKET_KEY = 'annotrieve:ncbi:bucket'
+METRICS_KEY = 'annotrieve:ncbi:metrics'
+#calls running in each worker, the key expires if a worker dies with calls in flight
+IN_FLIGHT_KEY = 'annotrieve:ncbi:in_flight'
+IN_FLIGHT_TTL = 3600 #seconds, longer than a datasets call
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+#token bucket shared by all the workers through redis, the redis clock is used so that every worker sees the same time.
+#return 0 when a token is taken, otherwise the milliseconds to wait for the next one
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated_at) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+class LocalTokenBucket:
+    """
+    In-process token bucket, used only when redis is not reachable
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+_local_bucket = LocalTokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+
+# Per-process metrics, the totals of all the workers are kept in redis
+_metrics_lock = threading.Lock()
+_metrics = {
+    'total_api_calls': 0,
+    'total_wait_time': 0.0,
+    'total_call_time': 0.0,
+    'errors': 0,
+    'in_flight': 0,
+}
+
+def _take_token() -> float:
+    """
+    Try to take a token, return 0 if taken or the seconds to wait before retrying
+    """
+    try:
+        wait_ms = get_redis_client().eval(TOKEN_BUCKET_SCRIPT, 1, BUCKET_KEY, RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+        return int(wait_ms) / 1000
+    except redis.RedisError as e:
+        print(f"Redis token bucket unavailable, using the local one: {e}")
+        return _local_bucket.take()
+
+def _record(**increments):
+    with _metrics_lock:
+        for key, value in increments.items():
+            _metrics[key] += value
+    try:
+        pipe = get_redis_client().pipeline()
+        for key, value in increments.items():
+            if key == 'in_flight':
+                pipe.hincrby(IN_FLIGHT_KEY, WORKER_ID, value)
+                pipe.expire(IN_FLIGHT_KEY, IN_FLIGHT_TTL)
+            else:
+                pipe.hincrbyfloat(METRICS_KEY, key, value)
+        pipe.execute()
+    except redis.RedisError:
+        pass
 
 def _apply_rate_limiting():
     """
-    Apply rate limiting for NCBI API calls.
-    Waits if the rate limit is exceeded.
-    """
-    global _rate_counter, _last_reset_time, _total_api_calls, _total_wait_time
-    
-    _rate_counter += 1
-    _total_api_calls += 1
-    
-    if _rate_counter >= RATE_LIMIT_CALLS:
-        wait_start = time.time()
-        time.sleep(RATE_LIMIT_WAIT)
-        wait_time = time.time() - wait_start
-        _total_wait_time += wait_time
-        
-        _rate_counter = 0
-        _last_reset_time = time.time()
+    Block until the shared token bucket grants a call
+    """
+    waited = 0.0
+    while (wait := _take_token()) > 0:
+        time.sleep(wait)
+        waited += wait
+    _record(total_api_calls=1, total_wait_time=waited)
+
+async def _apply_rate_limiting_async(tokens: int = 1):
+    """
+    Wait without blocking the event loop until the shared token bucket grants `tokens` API requests
+    """
+    waited = 0.0
+    for _ in range(tokens):
+        while (wait := await asyncio.to_thread(_take_token)) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+    _record(total_api_calls=tokens, total_wait_time=waited)
+
+def count_requests(accessions: int) -> int:
+    """
+    Number of API requests made by the datasets CLI for an input file of accessions
+    """
+    return max(1, math.ceil(accessions / ACCESSIONS_PER_REQUEST))
 
 def reset_rate_limiting_state():
     """
-    Reset the global rate limiting state.
+    Reset the rate limiting metrics.
     Useful for testing or when starting a new batch of operations.
     """
-    global _rate_counter, _last_reset_time, _total_api_calls, _total_wait_time
-    
-    _rate_counter = 0
-    _last_reset_time = time.time()
-    _total_api_calls = 0
-    _total_wait_time = 0
-    
+    with _metrics_lock:
+        for key in _metrics:
+            _metrics[key] = 0
+    try:
+        get_redis_client().delete(METRICS_KEY, IN_FLIGHT_KEY)
+    except redis.RedisError:
+        pass
 
 def get_rate_limiting_stats():
     """
     Get statistics about rate limiting usage.
-    
+
     Returns:
-        dict: Statistics about API calls and rate limiting
+        dict: Statistics of this process and the totals of all the workers
     """
-    global _total_api_calls, _total_wait_time, _last_reset_time
-    
+    with _metrics_lock:
+        process_stats = dict(_metrics)
+    try:
+        client = get_redis_client()
+        totals = {key: float(value) for key, value in client.hgetall(METRICS_KEY).items()}
+        totals['in_flight'] = sum(max(int(value), 0) for value in client.hvals(IN_FLIGHT_KEY))
+    except redis.RedisError:
+        totals = None
+    calls = process_stats['total_api_calls']
     return {
-        'total_api_calls': _total_api_calls,
-        'total_wait_time': _total_wait_time,
-        'rate_limit_calls': RATE_LIMIT_CALLS,
-        'rate_limit_wait': RATE_LIMIT_WAIT,
-        'last_reset_time': _last_reset_time,
-        'time_since_last_reset': time.time() - _last_reset_time,
-        'average_wait_time_per_call': _total_wait_time / _total_api_calls if _total_api_calls > 0 else 0
+        **process_stats,
+        'rate_limit_per_second': RATE_LIMIT_PER_SECOND,
+        'rate_limit_burst': RATE_LIMIT_BURST,
+        'concurrency': CONCURRENCY,
+        'average_wait_time_per_call': process_stats['total_wait_time'] / calls if calls > 0 else 0,
+        'all_workers': totals,
     }
 
 def get_data_from_ncbi(command):
 
     # Apply rate limiting before starting the API call
     _apply_rate_limiting()
-    
+
     CMD = ["datasets", "summary"]
 
     CMD.extend(command)
     # Execute the script and capture its output
     result = subprocess.run(CMD, capture_output=True, text=True)
-    
+
     # Check if the script executed successfully
     if result.returncode == 0:
         # Load the JSON output into a dictionary
@@ -83,19 +192,21 @@ def get_data_from_ncbi(command):
             return output_dict
         except json.JSONDecodeError as e:
             print("Error decoding JSON:", e)
+            _record(errors=1)
             return None
     else:
         print("Error executing script:", result.stderr)
+        _record(errors=1)
         return None
-    
+
 def stream_jsonlines_from_ncbi(command):
     CMD = ["datasets", "summary"]
     CMD.extend(command)
     CMD.append('--as-json-lines')
-    
+
     # Apply rate limiting before starting the API call
     _apply_rate_limiting()
-    
+
     try:
         process = subprocess.Popen(CMD, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
@@ -112,9 +223,68 @@ def stream_jsonlines_from_ncbi(command):
         if return_code != 0:
             stderr = process.stderr.read()
             print("Command failed:", stderr)
+            _record(errors=1)
 
     except Exception as e:
         print("Error during streaming:", e)
+        _record(errors=1)
+
+async def stream_jsonlines_from_ncbi_async(command, request_count: int = 1):
+    """
+    Run `datasets summary <command> --as-json-lines` without blocking the event loop and yield the reports as they are printed.
+    request_count tokens are taken from the bucket, one per API request made by the command (see count_requests)
+    """
+    CMD = ["datasets", "summary", *command, '--as-json-lines']
+    await _apply_rate_limiting_async(request_count)
+    start = time.monotonic()
+    _record(in_flight=1)
+    process = None
+    stderr_reader = None
+    try:
+        process = await asyncio.create_subprocess_exec(*CMD, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=64 * 1024 * 1024)
+        #stderr is drained while stdout is read, a full stderr pipe would block the subprocess
+        stderr_reader = asyncio.create_task(process.stderr.read())
+        async for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                print("Invalid JSON line:", line[:200], "\nError:", e)
+                continue
+        stderr = await stderr_reader
+        if await process.wait() != 0:
+            print("Command failed:", stderr.decode(errors='replace'))
+            _record(errors=1)
+    finally:
+        if process is not None and process.returncode is None:
+            #the consumer stopped early or the read failed
+            process.kill()
+            await process.wait()
+        if stderr_reader is not None and not stderr_reader.done():
+            stderr_reader.cancel()
+        _record(in_flight=-1, total_call_time=time.monotonic() - start)
+
+async def get_reports_many(commands: list[list[str]], concurrency: int = CONCURRENCY, request_counts: list[int] | None = None) -> list[list[dict]]:
+    """
+    Run several datasets summary commands concurrently (at most `concurrency` subprocesses, each one under the token bucket).
+    request_counts are the API requests of each command (one by default).
+    Return the reports of every command, in the same order as the commands
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bound_fetch(command, request_count):
+        async with sem:
+            try:
+                return [report async for report in stream_jsonlines_from_ncbi_async(command, request_count)]
+            except Exception as e:
+                print(f"Error running datasets {' '.join(command)}: {e}")
+                _record(errors=1)
+                return []
+
+    request_counts = request_counts or [1] * len(commands)
+    return await asyncio.gather(*(bound_fetch(command, request_count) for command, request_count in zip(commands, request_counts)))
 
 
 def get_assembled_molecules_from_ncbi(assembly_accession):
@@ -123,11 +293,13 @@ def get_assembled_molecules_from_ncbi(assembly_accession):
     """
     _apply_rate_limiting()
     api_url = f"https://api.ncbi.nlm.nih.gov/datasets/v2/genome/accession/{assembly_accession}/sequence_reports?role_filters=assembled-molecule&page_size=1000"
+    headers = {'api-key': NCBI_API_KEY} if NCBI_API_KEY else None
     try:
-        response = requests.get(api_url)
+        response = requests.get(api_url, headers=headers)
         response.raise_for_status()
         return response.json().get('reports', [])
     except Exception as e:
         print(f"Error getting assembled molecules from NCBI: {e}")
+        _record(errors=1)
         return None
 
@@ -12,4 +12,7 @@ class Settings:
     CELERY_RESULT_BACKEND: str = os.environ['CELERY_RESULT_BACKEND']
     CELERY_BROKER_URL: str = os.environ['CELERY_BROKER_URL']
 
+    # Redis Settings (task locks), the celery broker is used by default
+    REDIS_URL: str = os.getenv('REDIS_URL', os.environ['CELERY_BROKER_URL'])
+
 settings = Settings() 
\ No newline at end of file
@@ -1,9 +1,12 @@
 from mongoengine import connect, disconnect
 from configs.app_settings import settings
 import logging
+import redis
 
-def connect_to_db():
-    """Connect to MongoDB."""
+_redis_client = None
+
+def connect_to_db(event_listeners: list | None = None):
+    """Connect to MongoDB, optionally with pymongo event listeners (e.g. command monitoring)."""
     logging.info("Connecting to MongoDB...")
     connect(
         db=settings.MONGODB_DB,
@@ -11,7 +14,8 @@ def connect_to_db():
         port=settings.MONGODB_PORT,
         username=settings.MONGODB_USERNAME,
         password=settings.MONGODB_PASSWORD,
-        authentication_source='admin'
+        authentication_source='admin',
+        event_listeners=event_listeners or [],
     )
     logging.info("Successfully connected to MongoDB.")
 
@@ -19,4 +23,11 @@ def close_db_connection():
     """Close MongoDB connection."""
     logging.info("Closing MongoDB connection...")
     disconnect()
-    logging.info("Successfully closed MongoDB connection.") 
\ No newline at end of file
+    logging.info("Successfully closed MongoDB connection.") 
+
+def get_redis_client() -> redis.Redis:
+    """Return the shared Redis client, created on first use."""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis_client
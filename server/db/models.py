@@ -9,6 +9,7 @@ from mongoengine import (
     EmbeddedDocumentField,
     URLField,
     DateTimeField,
+    ReferenceField,
 )
 
 def drop_all_collections():
@@ -20,6 +21,7 @@ def drop_all_collections():
     GenomeAnnotation.objects().delete()
     TaxonNode.objects().delete()
     BioProject.objects().delete()
+    MetricCatalogue.objects().delete()
 
 class GenomeAssembly(DynamicDocument):
     assembly_accession = StringField(required=True, unique=True)
@@ -85,9 +87,10 @@ class Organism(DynamicDocument):
 class AnnotationSequenceMap(DynamicDocument):
     sequence_id = StringField(required=True) #id in the gff file
     annotation_id = StringField(required=True) #indexed_file_info.uncompressed_md5 of the annotation
-    aliases = ListField(StringField()) #aliases for the sequence_id, e.g. chr1, 1, 1_1, 1_1_1,ucsc_style_name, refseq_accession, insdc_accession, etc.
+    genomic_sequence = ReferenceField('GenomicSequence') #the aliases of the sequence_id are read from the referenced sequence
+    aliases = ListField(StringField()) #legacy: copy of the GenomicSequence aliases, replaced by genomic_sequence (see compact_sequence_maps)
     meta = {
-        'indexes': ['annotation_id', 'sequence_id', 'aliases']
+        'indexes': ['annotation_id', 'sequence_id']
     }
 
 class GenomicSequence(DynamicDocument):
@@ -106,7 +109,7 @@ class GenomicSequence(DynamicDocument):
 
     aliases = ListField(StringField(), required=True) #all possible aliases for the chromosome
     meta = {
-        'indexes': ['assembly_accession', 'aliases']
+        'indexes': ['aliases', ('assembly_accession', 'aliases')] #the compound index also serves the queries on assembly_accession alone
     }
 
 class AnnotationError(DynamicDocument):
@@ -135,6 +138,12 @@ class GenomeAnnotation(DynamicDocument):
     #ASSEMBLY
     assembly_accession = StringField(required=True)
     assembly_name = StringField(required=True)
+    #copies of the GenomeAssembly filter fields, kept in sync by sync_annotation_assembly_fields
+    refseq_category = StringField()
+    assembly_level = StringField()
+    assembly_status = StringField()
+    assembly_type = StringField()
+    bioprojects = ListField(StringField())
 
     #TAXONOMY
     organism_name = StringField(required=True)
@@ -154,6 +163,7 @@ class GenomeAnnotation(DynamicDocument):
 
     #FEATURE STATISTICS gene and transcript types
     features_statistics = EmbeddedDocumentField(GFFStats)
+    stats_version = StringField() #version of the analyzer that computed features_statistics
 
     # Time
     meta = {
@@ -172,6 +182,21 @@ class GenomeAnnotation(DynamicDocument):
             "source_file_info.release_date",
             "source_file_info.last_modified",
             "source_file_info.pipeline.name",
+            "stats_version",
+            "refseq_category",
+            "assembly_level",
+            "assembly_status",
+            "assembly_type",
+            "bioprojects",
+            #common filter combinations of the annotations endpoints, sorted by release date
+            ("taxon_lineage", "source_file_info.database", "-source_file_info.release_date"),
+            ("taxon_lineage", "source_file_info.provider", "-source_file_info.release_date"),
+            #has_stats=true
+            {
+                "fields": ["taxon_lineage", "-source_file_info.release_date"],
+                "partialFilterExpression": {"features_statistics": {"$exists": True}},
+                "name": "taxon_lineage_release_date_with_stats",
+            },
         ]
     }
     def parse_iso_date(iso_date: str) -> datetime:
@@ -199,3 +224,52 @@ class TaxonNode(Document):
             'taxid', 'scientific_name','children','rank'
         ]
     }
+
+
+class MetricCatalogue(Document):
+    """
+    Metrics available for a gene category or transcript type in the features_statistics of the annotations,
+    maintained by the jobs writing the stats (see jobs/services/metric_catalogue.py)
+    """
+    kind = StringField(required=True) #gene, transcript
+    name = StringField(required=True) #gene category or transcript type, as stored in features_statistics
+    metrics = ListField(StringField())
+    updated_at = DateTimeField(default=datetime.now)
+    meta = {
+        'indexes': [
+            {'fields': ['kind', 'name'], 'unique': True},
+        ]
+    }
+
+
+class ImportJob(Document):
+    """
+    Persisted state of an import_annotations run, used to resume the job after a worker restart
+    """
+    status = StringField(required=True, default='running') #running, finished
+    started_at = DateTimeField(default=datetime.now)
+    updated_at = DateTimeField(default=datetime.now)
+    finished_at = DateTimeField()
+    total_annotations = IntField(default=0) #annotations registered for processing
+    meta = {
+        'indexes': ['status', '-started_at']
+    }
+
+class ImportJobAnnotation(Document):
+    """
+    Stage of a single annotation within an import job: pending → fetched → sorted → indexed → stats → saved, or error
+    """
+    job_id = StringField(required=True) #id of the related ImportJob
+    url_path = StringField(required=True) #source url of the annotation
+    source_md5 = StringField(required=True) #md5 of the source file, as in the tsv
+    stage = StringField(required=True, default='pending')
+    annotation_id = StringField() #uncompressed md5 of the sorted file, set once the file is indexed
+    file_size = IntField() #size of the bgzipped file, set once the file is indexed
+    error_message = StringField()
+    updated_at = DateTimeField(default=datetime.now)
+    meta = {
+        'indexes': [
+            {'fields': ['job_id', 'url_path', 'source_md5'], 'unique': True},
+            ('job_id', 'stage'),
+        ]
+    }
@@ -3,7 +3,7 @@ from typing import Optional, Dict, List, Any
 from db.embedded_documents import GeneStats, GeneLengthStats, TranscriptStats, LengthStats, FeatureStats, TranscriptTypeStats, FeatureTypeStats, GFFStats, GeneCategoryFeatureStats, GenericTranscriptTypeStats, GenericLengthStats, AssociatedGenesStats, SubFeatureStats
 import statistics
 from fastapi import HTTPException
-from db.models import AnnotationSequenceMap
+from db.models import AnnotationSequenceMap, GenomicSequence, GenomeAnnotation
 from helpers import pysam_helper
 
 
@@ -34,14 +34,19 @@ def flatten_dict(d: Dict[str, Any], parent_key: str = '', sep: str = '.') -> Dic
             items.append((new_key, v))
     return dict(items)
 
-def resolve_sequence_id(region:str| int, md5_checksum:str, file_path:str):
+def resolve_sequence_id(region:str| int, annotation: GenomeAnnotation, file_path:str):
     """
     Resolve the sequence id from the region or aliases
     """
     region_str = str(region)
+    md5_checksum = annotation.annotation_id
     seq_id = None
-    #resolve aliases to sequence_id
-    gff_region = AnnotationSequenceMap.objects(annotation_id=md5_checksum, aliases__in=[region, region_str]).first()
+    #resolve aliases to the genomic sequences of the assembly, then to the sequence_id mapped to them
+    genomic_sequences = GenomicSequence.objects(assembly_accession=annotation.assembly_accession, aliases=region_str).scalar('id')
+    gff_region = AnnotationSequenceMap.objects(annotation_id=md5_checksum, genomic_sequence__in=list(genomic_sequences)).first()
+    if not gff_region:
+        #sequence maps stored before genomic_sequence was introduced
+        gff_region = AnnotationSequenceMap.objects(annotation_id=md5_checksum, aliases__in=[region, region_str]).first()
     if not gff_region:
         print(f"Region '{region}' not found in annotation {md5_checksum}")
         #check if the region is present in the contigs
@@ -0,0 +1,71 @@
+import time
+from datetime import datetime, timezone
+import redis
+from db.database import get_redis_client
+
+GENERATION_KEY = 'annotrieve:data_generation'
+
+def bump_generation(reason: str) -> int | None:
+    """
+    Increment the data generation after a job changed the catalogue, the in-memory snapshots and cached responses
+    derived from an older generation are discarded by the API workers
+    """
+    try:
+        pipe = get_redis_client().pipeline()
+        pipe.hincrby(GENERATION_KEY, 'generation', 1)
+        pipe.hset(GENERATION_KEY, mapping={'updated_at': datetime.now(timezone.utc).isoformat(), 'reason': reason})
+        generation = pipe.execute()[0]
+        print(f"Data generation bumped to {generation} ({reason})")
+        return generation
+    except redis.RedisError as e:
+        print(f"Error bumping the data generation: {e}")
+        return None
+
+def get_generation_info() -> dict | None:
+    """
+    Return the current generation with the time and reason of the last bump, None if redis is not reachable
+    """
+    try:
+        info = get_redis_client().hgetall(GENERATION_KEY)
+    except redis.RedisError:
+        return None
+    return {
+        'generation': int(info.get('generation', 0)),
+        'updated_at': info.get('updated_at'),
+        'reason': info.get('reason'),
+    }
+
+def get_generation() -> int | None:
+    info = get_generation_info()
+    return info['generation'] if info else None
+
+class GenerationCache:
+    """
+    Value built by loader and kept in memory until the data generation changes (checked at most every check_seconds)
+    """
+    def __init__(self, loader, check_seconds: float = 30):
+        self.loader = loader
+        self.check_seconds = check_seconds
+        self.generation = None
+        self.checked_at = 0.0
+        self.value = None
+        self.loaded = False
+
+    def get(self):
+        now = time.monotonic()
+        if self.loaded and now - self.checked_at < self.check_seconds:
+            return self.value
+        generation = get_generation()
+        if not self.loaded or generation != self.generation:
+            self.value = self.loader()
+            self.generation = generation
+            self.loaded = True
+        self.checked_at = now
+        return self.value
+
+    def reload(self):
+        """
+        Rebuild the value now, e.g. when it is found to be older than the data it describes
+        """
+        self.loaded = False
+        return self.get()
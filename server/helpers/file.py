@@ -30,11 +30,34 @@ def get_annotation_file_path(annotation:GenomeAnnotation):
     Common function to get the full file path for an annotation.
     Handles cleaning the bgzipped_path by removing leading slash if present.
     """
+    return get_file_path(annotation.indexed_file_info.bgzipped_path)
+
+def get_file_path(relative_path: str):
+    """
+    Map a path relative to the annotations dir (as stored in indexed_file_info) to the full path
+    """
     if not ANNOTATIONS_PATH:
         raise ValueError("LOCAL_ANNOTATIONS_DIR environment variable is not set")
     
-    bgzipped_path = annotation.indexed_file_info.bgzipped_path.lstrip('/') if annotation.indexed_file_info.bgzipped_path.startswith('/') else annotation.indexed_file_info.bgzipped_path
-    return os.path.join(ANNOTATIONS_PATH, bgzipped_path)
+    relative_path = relative_path.lstrip('/') if relative_path.startswith('/') else relative_path
+    return os.path.join(ANNOTATIONS_PATH, relative_path)
+
+def iter_files(root_path: str):
+    """
+    Walk the directory tree under root_path and yield the DirEntry of every file, without listing the whole tree in memory
+    """
+    stack = [root_path]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except OSError as e:
+            print(f"Error scanning {dir_path}: {e}")
 
 def remove_files(files, dir_path) -> list[str]:
     """
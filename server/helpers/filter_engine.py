@@ -0,0 +1,224 @@
+import os
+import time
+import threading
+from db.models import GenomeAnnotation
+from helpers import data_generation
+from helpers import parameters as params_helper
+from helpers import metric_columns
+from helpers import request_context
+from helpers.query_visitors import ALLOWED_FIELDS_MAP, NO_VALUE_KEY
+
+#in-process bitmap index of the annotations filter fields, disabled by default (every API worker holds its own copy)
+ENABLED = os.getenv('FILTER_ENGINE', 'false').lower() == 'true'
+GENERATION_CHECK_SECONDS = float(os.getenv('FILTER_ENGINE_CHECK_SECONDS', '5'))
+
+if ENABLED:
+    #optional dependency, only needed when the engine is enabled
+    from pyroaring import BitMap
+
+#filter param of get_annotation_records -> indexed document path
+FILTER_PARAMS = {
+    'taxids': 'taxon_lineage',
+    'db_sources': 'source_file_info.database',
+    'providers': 'source_file_info.provider',
+    'pipelines': 'source_file_info.pipeline.name',
+    'feature_types': 'features_summary.types',
+    'feature_sources': 'features_summary.sources',
+    'biotypes': 'features_summary.biotypes',
+    'assembly_accessions': 'assembly_accession',
+    'refseq_categories': 'refseq_category',
+    'assembly_levels': 'assembly_level',
+    'assembly_statuses': 'assembly_status',
+    'assembly_types': 'assembly_type',
+    'bioproject_accessions': 'bioprojects',
+}
+INDEXED_PATHS = sorted(set(FILTER_PARAMS.values()) | {'taxid', 'organism_name'})
+
+def get_path(document: dict, path: str):
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+class Snapshot:
+    """
+    Bitmaps of the annotation ordinals (position in _id order) for every (field, value) of a data generation
+    """
+    def __init__(self, generation: int | None):
+        self.generation = generation
+        self.annotation_ids: list[str] = []
+        self.ordinals: dict[str, int] = {}
+        self.universe = BitMap()
+        self.with_stats = BitMap()
+        self.indexes: dict[str, dict] = {path: {} for path in INDEXED_PATHS}
+        self.metrics = metric_columns.MetricColumns([])
+        self.built_at = None
+        self.build_seconds = None
+
+    def build(self):
+        start = time.perf_counter()
+        collection = GenomeAnnotation._get_collection()
+        values: dict[str, dict] = {path: {} for path in INDEXED_PATHS}
+        ordinal_by_object_id = {}
+        projection = {path: 1 for path in INDEXED_PATHS}
+        projection['annotation_id'] = 1
+        for ordinal, document in enumerate(collection.find({}, projection).sort('_id', 1)):
+            self.annotation_ids.append(document['annotation_id'])
+            ordinal_by_object_id[document['_id']] = ordinal
+            for path in INDEXED_PATHS:
+                value = get_path(document, path)
+                #missing values are indexed under None (counted as NO_VALUE_KEY), empty lists are not indexed
+                for item in (set(value) if isinstance(value, list) else [value]):
+                    values[path].setdefault(item, []).append(ordinal)
+        self.ordinals = {annotation_id: ordinal for ordinal, annotation_id in enumerate(self.annotation_ids)}
+        self.universe = BitMap(range(len(self.annotation_ids)))
+        self.indexes = {path: {value: BitMap(ordinals) for value, ordinals in by_value.items()} for path, by_value in values.items()}
+        #same semantics as has_stats (features_statistics__exists), the metrics of the histograms are read in the same pass
+        self.metrics = metric_columns.MetricColumns(self.annotation_ids)
+        with_stats = []
+        stats_projection = {'features_statistics.gene_category_stats': 1, 'features_statistics.transcript_type_stats': 1}
+        for document in collection.find({'features_statistics': {'$exists': True}}, stats_projection):
+            ordinal = ordinal_by_object_id.get(document['_id'])
+            if ordinal is None:
+                continue
+            with_stats.append(ordinal)
+            self.add_metrics(ordinal, document.get('features_statistics') or {})
+        self.with_stats = BitMap(with_stats)
+        self.built_at = time.time()
+        self.build_seconds = time.perf_counter() - start
+        return self
+
+    def add_metrics(self, ordinal: int, features_statistics: dict):
+        for kind, stats_key, metric_paths in [
+            ('gene', 'gene_category_stats', metric_columns.GENE_METRIC_PATHS),
+            ('transcript', 'transcript_type_stats', metric_columns.TRANSCRIPT_METRIC_PATHS),
+        ]:
+            for name, stats in (features_statistics.get(stats_key) or {}).items():
+                for metric, path in metric_paths.items():
+                    self.metrics.set((kind, name, metric), ordinal, get_path(stats, path))
+
+    def evaluate(self, params: dict) -> 'BitMap | None':
+        """
+        Evaluate the filters of get_annotation_records: OR of the values of a param, AND between params.
+        Return None if a param is not indexed (text filter, dates, sort), the caller then queries mongo
+        """
+        result = self.universe
+        for param, value in params.items():
+            if value is None or value == '' or value == []:
+                continue
+            if param == 'has_stats':
+                if isinstance(value, str) and value.lower() not in ('true', 'false'):
+                    return None
+                has_stats = params_helper.format_boolean_param(value)
+                result = result & self.with_stats if has_stats else result - self.with_stats
+            elif param == 'md5_checksums':
+                result = result & BitMap(self.ordinals[annotation_id] for annotation_id in params_helper.normalize_to_list(value) if annotation_id in self.ordinals)
+            elif param in FILTER_PARAMS:
+                index = self.indexes[FILTER_PARAMS[param]]
+                bitmaps = [index[item] for item in params_helper.normalize_to_list(value) if item in index]
+                result = result & BitMap.union(*bitmaps) if bitmaps else BitMap()
+            else:
+                return None
+        return result
+
+    def frequencies(self, matches: 'BitMap', field: str, top_k: int | None = None) -> dict[str, int] | None:
+        """
+        Count the matching annotations per value of a field (cardinality of the intersections), sorted by count.
+        Return None if the field is not indexed
+        """
+        path = ALLOWED_FIELDS_MAP.get(field)
+        if path not in self.indexes:
+            return None
+        counts = []
+        for value, bitmap in self.indexes[path].items():
+            count = matches.intersection_cardinality(bitmap)
+            if count:
+                counts.append((NO_VALUE_KEY if value is None else str(value), count))
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        if top_k:
+            counts = counts[:top_k]
+        return dict(counts)
+
+    def page_ids(self, matches: 'BitMap', offset: int, limit: int) -> list[str]:
+        """
+        Return the annotation ids of a page of the matches, in _id order
+        """
+        return [self.annotation_ids[matches[idx]] for idx in range(offset, min(offset + limit, len(matches)))]
+
+_snapshot: Snapshot | None = None
+_building = threading.Lock()
+_last_check = 0.0
+_last_build_start = 0.0
+#last data generation read from redis
+_current_generation: int | None = None
+
+def build_snapshot():
+    """
+    Build a snapshot of the current generation and swap it in, a single build runs at a time
+    """
+    global _snapshot
+    if not _building.acquire(blocking=False):
+        return
+    try:
+        generation = data_generation.get_generation()
+        snapshot = Snapshot(generation).build()
+        _snapshot = snapshot
+        print(f"Filter engine: {len(snapshot.annotation_ids)} annotations indexed in {snapshot.build_seconds:.2f}s (generation {generation})")
+    except Exception as e:
+        print(f"Filter engine: error building the snapshot: {e}")
+    finally:
+        _building.release()
+
+def start():
+    """
+    Build the first snapshot in the background, the requests are served by mongo until it is ready
+    """
+    global _last_build_start
+    if ENABLED:
+        _last_build_start = time.monotonic()
+        threading.Thread(target=build_snapshot, name='filter-engine-build', daemon=True).start()
+
+def get_current_generation() -> int | None:
+    """
+    Data generation of the request, the one of its ETag when set by the conditional requests middleware,
+    otherwise read from redis at most every GENERATION_CHECK_SECONDS
+    """
+    global _last_check, _current_generation
+    state = request_context.get_state()
+    if state and state.get('data_generation') is not None:
+        return state['data_generation']
+    now = time.monotonic()
+    if now - _last_check >= GENERATION_CHECK_SECONDS:
+        _last_check = now
+        _current_generation = data_generation.get_generation()
+    return _current_generation
+
+def get_snapshot() -> Snapshot | None:
+    """
+    Return the snapshot if it matches the current data generation.
+    Otherwise a rebuild is started in the background (at most every GENERATION_CHECK_SECONDS)
+    and None is returned until the snapshot of the new generation is swapped in
+    """
+    if not ENABLED or _snapshot is None:
+        return None
+    generation = get_current_generation()
+    if generation is not None and generation != _snapshot.generation:
+        #a request older than the snapshot (generation read before a bump) is served by mongo without a rebuild
+        newer = _snapshot.generation is None or generation > _snapshot.generation
+        if newer and not _building.locked() and time.monotonic() - _last_build_start >= GENERATION_CHECK_SECONDS:
+            start()
+        return None
+    return _snapshot
+
+def get_status() -> dict:
+    snapshot = _snapshot
+    return {
+        'enabled': ENABLED,
+        'building': _building.locked(),
+        'generation': snapshot.generation if snapshot else None,
+        'annotations': len(snapshot.annotation_ids) if snapshot else 0,
+        'built_at': snapshot.built_at if snapshot else None,
+        'build_seconds': snapshot.build_seconds if snapshot else None,
+    }
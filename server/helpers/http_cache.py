@@ -0,0 +1,122 @@
+import os
+import re
+import time
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request
+from fastapi.responses import Response
+from helpers import data_generation
+from helpers import request_context
+
+MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', '60')) #seconds
+GENERATION_CHECK_SECONDS = 2
+#job triggers (auth key in the path), job state and monitoring routes are never cached
+UNCACHED_PATHS = re.compile(r'^/(jobs|metrics|health)|/(import|update|cleanup|drop)(/|$)')
+
+def get_build_version() -> str:
+    """
+    APP_VERSION when set by the deploy, otherwise a digest of the server sources:
+    a deploy changing the format of a response must not keep the ETags of the previous one valid
+    """
+    version = os.getenv('APP_VERSION')
+    if version:
+        return version
+    digest = hashlib.sha1()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(dirname for dirname in dirnames if dirname != '__pycache__' and not dirname.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, root).encode())
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+BUILD_VERSION = get_build_version()
+#Last-Modified is never older than the start of the server, If-Modified-Since is revalidated after a deploy as the ETags
+STARTED_AT = datetime.now(timezone.utc).replace(microsecond=0)
+
+generation_info_cache = {'checked_at': 0.0, 'value': None}
+
+def get_generation_info() -> dict | None:
+    """
+    Data generation read from redis at most every GENERATION_CHECK_SECONDS
+    """
+    now = time.monotonic()
+    if now - generation_info_cache['checked_at'] >= GENERATION_CHECK_SECONDS:
+        generation_info_cache['value'] = data_generation.get_generation_info()
+        generation_info_cache['checked_at'] = now
+    return generation_info_cache['value']
+
+def is_cacheable(request: Request) -> bool:
+    return request.method in ('GET', 'HEAD') and not UNCACHED_PATHS.search(request.url.path)
+
+def compute_etag(generation: int, request: Request) -> str:
+    """
+    Strong ETag of a resource for a data generation and build: the responses only change when a job bumps the generation or on a deploy
+    """
+    query = '&'.join(sorted(f"{key}={value}" for key, value in request.query_params.multi_items()))
+    resource = f"{BUILD_VERSION}|{request.url.path}?{query}|{request.headers.get('accept', '')}"
+    return f'"{generation}-{hashlib.sha1(resource.encode()).hexdigest()[:20]}"'
+
+def parse_last_modified(updated_at: str | None) -> datetime:
+    try:
+        return max(datetime.fromisoformat(updated_at).replace(microsecond=0), STARTED_AT)
+    except (TypeError, ValueError):
+        return STARTED_AT
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None) -> bool:
+    """
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 9110
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and last_modified:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cache_headers(etag: str, last_modified: datetime | None) -> dict:
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={MAX_AGE}, must-revalidate',
+        'Vary': 'Accept',
+    }
+    if last_modified:
+        headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+    return headers
+
+async def conditional_requests(request: Request, call_next):
+    """
+    Answer a conditional GET matching the current data generation with a 304 before any mongo query,
+    and add the ETag, Last-Modified and Cache-Control headers to the other successful responses
+    (a route setting its own ETag or Cache-Control keeps it)
+    """
+    if not is_cacheable(request):
+        return await call_next(request)
+    info = get_generation_info()
+    if info is None:
+        #redis not reachable, no validator to compare with
+        return await call_next(request)
+    state = request_context.get_state()
+    if state is not None:
+        #the filter engine serves the request only from a snapshot of this generation
+        state['data_generation'] = info['generation']
+    etag = compute_etag(info['generation'], request)
+    last_modified = parse_last_modified(info.get('updated_at'))
+    headers = cache_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response = await call_next(request)
+    if response.status_code == 200 and 'etag' not in response.headers:
+        for key, value in headers.items():
+            if key.lower() not in response.headers:
+                response.headers[key] = value
+    return response
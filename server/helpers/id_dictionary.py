@@ -0,0 +1,36 @@
+import hashlib
+from db.models import GenomeAnnotation
+from helpers import data_generation
+
+class IdDictionary:
+    """
+    Sorted annotation ids of the catalogue: the packed responses return the index of an annotation id in this list
+    """
+    def __init__(self, annotation_ids: list[str]):
+        self.annotation_ids = annotation_ids
+        self.index = {annotation_id: idx for idx, annotation_id in enumerate(annotation_ids)}
+        self.etag = '"' + hashlib.sha1('\n'.join(annotation_ids).encode()).hexdigest()[:20] + '"'
+
+    def indices(self, annotation_ids) -> list[int]:
+        return [self.index[annotation_id] for annotation_id in annotation_ids]
+
+def load_id_dictionary() -> IdDictionary:
+    return IdDictionary(sorted(GenomeAnnotation.objects().scalar('annotation_id')))
+
+#rebuilt when the data generation changes
+id_dictionary_cache = data_generation.GenerationCache(load_id_dictionary)
+
+def get_id_dictionary() -> IdDictionary:
+    return id_dictionary_cache.get()
+
+def get_indices(annotation_ids) -> tuple[list[int], IdDictionary]:
+    """
+    Return the indices of the annotation ids and the dictionary they refer to,
+    the dictionary is rebuilt if an annotation was imported after it
+    """
+    dictionary = get_id_dictionary()
+    try:
+        return dictionary.indices(annotation_ids), dictionary
+    except KeyError:
+        dictionary = id_dictionary_cache.reload()
+        return dictionary.indices(annotation_ids), dictionary
@@ -0,0 +1,104 @@
+import numpy as np
+from fastapi import HTTPException
+
+#metric name -> path inside features_statistics.gene_category_stats.<category>
+GENE_METRIC_PATHS = {
+    'total_count': 'total_count',
+    'average_mean_length': 'length_stats.mean',
+}
+#metric name -> path inside features_statistics.transcript_type_stats.<type>
+TRANSCRIPT_METRIC_PATHS = {
+    'total_count': 'total_count',
+    'average_mean_length': 'length_stats.mean',
+    'associated_genes_total_count': 'associated_genes.total_count',
+    'exon_total_count': 'exon_stats.total_count',
+    'exon_average_length': 'exon_stats.length.mean',
+    'exon_average_concatenated_length': 'exon_stats.concatenated_length.mean',
+    'cds_total_count': 'cds_stats.total_count',
+    'cds_average_length': 'cds_stats.length.mean',
+    'cds_average_concatenated_length': 'cds_stats.concatenated_length.mean',
+}
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+MAX_BINS = 1000
+
+class MetricColumns:
+    """
+    One float64 array per (gene|transcript, category or type, metric), indexed by the filter engine ordinals, NaN when missing
+    """
+    def __init__(self, annotation_ids: list[str]):
+        self.size = len(annotation_ids)
+        self.columns: dict[tuple[str, str, str], np.ndarray] = {}
+        #rank of each ordinal in annotation_id order, the values are returned sorted by annotation_id
+        self.id_rank = np.argsort(np.argsort(np.array(annotation_ids, dtype=object))) if annotation_ids else np.array([], dtype=np.int64)
+
+    def set(self, key: tuple[str, str, str], ordinal: int, value):
+        if value is None:
+            return
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = np.full(self.size, np.nan)
+        column[ordinal] = value
+
+    def mask(self, matches) -> np.ndarray:
+        """
+        Boolean mask of the ordinals of a filter engine bitmap
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        mask[np.frombuffer(matches.to_array(), dtype=np.uint32)] = True
+        return mask
+
+    def values(self, key: tuple[str, str, str], mask: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        Return the ordinals (in annotation_id order) and the values of the masked annotations having the metric,
+        None if no annotation has it
+        """
+        column = self.columns.get(key)
+        if column is None:
+            return None
+        ordinals = np.flatnonzero(mask & ~np.isnan(column))
+        if not ordinals.size:
+            return None
+        ordinals = ordinals[np.argsort(self.id_rank[ordinals], kind='stable')]
+        return ordinals, column[ordinals]
+
+def coerce_bins(bins) -> int | None:
+    if bins in (None, ''):
+        return None
+    try:
+        bins = int(bins)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail=f"Invalid numeric parameter 'bins': {bins}")
+    if bins < 1 or bins > MAX_BINS:
+        raise HTTPException(status_code=400, detail=f"Parameter 'bins' must be between 1 and {MAX_BINS}")
+    return bins
+
+def to_number(value: float):
+    #counts are returned as int, as stored in mongo
+    return int(value) if float(value).is_integer() else float(value)
+
+def summarize(values: np.ndarray | list, bins: int) -> dict:
+    """
+    Histogram (bins equal-width bins between min and max), quantiles and mean of the values
+    """
+    values = np.asarray(values, dtype=float)
+    if not values.size:
+        return {'count': 0, 'mean': None, 'min': None, 'max': None, 'quantiles': {}, 'histogram': {'edges': [], 'counts': []}}
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        'count': int(values.size),
+        'mean': float(values.mean()),
+        'min': to_number(values.min()),
+        'max': to_number(values.max()),
+        'quantiles': {str(q): float(value) for q, value in zip(QUANTILES, np.quantile(values, QUANTILES))},
+        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()},
+    }
+
+def to_list(values) -> list:
+    """
+    Values of a column as a JSON list, integers when every value is integral (the counts)
+    """
+    if isinstance(values, list):
+        return values
+    if values.size and np.all(np.mod(values, 1) == 0):
+        return values.astype(np.int64).tolist()
+    return values.tolist()
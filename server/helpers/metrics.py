@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from pymongo import monitoring
+from helpers import request_context
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGES_BUCKETS = (1, 2, 3, 5, 8, 13, 21)
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_MS', '1000')) / 1000
+SLOW_REQUESTS_KEPT = 200
+
+logger = logging.getLogger('annotrieve.slow_requests')
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram with labels, kept in memory for this process
+    """
+    def __init__(self, name: str, description: str, labels: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series: dict[tuple, dict] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][idx] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = format_labels(self.labels, key)
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{format_labels(self.labels + ("le",), key + (str(bound),))} {count}')
+                lines.append(f'{self.name}_bucket{format_labels(self.labels + ("le",), key + ("+Inf",))} {series["count"]}')
+                lines.append(f"{self.name}_sum{labels} {series['sum']}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Latency of the requests until the response headers are sent', ('method', 'route', 'status'), LATENCY_BUCKETS)
+MONGO_COMMAND_DURATION = Histogram('mongo_command_duration_seconds', 'Duration of the MongoDB commands', ('command', 'collection', 'route'), LATENCY_BUCKETS)
+MONGO_AGGREGATE_STAGES = Histogram('mongo_aggregate_stages', 'Number of stages of the aggregation pipelines', ('collection', 'route'), STAGES_BUCKETS)
+MONGO_DOCUMENTS_RETURNED = Counter('mongo_documents_returned_total', 'Documents returned by find, aggregate and getMore', ('collection', 'route'))
+MONGO_COMMAND_FAILURES = Counter('mongo_command_failures_total', 'Failed MongoDB commands', ('command', 'route'))
+PYSAM_BYTES = Counter('pysam_bytes_decompressed_total', 'Bytes of GFF lines decompressed by tabix fetches', ('route',))
+SLOW_REQUESTS = Counter('http_slow_requests_total', f'Requests slower than {SLOW_REQUEST_SECONDS}s', ('method', 'route'))
+
+REGISTRY = [REQUEST_DURATION, SLOW_REQUESTS, MONGO_COMMAND_DURATION, MONGO_AGGREGATE_STAGES, MONGO_DOCUMENTS_RETURNED, MONGO_COMMAND_FAILURES, PYSAM_BYTES]
+
+slow_requests = deque(maxlen=SLOW_REQUESTS_KEPT)
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def get_route() -> str:
+    state = request_context.get_state()
+    if not state:
+        return 'none'
+    scope = state['scope']
+    route = scope.get('route')
+    return getattr(route, 'path', None) or 'unmatched'
+
+def normalize_params(query_params) -> dict:
+    """
+    Normalize the filter params of a request: sorted keys, comma separated values split and sorted
+    """
+    params = {}
+    for key in sorted(set(query_params.keys())):
+        values = []
+        for value in query_params.getlist(key):
+            values.extend(item.strip() for item in value.split(','))
+        params[key] = sorted(values) if len(values) > 1 else values[0] if values else ''
+    return params
+
+def observe_request(request, status_code: int, duration: float):
+    """
+    Record the latency of a request, requests slower than SLOW_REQUEST_MS are logged with their normalized params and mongo usage
+    """
+    route = get_route()
+    REQUEST_DURATION.observe(duration, method=request.method, route=route, status=status_code)
+    if duration < SLOW_REQUEST_SECONDS:
+        return
+    SLOW_REQUESTS.inc(method=request.method, route=route)
+    state = request_context.get_state() or {}
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'method': request.method,
+        'route': route,
+        'status': status_code,
+        'duration_ms': round(duration * 1000, 1),
+        'params': normalize_params(request.query_params),
+        'mongo_commands': state.get('mongo_commands', 0),
+        'mongo_time_ms': round(state.get('mongo_time', 0) * 1000, 1),
+        'mongo_documents_returned': state.get('mongo_documents_returned', 0),
+        'aggregate_stages': state.get('aggregate_stages', 0),
+    }
+    slow_requests.append(entry)
+    logger.warning(json.dumps(entry))
+
+def observe_pysam_bytes(byte_count: int):
+    PYSAM_BYTES.inc(byte_count, route=get_route())
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Time the MongoDB commands and attribute them to the request being served
+    """
+    TRACKED_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'getMore', 'insert', 'update', 'delete', 'findAndModify'}
+
+    def __init__(self):
+        self.pending: dict[int, tuple[str, str, str]] = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name not in self.TRACKED_COMMANDS:
+            return
+        command = event.command
+        collection = command.get(event.command_name) if event.command_name != 'getMore' else command.get('collection')
+        collection = collection if isinstance(collection, str) else ''
+        route = get_route()
+        with self.lock:
+            self.pending[event.request_id] = (event.command_name, collection, route)
+        if event.command_name == 'aggregate':
+            stages = len(command.get('pipeline', []))
+            MONGO_AGGREGATE_STAGES.observe(stages, collection=collection, route=route)
+            state = request_context.get_state()
+            if state is not None:
+                state['aggregate_stages'] = state.get('aggregate_stages', 0) + stages
+
+    def succeeded(self, event):
+        with self.lock:
+            pending = self.pending.pop(event.request_id, None)
+        if not pending:
+            return
+        command_name, collection, route = pending
+        duration = event.duration_micros / 1_000_000
+        MONGO_COMMAND_DURATION.observe(duration, command=command_name, collection=collection, route=route)
+        returned = 0
+        cursor = event.reply.get('cursor') if isinstance(event.reply, dict) else None
+        if cursor:
+            returned = len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+            MONGO_DOCUMENTS_RETURNED.inc(returned, collection=collection, route=route)
+        state = request_context.get_state()
+        if state is not None:
+            state['mongo_commands'] = state.get('mongo_commands', 0) + 1
+            state['mongo_time'] = state.get('mongo_time', 0) + duration
+            state['mongo_documents_returned'] = state.get('mongo_documents_returned', 0) + returned
+
+    def failed(self, event):
+        with self.lock:
+            pending = self.pending.pop(event.request_id, None)
+        if pending:
+            MONGO_COMMAND_FAILURES.inc(command=pending[0], route=pending[2])
@@ -1,25 +1,32 @@
 import pysam
+from helpers import metrics as metrics_helper
 
 
 def stream_gff_file(file_path:str, index_format:str="csi", seqid:str=None, start:int=None, end:int=None, feature_type:str | None=None, feature_source:str | None=None, biotype:str | None=None):
     has_filters = feature_type or feature_source or biotype
-    if has_filters:
-        with pysam.TabixFile(file_path, index=f"{file_path}.{index_format}") as file:
-            for line in file.fetch(seqid, start, end):
-                fields = line.split("\t", 8)
-                if feature_type and fields[2] != feature_type:
-                    continue
-                if feature_source and fields[1] != feature_source:
-                    continue
-                if biotype:
-                    attributes = {k: v for k, v in (item.split('=') for item in fields[8].split(';') if '=' in item)}
-                    if biotype not in attributes.values():
+    decompressed_bytes = 0
+    try:
+        if has_filters:
+            with pysam.TabixFile(file_path, index=f"{file_path}.{index_format}") as file:
+                for line in file.fetch(seqid, start, end):
+                    decompressed_bytes += len(line) + 1
+                    fields = line.split("\t", 8)
+                    if feature_type and fields[2] != feature_type:
                         continue
-                yield line + '\n'
-    else:
-        with pysam.TabixFile(file_path, index=f"{file_path}.{index_format}") as file:
-            for line in file.fetch(seqid, start, end):
-                yield line + '\n'
+                    if feature_source and fields[1] != feature_source:
+                        continue
+                    if biotype:
+                        attributes = {k: v for k, v in (item.split('=') for item in fields[8].split(';') if '=' in item)}
+                        if biotype not in attributes.values():
+                            continue
+                    yield line + '\n'
+        else:
+            with pysam.TabixFile(file_path, index=f"{file_path}.{index_format}") as file:
+                for line in file.fetch(seqid, start, end):
+                    decompressed_bytes += len(line) + 1
+                    yield line + '\n'
+    finally:
+        metrics_helper.observe_pysam_bytes(decompressed_bytes)
 
 def stream_contigs(file_path:str, index_format:str="csi"):
     with pysam.TabixFile(file_path, index=f"{file_path}.{index_format}") as file:
@@ -0,0 +1,115 @@
+import os
+import json
+import queue
+import random
+import hashlib
+import threading
+from bson import json_util
+from db.database import get_redis_client
+from helpers import request_context
+
+SHAPES_KEY = 'annotrieve:query_shapes'
+SHAPES_COUNT_KEY = 'annotrieve:query_shapes:count'
+SAMPLE_RATE = float(os.getenv('QUERY_SHAPES_SAMPLE_RATE', '0.1'))
+QUEUE_SIZE = 1000 #shapes waiting to be written, the new ones are dropped when redis lags behind
+
+#the shapes are written to redis by a background thread, the requests only push them to the queue
+_pending: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+_writer: threading.Thread | None = None
+_writer_lock = threading.Lock()
+
+def normalize(value):
+    """
+    Replace the values of a mongo filter with placeholders, keeping the field names and operators
+    """
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        #$and/$or branches are kept, lists of values collapse to a single placeholder
+        if value and all(isinstance(item, dict) for item in value):
+            return [normalize(item) for item in value]
+        return ['?']
+    if isinstance(value, bool):
+        return value #$exists: True/False changes the index that can be used
+    return '?'
+
+def replay_filter(value, key: str | None = None):
+    """
+    Turn a normalized filter back into a query that explain() can run, the placeholders becoming dummy values of the same kind
+    """
+    if isinstance(value, dict):
+        return {item_key: replay_filter(item, item_key) for item_key, item in value.items()}
+    if isinstance(value, list):
+        return [replay_filter(item) if isinstance(item, dict) else item for item in value]
+    if value != '?':
+        return value
+    if key == '$regex':
+        return '^' #anchored, the index bounds stay the same as for a prefix search
+    if key == '$options':
+        return ''
+    if key == '$size':
+        return 0
+    return value
+
+def write_shapes():
+    while True:
+        key, shape = _pending.get()
+        try:
+            client = get_redis_client()
+            client.hset(SHAPES_KEY, key, json.dumps(shape))
+            client.hincrby(SHAPES_COUNT_KEY, key, 1)
+        except Exception as e:
+            print(f"Error recording query shape: {e}")
+
+def start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=write_shapes, name='query-shapes-writer', daemon=True)
+            _writer.start()
+
+def record_query(queryset):
+    """
+    Record a sample of the filter and sort of a queryset with the endpoint serving it, replayed by the index advisor.
+    Only the normalized shape is kept (no value sent by the client), a shape is recorded once per request
+    and a failure here never affects the request
+    """
+    state = request_context.get_state()
+    if state is None or random.random() >= SAMPLE_RATE:
+        return
+    try:
+        sort = [list(item) for item in (queryset._ordering or [])]
+        shape = {
+            'endpoint': request_context.get_endpoint(),
+            'collection': queryset._document._get_collection_name(),
+            'filter': normalize(queryset._query),
+            'sort': sort,
+        }
+        key = hashlib.sha1(json.dumps(shape, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        recorded = state.setdefault('recorded_shapes', set())
+        if key in recorded:
+            return
+        recorded.add(key)
+        start_writer()
+        _pending.put_nowait((key, shape))
+    except queue.Full:
+        pass
+    except Exception as e:
+        print(f"Error recording query shape: {e}")
+
+def get_recorded_shapes() -> list[dict]:
+    """
+    Return the recorded shapes with their number of occurrences, most frequent first
+    """
+    client = get_redis_client()
+    counts = client.hgetall(SHAPES_COUNT_KEY)
+    shapes = []
+    for key, value in client.hgetall(SHAPES_KEY).items():
+        shape = json_util.loads(value)
+        shape['key'] = key
+        shape['count'] = int(counts.get(key, 0))
+        shapes.append(shape)
+    return sorted(shapes, key=lambda shape: shape['count'], reverse=True)
+
+def clear_recorded_shapes():
+    get_redis_client().delete(SHAPES_KEY, SHAPES_COUNT_KEY)
@@ -1,6 +1,7 @@
 from mongoengine.queryset.visitor import Q
 from fastapi import HTTPException
 from mongoengine.queryset import QuerySet
+from helpers import query_shapes
 
 NO_VALUE_KEY = "no_value"
 
@@ -61,50 +62,81 @@ ALLOWED_FIELDS_MAP_ASSEMBLY = {
     'assembly_type':'assembly_type',
     'bioprojects':'bioprojects',
 }
-def get_frequencies(items:QuerySet, field:str, type:str = 'annotation'):
+def get_allowed_fields_map(type: str) -> dict:
     if type == 'annotation':
-        allowed_fields_map = ALLOWED_FIELDS_MAP
-    elif type == 'assembly':
-        allowed_fields_map = ALLOWED_FIELDS_MAP_ASSEMBLY
-    else:
-        raise HTTPException(status_code=400, detail=f"Type parameter is required and must be one of: annotation, assembly")
-    if not field or field not in allowed_fields_map:
-        raise HTTPException(status_code=400, detail=f"Field parameter is required and must be one of: {', '.join(allowed_fields_map.keys())}")
-    field = allowed_fields_map[field]
-    try:
+        return ALLOWED_FIELDS_MAP
+    if type == 'assembly':
+        return ALLOWED_FIELDS_MAP_ASSEMBLY
+    raise HTTPException(status_code=400, detail=f"Type parameter is required and must be one of: annotation, assembly")
 
-            # Original pipeline for regular fields
-        pipeline = [
-            {
-                "$project": {
-                    "field_value": {
-                        "$ifNull": [f"${field}", f"{NO_VALUE_KEY}"]
-                    },
-                    "annotation_id": "$_id"  # Keep track of unique annotations
-                }
-            },
-            {"$unwind": "$field_value"},
-            {
-                "$group": {
-                    "_id": "$field_value",
-                    "count": {"$addToSet": "$annotation_id"}  # Count unique annotations
-                }
-            },
-            {
-                "$project": {
-                    "_id": 1,
-                    "count": {"$size": "$count"}  # Get the size of unique annotation IDs
+def frequencies_pipeline(field_path: str, top_k: int | None = None) -> list[dict]:
+    """
+    Count the documents per value of a field.
+    Array values are deduplicated per document ($setUnion) before the $unwind, so each document counts once per value
+    with a $sum instead of collecting the ids of every document in the group.
+    Missing values are counted as NO_VALUE_KEY, sorted by count desc (then value) and cut to the top_k values
+    """
+    pipeline = [
+        {
+            "$project": {
+                "_id": 0,
+                "field_value": {
+                    "$let": {
+                        "vars": {"value": {"$ifNull": [f"${field_path}", NO_VALUE_KEY]}},
+                        "in": {"$cond": [{"$isArray": "$$value"}, {"$setUnion": ["$$value", []]}, ["$$value"]]}
+                    }
                 }
             }
-        ]
+        },
+        {"$unwind": "$field_value"},
+        {"$group": {"_id": "$field_value", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+    ]
+    if top_k:
+        pipeline.append({"$limit": top_k})
+    return pipeline
 
-        response = {
-            str(doc["_id"]): int(doc["count"])
-            for doc in sorted(items.aggregate(pipeline), key=lambda x: x["count"], reverse=True)
+def get_frequencies_many(items:QuerySet, fields:list[str], type:str = 'annotation', top_k:int | None = None, field_filters:dict[str, dict] | None = None) -> dict[str, dict[str, int]]:
+    """
+    Return the frequencies of several fields of the queryset, computed by a single aggregation with one $facet branch per field.
+    field_filters are extra mongo filters applied only to the branch of a field
+    """
+    allowed_fields_map = get_allowed_fields_map(type)
+    invalid_fields = [field for field in fields if field not in allowed_fields_map]
+    if not fields or invalid_fields:
+        raise HTTPException(status_code=400, detail=f"Field parameter is required and must be one of: {', '.join(allowed_fields_map.keys())}")
+    top_k = coerce_top_k(top_k)
+    query_shapes.record_query(items)
+    try:
+        facets = {}
+        for field in fields:
+            field_filter = (field_filters or {}).get(field)
+            facets[field] = ([{"$match": field_filter}] if field_filter else []) + frequencies_pipeline(allowed_fields_map[field], top_k)
+        if len(facets) == 1:
+            results = {fields[0]: list(items.aggregate(facets[fields[0]]))}
+        else:
+            results = next(items.aggregate([{"$facet": facets}]), {})
+        #the pipelines sort by count, the dicts keep the order
+        return {
+            field: {str(doc["_id"]): int(doc["count"]) for doc in results.get(field, [])}
+            for field in fields
         }
-
-        sorted_response = {key: value for key, value in sorted(response.items(), key=lambda item: item[1], reverse=True)} #sort desc by value
-        return sorted_response
-
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching stats: {e}")
+
+def get_frequencies(items:QuerySet, field:str, type:str = 'annotation', top_k:int | None = None):
+    allowed_fields_map = get_allowed_fields_map(type)
+    if not field or field not in allowed_fields_map:
+        raise HTTPException(status_code=400, detail=f"Field parameter is required and must be one of: {', '.join(allowed_fields_map.keys())}")
+    return get_frequencies_many(items, [field], type, top_k)[field]
+
+def coerce_top_k(top_k) -> int | None:
+    if top_k in (None, ''):
+        return None
+    try:
+        top_k = int(top_k)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail=f"Invalid numeric parameter 'top_k': {top_k}")
+    if top_k < 0:
+        raise HTTPException(status_code=400, detail="Parameter 'top_k' must be positive")
+    return top_k or None
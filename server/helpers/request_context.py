@@ -0,0 +1,28 @@
+from contextvars import ContextVar
+
+#state of the request being served, set by the middleware in main.py
+_request_state: ContextVar[dict | None] = ContextVar('request_state', default=None)
+
+def start_request(scope: dict):
+    """
+    Bind a new request state to the current context, return the token to reset it
+    """
+    return _request_state.set({'scope': scope})
+
+def end_request(token):
+    _request_state.reset(token)
+
+def get_state() -> dict | None:
+    return _request_state.get()
+
+def get_endpoint() -> str | None:
+    """
+    Return the method and route template of the current request (e.g. 'GET /annotations/{md5_checksum}'), None outside a request
+    """
+    state = get_state()
+    if not state:
+        return None
+    scope = state['scope']
+    route = scope.get('route')
+    path = getattr(route, 'path', None) or scope.get('path')
+    return f"{scope.get('method')} {path}"
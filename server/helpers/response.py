@@ -1,24 +1,88 @@
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from helpers import file as file_helper, tar as tar_helper
 from fastapi import HTTPException
 import json
+import orjson
+import numpy as np
+from bson import ObjectId, Decimal128
+from helpers import query_shapes
 
-def json_response_with_pagination(items, count, offset, limit):
-    """Format response as JSON with pagination."""
+#float64 values then uint32 indices of the annotation ids and of the missing annotations, all little-endian
+PACKED_MEDIA_TYPE = 'application/octet-stream'
+
+def bson_default(value):
+    """
+    BSON types orjson does not know (datetimes are encoded natively)
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def json_bytes(content) -> bytes:
+    return orjson.dumps(content, default=bson_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+class MongoJSONResponse(Response):
+    """
+    JSON response of raw pymongo documents, encoded straight to bytes by orjson instead of FastAPI's jsonable_encoder + json.dumps
+    """
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return json_bytes(content)
+
+def document_response(document: dict | None, not_found_detail: str):
+    """
+    Return a raw document (e.g. from find_one) without building the MongoEngine document, 404 if missing
+    """
+    if not document:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return MongoJSONResponse(document)
+
+def coerce_pagination(offset, limit) -> tuple[int, int]:
     #force offset and limit to be int
     try:
-        offset = int(offset)
-        limit = int(limit)
+        return int(offset), int(limit)
     except:
-        offset = 0
-        limit = 20
+        return 0, 20
+
+def json_response_with_pagination(items, count, offset, limit):
+    """Format response as JSON with pagination."""
+    offset, limit = coerce_pagination(offset, limit)
+    query_shapes.record_query(items)
     paginated_items = items.skip(offset).limit(limit).exclude('id').as_pymongo()
-    return {
+    return MongoJSONResponse({
         'total': count,
         'offset': offset,
         'limit': limit,
         'results': list(paginated_items)
-    }
+    })
+
+def accepts_packed(accept: str | None) -> bool:
+    return bool(accept) and PACKED_MEDIA_TYPE in accept
+
+def packed_values_response(values, annotation_indices: list[int] | None, missing_indices: list[int], id_dictionary_etag: str | None, headers: dict | None = None):
+    """
+    Pack the values of a metric as little-endian float64, followed by the uint32 indices (in the id dictionary of /annotations/ids)
+    of their annotations when requested and of the annotations missing the metric. The counts are sent in the headers
+    """
+    values = np.asarray(values, dtype='<f8')
+    parts = [values.tobytes()]
+    if annotation_indices is not None:
+        parts.append(np.asarray(annotation_indices, dtype='<u4').tobytes())
+    parts.append(np.asarray(missing_indices, dtype='<u4').tobytes())
+    return Response(
+        content=b''.join(parts),
+        media_type=PACKED_MEDIA_TYPE,
+        headers={
+            **(headers or {}),
+            'X-Values-Count': str(values.size),
+            'X-Annotation-Indices-Count': str(len(annotation_indices) if annotation_indices is not None else 0),
+            'X-Missing-Count': str(len(missing_indices)),
+            'X-Id-Dictionary-ETag': id_dictionary_etag or '',
+        },
+    )
 
 def get_gb_size(items):
     return round(items.sum('indexed_file_info.file_size') / 1024 / 1024 / 1024, 2)
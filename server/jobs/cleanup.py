@@ -0,0 +1,129 @@
+import os
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from celery import shared_task
+from db.models import GenomeAnnotation, AnnotationSequenceMap, ImportJob, ImportJobAnnotation
+from .services import import_job as import_job_service
+from helpers import file as file_helper
+from .services.utils import create_batches
+from celery_app import task_lock
+from helpers import data_generation
+
+ANNOTATIONS_PATH = os.getenv('LOCAL_ANNOTATIONS_DIR')
+ANNOTATION_FILE_SUFFIXES = ('.gff.gz', '.gff.gz.csi')
+#files and sequence maps younger than this may belong to an import still in progress (written before the annotation is saved)
+MIN_ORPHAN_AGE_SECONDS = 24 * 3600
+REPORT_SAMPLE_SIZE = 100
+
+@shared_task(name='collect_garbage', ignore_result=False)
+@task_lock.singleton('collect_garbage')
+def collect_garbage(dry_run: bool = True, batch_size: int = 1000):
+    """
+    Remove the annotation files and the sequence maps not referenced by any annotation.
+    With dry_run the orphans are only reported
+    """
+    if not ANNOTATIONS_PATH:
+        print("LOCAL_ANNOTATIONS_DIR environment variable is not set")
+        return None
+    if task_lock.get_lock_info('import_annotations'):
+        #files of a running import are written before their annotation is saved
+        print("Import annotations task is running, skipping garbage collection")
+        return None
+    known_paths = get_known_file_paths()
+    print(f"Found {len(known_paths)} files referenced by the annotations")
+
+    orphan_files, orphan_bytes, scanned_files = find_orphan_files(known_paths)
+    print(f"Scanned {scanned_files} files, found {len(orphan_files)} orphan files ({orphan_bytes} bytes)")
+
+    #the import may start while the garbage is collected, the sequence maps are guarded by their age as the files
+    min_sequence_map_id = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=MIN_ORPHAN_AGE_SECONDS))
+    orphan_annotation_ids = find_orphan_sequence_map_ids(min_sequence_map_id)
+    print(f"Found sequence maps of {len(orphan_annotation_ids)} missing annotations")
+
+    deleted_files = []
+    deleted_sequence_maps = 0
+    if not dry_run:
+        deleted_files = file_helper.remove_files(orphan_files, ANNOTATIONS_PATH)
+        for batch in create_batches(orphan_annotation_ids, batch_size):
+            deleted_sequence_maps += AnnotationSequenceMap.objects(annotation_id__in=batch, id__lt=min_sequence_map_id).delete()
+        print(f"Deleted {len(deleted_files)} orphan files and {deleted_sequence_maps} orphan sequence maps")
+        if deleted_files or deleted_sequence_maps:
+            data_generation.bump_generation('collect_garbage')
+
+    return {
+        'dry_run': dry_run,
+        'scanned_files': scanned_files,
+        'orphan_files': len(orphan_files),
+        'orphan_bytes': orphan_bytes,
+        'orphan_files_sample': [os.path.relpath(f, ANNOTATIONS_PATH) for f in orphan_files[:REPORT_SAMPLE_SIZE]],
+        'orphan_sequence_map_annotations': len(orphan_annotation_ids),
+        'orphan_sequence_map_annotations_sample': orphan_annotation_ids[:REPORT_SAMPLE_SIZE],
+        'deleted_files': len(deleted_files),
+        'deleted_sequence_maps': deleted_sequence_maps,
+    }
+
+def get_known_file_paths() -> set[str]:
+    """
+    Return the full paths of the bgzipped and csi files referenced by the annotations
+    """
+    known_paths = set()
+    indexed_files = GenomeAnnotation.objects().only('indexed_file_info.bgzipped_path', 'indexed_file_info.csi_path').as_pymongo()
+    for annotation in indexed_files:
+        indexed_file_info = annotation.get('indexed_file_info') or {}
+        for relative_path in [indexed_file_info.get('bgzipped_path'), indexed_file_info.get('csi_path')]:
+            if relative_path:
+                known_paths.add(os.path.normpath(file_helper.get_file_path(relative_path)))
+    return known_paths
+
+def find_orphan_files(known_paths: set[str]) -> tuple[list[str], int, int]:
+    """
+    Walk the annotations dir and return the annotation files not in known_paths,
+    their total size and the number of scanned files
+    """
+    orphan_files = []
+    orphan_bytes = 0
+    scanned_files = 0
+    min_mtime = time.time() - MIN_ORPHAN_AGE_SECONDS
+    for entry in file_helper.iter_files(ANNOTATIONS_PATH):
+        if not entry.name.endswith(ANNOTATION_FILE_SUFFIXES):
+            continue
+        scanned_files += 1
+        if os.path.normpath(entry.path) in known_paths:
+            continue
+        stat = entry.stat(follow_symlinks=False)
+        if stat.st_mtime > min_mtime:
+            continue
+        orphan_files.append(entry.path)
+        orphan_bytes += stat.st_size
+    return orphan_files, orphan_bytes, scanned_files
+
+def get_importing_annotation_ids() -> set[str]:
+    """
+    Return the annotation ids indexed by an unfinished import job but not saved yet, their sequence maps are written before the annotation
+    """
+    job_ids = [str(job_id) for job_id in ImportJob.objects(status='running').scalar('id')]
+    if not job_ids:
+        return set()
+    states = ImportJobAnnotation.objects(job_id__in=job_ids, stage__nin=list(import_job_service.FINAL_STAGES), annotation_id__ne=None)
+    return set(states.scalar('annotation_id'))
+
+def find_orphan_sequence_map_ids(min_sequence_map_id: ObjectId) -> list[str]:
+    """
+    Return the annotation ids of the sequence maps older than min_sequence_map_id (the ObjectId holds the creation time)
+    whose annotation does not exist anymore and is not being imported
+    """
+    importing_ids = get_importing_annotation_ids()
+    pipeline = [
+        {"$match": {"_id": {"$lt": min_sequence_map_id}}},
+        {"$group": {"_id": "$annotation_id"}},
+        {"$lookup": {
+            "from": GenomeAnnotation._get_collection_name(),
+            "localField": "_id",
+            "foreignField": "annotation_id",
+            "as": "annotation",
+        }},
+        {"$match": {"annotation": {"$size": 0}}},
+        {"$project": {"_id": 1}},
+    ]
+    return [doc['_id'] for doc in AnnotationSequenceMap.objects.aggregate(pipeline, allowDiskUse=True) if doc['_id'] not in importing_ids]
@@ -11,8 +11,12 @@ from .services import taxonomy as taxonomy_service
 from .services import stats as stats_service
 from .services import feature_summary as feature_summary_service
 from .services import feature_stats as feature_stats_service
-from db.models import GenomeAnnotation, GenomeAssembly
+from .services import import_job as import_job_service
+from .services import metric_catalogue as metric_catalogue_service
+from db.models import GenomeAnnotation, ImportJob
 from .services.utils import create_batches
+from celery_app import task_lock
+from helpers import data_generation
 
 TMP_DIR = "/tmp"
 ANNOTATIONS_PATH = os.getenv('LOCAL_ANNOTATIONS_DIR')
@@ -26,29 +30,40 @@ DEV= os.getenv('DEV')
 BATCH_SIZE = 10
 
 @shared_task(name='import_annotations', ignore_result=False)
+@task_lock.singleton('import_annotations')
 def import_annotations():
     """
     Orchestrate the import job: fetch → filter → enrich → process → persist → stats → cleanup.
+    The progress of each annotation is persisted in an ImportJob, an interrupted run is resumed by the next one.
     """
     os.makedirs(TMP_DIR, exist_ok=True)
 
     print("Starting import annotations job...")
+    job = import_job_service.get_or_create_job()
     # fetch annotations and deduplicate by md5 checksum and url path (exact match)
+    # the stored (url_path, md5) pairs are loaded once and every TSV is checked against them in memory
+    existing_sources = annotation_service.load_existing_source_files()
+    fetched_url_paths = set()
     new_annotations = []
     for url in URLS_TO_FETCH:
         fetched_annotations = annotation_service.fetch_from_url(url)
+        fetched_url_paths.update(annotation.access_url for annotation in fetched_annotations)
         #here we filter those incoming annotations 
         # that are already in the database by md5 checksum and url path 
         # exact match (perfect match) of the source file
         # we will handle later those which url exists but the md5 checksum is different
-        filtered_annotations = annotation_service.filter_annotations_by_md5_checksum_and_url_path(fetched_annotations)
-        new_annotations.extend(filtered_annotations)
+        added, changed = annotation_service.detect_changes(fetched_annotations, existing_sources)
+        print(f"{url}: {len(added)} new and {len(changed)} changed annotations")
+        new_annotations.extend(added + changed)
+    removed_url_paths = annotation_service.get_removed_url_paths(existing_sources, fetched_url_paths)
+    if removed_url_paths:
+        print(f"{len(removed_url_paths)} stored annotations are no longer listed in the source TSVs")
     
     if DEV:
         new_annotations = random.sample(new_annotations, 10)
     print(f"Found {len(new_annotations)} new annotations to process")
     # LINEAGE HANDLING STEP
-    valid_lineages = taxonomy_service.handle_taxonomy(new_annotations, TMP_DIR) #lineages saved in the database, return a dict of taxid:lineage
+    valid_lineages = taxonomy_service.handle_taxonomy(new_annotations) #lineages saved in the database, return a dict of taxid:lineage
     new_annotations_to_process = annotation_service.filter_annotations_dict_by_field(
         new_annotations, 'taxon_id', list(valid_lineages.keys())
     )
@@ -56,6 +71,7 @@ def import_annotations():
 
     if not new_annotations_to_process:
         print("No new annotations to process after filtering by lineage, exiting...")
+        finish_import(job, changed=bool(new_annotations))
         return
     
     # ASSEMBLY HANDLING STEP (here we also hanlde bioprojects)
@@ -65,72 +81,117 @@ def import_annotations():
     )
     if not new_annotations_to_process:
         print("No new annotations to process after filtering by assembly, exiting...")
+        finish_import(job, changed=True)
         return
 
+    # CHECKPOINT STEP: skip the annotations already saved or failed in this job
+    states = import_job_service.register_annotations(job, new_annotations_to_process)
+    new_annotations_to_process = [
+        annotation for annotation in new_annotations_to_process
+        if states.get((annotation.access_url, annotation.md5_checksum), {}).get('stage') not in import_job_service.FINAL_STAGES
+    ]
     print(f"Found {len(new_annotations_to_process)} new annotations to process")
     
-    existing_annotation_md5s = GenomeAnnotation.objects().scalar('annotation_id') #the annotation id is the md5 of the uncompressed sorted file
+    existing_annotation_md5s = set(GenomeAnnotation.objects().scalar('annotation_id')) #the annotation id is the md5 of the uncompressed sorted file
     saved_annotations_ids: list[str] = []
+    #the singleton lock already keeps a single import running, the batches need no per-annotation lease
     for annotations in create_batches(new_annotations_to_process, BATCH_SIZE):
-        processed_annotations = process_annotations_pipeline(annotations, valid_lineages, existing_annotation_md5s)
-        saved_annotations_ids.extend(
-            annotation_service.save_annotations(processed_annotations, ANNOTATIONS_PATH)
-            )    
+        processed_annotations, errors = process_annotations_pipeline(annotations, valid_lineages, existing_annotation_md5s, job, states)
+        batch_saved_ids, failed = annotation_service.save_annotations(processed_annotations, ANNOTATIONS_PATH)
+        mark_saved_annotations(job, annotations, batch_saved_ids, failed, errors)
+        saved_annotations_ids.extend(batch_saved_ids)
+        if batch_saved_ids:
+            #the saved annotations are served right away, a run interrupted later must not leave the old ETags valid
+            data_generation.bump_generation('import_annotations')
+    print(f"Saved {len(saved_annotations_ids)} annotations" if saved_annotations_ids else "No annotations saved")
+    finish_import(job, changed=bool(new_annotations))
+    print("Import annotations job successfully finished")
+
+def finish_import(job: ImportJob, changed: bool):
+    """
+    Update the stats of every annotation saved by the job, including those saved by an interrupted run before it was resumed,
+    then clean up the empty models and close the job.
+    The data generation is bumped if the run wrote anything: taxons, organisms and assemblies are saved
+    and annotation errors stored even when no annotation is, and the empty models are deleted
+    """
+    saved_annotations_ids = import_job_service.get_saved_annotation_ids(job)
     if saved_annotations_ids:
-        print(f"Saved {len(saved_annotations_ids)} annotations")
+        print(f"Updating the stats of {len(saved_annotations_ids)} annotations saved by the job")
         stats_service.update_db_stats(saved_annotations_ids)
-    else:
-        print("No annotations saved")
-    
+        metric_catalogue_service.update_metric_catalogue(saved_annotations_ids)
     print("Cleaning up empty models")
-    stats_service.clean_up_empty_models()
-    print("Import annotations job successfully finished")
+    deleted_models = stats_service.clean_up_empty_models()
+    if changed or saved_annotations_ids or deleted_models:
+        data_generation.bump_generation('import_annotations')
+    import_job_service.finish_job(job)
 
-def process_annotations_pipeline(annotations: list[AnnotationToProcess], valid_lineages: dict[str, list[str]], existing_annotation_md5s: list[str]) -> list[GenomeAnnotation]:
+def process_annotations_pipeline(annotations: list[AnnotationToProcess], valid_lineages: dict[str, list[str]], existing_annotation_md5s: set[str], job: ImportJob, states: dict[tuple[str, str], dict]) -> tuple[list[GenomeAnnotation], list[tuple[AnnotationToProcess, str]]]:
+    """
+    Process the annotation files of a batch, return the parsed annotations and the (annotation, error) tuples of those that failed
+    """
     processed_annotations = []
+    errors = []
+    assembly_fields = assembly_service.get_annotation_assembly_fields({annotation.assembly_accession for annotation in annotations})
     for annotation_to_process in annotations:
         print(f"Processing {annotation_to_process.access_url}:")
         tmp_subdir_path = file_helper.create_dir_path(TMP_DIR, f"{annotation_to_process.md5_checksum}")
         full_bgzipped_path, relative_bgzipped_path = annotation_service.init_annotation_file_paths(ANNOTATIONS_PATH, annotation_to_process)
         full_csi_path = f"{full_bgzipped_path}.csi"
         relative_csi_path = f"{relative_bgzipped_path}.csi"
+        state = states.get((annotation_to_process.access_url, annotation_to_process.md5_checksum), {})
         
+        def on_stage(stage: str, **fields):
+            import_job_service.set_stage(job, annotation_to_process, stage, **fields)
+
         try:
-            md5_checksum, file_size = annotation_service.process_annotation_file(annotation_to_process, tmp_subdir_path, full_bgzipped_path, existing_annotation_md5s)
+            if state.get('stage') in import_job_service.RESUMABLE_STAGES and \
+                    not file_helper.file_is_empty_or_does_not_exist(full_bgzipped_path) and \
+                    not file_helper.file_is_empty_or_does_not_exist(full_csi_path):
+                # the file was sorted and indexed by an interrupted run, reuse it
+                print(f"- Reusing indexed file {full_bgzipped_path}")
+                md5_checksum, file_size = state['annotation_id'], state['file_size']
+            else:
+                md5_checksum, file_size = annotation_service.process_annotation_file(annotation_to_process, tmp_subdir_path, full_bgzipped_path, existing_annotation_md5s, on_stage)
+                on_stage(import_job_service.INDEXED, annotation_id=md5_checksum, file_size=file_size)
             indexed_file_info = annotation_service.init_indexed_file_info(md5_checksum, file_size, relative_bgzipped_path, relative_csi_path)
             feature_summary = feature_summary_service.compute_features_summary(full_bgzipped_path)
             feature_stats = feature_stats_service.compute_features_statistics(full_bgzipped_path)   
+            on_stage(import_job_service.STATS)
             parsed_annotation = annotation_to_process.to_genome_annotation(
                 annotation_id=md5_checksum,
                 taxon_lineage=valid_lineages.get(annotation_to_process.taxon_id, []),
                 indexed_file_info=indexed_file_info,
                 features_summary=feature_summary,
                 features_statistics=feature_stats,
+                stats_version=feature_stats_service.STATS_VERSION,
+                **assembly_fields.get(annotation_to_process.assembly_accession, {}),
             )
             contigs_service.handle_alias_mapping(parsed_annotation, full_bgzipped_path)
-            #TODO: do we need to set bioprojects to the annotations or just the assemblies?
-            #handle_bioprojects(parsed_annotation)
             processed_annotations.append(parsed_annotation)
         except Exception as e:
             str_error = str(e)
             print(f"- Error processing annotation {annotation_to_process.access_url}: {str_error}")
-            annotation_service.handle_annotation_error(annotation_to_process, str_error)
+            errors.append((annotation_to_process, str_error))
+            on_stage(import_job_service.ERROR, error_message=str_error)
             file_helper.remove_file_and_empty_parents(full_bgzipped_path, ANNOTATIONS_PATH)
             file_helper.remove_file_and_empty_parents(full_csi_path, ANNOTATIONS_PATH)
         finally:
             shutil.rmtree(tmp_subdir_path)
 
-    return processed_annotations
+    return processed_annotations, errors
 
-
-def handle_bioprojects(ann_to_save: GenomeAnnotation) -> list[GenomeAnnotation]:
+def mark_saved_annotations(job: ImportJob, annotations: list[AnnotationToProcess], saved_annotations_ids: list[str], failed: dict[str, str], errors: list[tuple[AnnotationToProcess, str]]):
     """
-    Set the bioprojects for the annotations
+    Persist the outcome of a batch: the saved annotations are marked as saved,
+    those that failed while saving are marked as error and all the errors of the batch are stored at once
     """
-    #fetch related assembly
-    assembly = GenomeAssembly.objects(assembly_accession=ann_to_save.assembly_accession).first()
-    if not assembly:
-        return
-    #set bioprojects
-    ann_to_save.bioprojects = assembly.bioprojects
-    return ann_to_save
+    annotations_by_url = {annotation.access_url: annotation for annotation in annotations}
+    failed_annotations = [annotations_by_url[url_path] for url_path in failed if url_path in annotations_by_url]
+    for annotation_to_process in failed_annotations:
+        import_job_service.set_stage(job, annotation_to_process, import_job_service.ERROR, error_message=failed[annotation_to_process.access_url])
+    errors = errors + [(annotation_to_process, failed[annotation_to_process.access_url]) for annotation_to_process in failed_annotations]
+    annotation_service.save_annotation_errors(errors)
+    if saved_annotations_ids:
+        failed_urls = set(failed) | {annotation_to_process.access_url for annotation_to_process, _ in errors}
+        saved_annotations = [annotation for annotation in annotations if annotation.access_url not in failed_urls]
+        import_job_service.set_stages(job, saved_annotations, import_job_service.SAVED)
@@ -0,0 +1,200 @@
+import json
+from datetime import datetime
+from celery import shared_task
+from mongoengine import ListField
+from mongoengine.fields import EmbeddedDocumentField
+from db import models
+from db.database import get_redis_client
+from helpers import query_shapes
+from celery_app import task_lock
+
+REPORT_KEY = 'annotrieve:index_advisor:report'
+EXPLAIN_LIMIT = 20 #the list endpoints paginate, the plan of the first page is the one that matters
+EQUALITY_OPERATORS = {'$eq', '$in', '$all'}
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$regex'}
+
+def get_documents() -> dict[str, type]:
+    """
+    Return the document classes of db.models by collection name
+    """
+    documents = {}
+    for value in vars(models).values():
+        if isinstance(value, type) and issubclass(value, models.Document) and not value._meta.get('abstract'):
+            if value is models.Document or value is models.DynamicDocument:
+                continue
+            documents[value._get_collection_name()] = value
+    return documents
+
+@shared_task(name='advise_indexes', ignore_result=False)
+@task_lock.singleton('advise_indexes')
+def advise_indexes(create: bool = False, min_count: int = 1):
+    """
+    Replay the recorded query shapes with explain(), propose a compound (or partial) index for those
+    not fully served by an index and, with create, build it and explain again.
+    The report (COLLSCAN -> IXSCAN wins per endpoint) is stored in redis and returned
+    """
+    documents = get_documents()
+    report = []
+    created_indexes = set()
+    for shape in query_shapes.get_recorded_shapes():
+        if shape['count'] < min_count or shape['collection'] not in documents:
+            continue
+        document = documents[shape['collection']]
+        collection = document._get_collection()
+        sort = [tuple(item) for item in shape['sort']]
+        entry = {
+            'endpoint': shape['endpoint'],
+            'collection': shape['collection'],
+            'count': shape['count'],
+            'filter': shape['filter'],
+            'sort': shape['sort'],
+        }
+        query = query_shapes.replay_filter(shape['filter'])
+        try:
+            entry['before'] = explain_summary(collection, query, sort)
+            proposal = propose_index(document, query, sort)
+            entry['proposed_index'] = proposal
+            if create and proposal and needs_index(entry['before']):
+                name = proposal['name']
+                if name not in created_indexes:
+                    options = {'name': name, 'background': True}
+                    if proposal.get('partialFilterExpression'):
+                        options['partialFilterExpression'] = proposal['partialFilterExpression']
+                    collection.create_index([tuple(key) for key in proposal['keys']], **options)
+                    created_indexes.add(name)
+                entry['after'] = explain_summary(collection, query, sort)
+        except Exception as e:
+            entry['error'] = str(e)
+        report.append(entry)
+
+    wins = [
+        {'endpoint': entry['endpoint'], 'collection': entry['collection'], 'before': entry['before']['stages'], 'after': entry['after']['stages']}
+        for entry in report
+        if entry.get('after') and 'COLLSCAN' in entry['before']['stages'] and 'COLLSCAN' not in entry['after']['stages']
+    ]
+    result = {
+        'generated_at': datetime.now().isoformat(),
+        'created': create,
+        'shapes': len(report),
+        'created_indexes': sorted(created_indexes),
+        'wins': wins,
+        'entries': report,
+    }
+    get_redis_client().set(REPORT_KEY, json.dumps(result, default=str))
+    print(f"Index advisor: {len(report)} shapes, {len(created_indexes)} indexes created, {len(wins)} COLLSCAN -> IXSCAN wins")
+    return {key: value for key, value in result.items() if key != 'entries'}
+
+def get_report() -> dict | None:
+    value = get_redis_client().get(REPORT_KEY)
+    return json.loads(value) if value else None
+
+def explain_summary(collection, query: dict, sort: list[tuple[str, int]]) -> dict:
+    """
+    Run explain on the query and return the stages of the winning plan and the execution stats
+    """
+    cursor = collection.find(query).limit(EXPLAIN_LIMIT)
+    if sort:
+        cursor = cursor.sort(sort)
+    explain = cursor.explain()
+    winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    stats = explain.get('executionStats', {})
+    return {
+        'stages': get_stages(winning_plan.get('queryPlan', winning_plan)),
+        'index_names': get_index_names(winning_plan.get('queryPlan', winning_plan)),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'returned': stats.get('nReturned'),
+        'time_ms': stats.get('executionTimeMillis'),
+    }
+
+def get_stages(plan: dict) -> list[str]:
+    stages = [plan.get('stage')] if plan.get('stage') else []
+    children = [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', [])
+    for child in children:
+        stages.extend(get_stages(child))
+    return stages
+
+def get_index_names(plan: dict) -> list[str]:
+    names = [plan['indexName']] if 'indexName' in plan else []
+    children = [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', [])
+    for child in children:
+        names.extend(get_index_names(child))
+    return names
+
+def needs_index(summary: dict) -> bool:
+    """
+    A plan needs an index if it scans the collection, sorts in memory or examines many more documents than it returns
+    """
+    if 'COLLSCAN' in summary['stages'] or 'SORT' in summary['stages']:
+        return True
+    docs_examined = summary.get('docs_examined') or 0
+    returned = summary.get('returned') or 0
+    return docs_examined > 10 * max(returned, 1)
+
+def is_array_field(document: type, path: str) -> bool:
+    """
+    Check if any field along a dotted path is a list (multikey), following embedded documents
+    """
+    current = document
+    for part in path.split('.'):
+        field = getattr(current, '_fields', {}).get(part)
+        if field is None:
+            return False
+        if isinstance(field, ListField):
+            return True
+        if isinstance(field, EmbeddedDocumentField):
+            current = field.document_type
+        else:
+            return False
+    return False
+
+def flatten_conditions(query: dict) -> list[tuple[str, object]]:
+    """
+    Return the (field, condition) pairs of the query, the $and branches are flattened and $or/$nor are skipped
+    """
+    conditions = []
+    for key, value in query.items():
+        if key == '$and':
+            for branch in value:
+                conditions.extend(flatten_conditions(branch))
+        elif not key.startswith('$'):
+            conditions.append((key, value))
+    return conditions
+
+def propose_index(document: type, query: dict, sort: list[tuple[str, int]]) -> dict | None:
+    """
+    Propose an index following the equality, sort, range rule.
+    $exists: true conditions become the partial filter of the index,
+    only one multikey field is kept since a compound index cannot index parallel arrays
+    """
+    equality, ranges, partial = [], [], {}
+    for field, condition in flatten_conditions(query):
+        if isinstance(condition, dict) and any(key.startswith('$') for key in condition):
+            operators = set(condition.keys())
+            if operators == {'$exists'}:
+                if condition['$exists'] is True:
+                    partial[field] = {'$exists': True}
+                continue
+            if operators & EQUALITY_OPERATORS and not operators & RANGE_OPERATORS:
+                equality.append(field)
+            else:
+                ranges.append(field)
+        else:
+            equality.append(field)
+
+    keys = []
+    has_array = False
+    for field, direction in [(field, 1) for field in equality] + list(sort) + [(field, 1) for field in ranges]:
+        if field in [key[0] for key in keys]:
+            continue
+        if is_array_field(document, field):
+            if has_array:
+                continue
+            has_array = True
+        keys.append([field, direction])
+    if not keys:
+        return None
+    name = '_'.join(f"{field}_{direction}" for field, direction in keys)
+    if partial:
+        name = f"{name}_partial_{'_'.join(sorted(partial))}"
+    return {'keys': keys, 'partialFilterExpression': partial or None, 'name': name[:120]}
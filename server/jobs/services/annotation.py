@@ -4,8 +4,11 @@ import shutil
 import subprocess
 import shlex
 from datetime import datetime
+from typing import Callable
 import requests
-from db.models import GenomeAnnotation, AnnotationError
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from db.models import GenomeAnnotation, AnnotationError, AnnotationSequenceMap
 from db.embedded_documents import PipelineInfo, IndexedFileInfo
 from mongoengine import Q
 from helpers import file as file_helper
@@ -25,28 +28,42 @@ PIPELINE_INFO = {
 
 def handle_annotation_error(annotation_to_process: AnnotationToProcess, error: str):
     """Handle annotation processing errors."""
-
-    url_path = annotation_to_process.access_url
-    source_md5 = annotation_to_process.md5_checksum
-    
-    # Check by url_path first (unique constraint), then by source_md5 as fallback
-    annotation_error = AnnotationError.objects(url_path=url_path).first()
-    if not annotation_error:
-        annotation_error = AnnotationError.objects(source_md5=source_md5).first()
-    
-    if isinstance(error, Exception):
-        error = str(error)
-    
-    if isinstance(error, str):
-        error = error.replace('\n', ';')
-
-    if annotation_error:
-        annotation_error.error_message = error
-        annotation_error.save()
-
-    else:
-        annotation_error = annotation_to_process.to_annotation_error(error)
-        annotation_error.save()
+    save_annotation_errors([(annotation_to_process, error)])
+
+def save_annotation_errors(errors: list[tuple[AnnotationToProcess, str]]):
+    """
+    Upsert the annotation errors in bulk, matching existing errors by url_path first and by source_md5 as fallback
+    """
+    if not errors:
+        return
+    collection = AnnotationError._get_collection()
+    operations = []
+    fallback_operations = []
+    for annotation_to_process, error in errors:
+        if isinstance(error, Exception):
+            error = str(error)
+        if isinstance(error, str):
+            error = error.replace('\n', ';')
+        error_doc = annotation_to_process.to_annotation_error(error).to_mongo().to_dict()
+        error_doc.pop('_id', None)
+        created_at = error_doc.pop('created_at', datetime.now())
+        operations.append(UpdateOne(
+            {'url_path': error_doc['url_path']},
+            {'$set': error_doc, '$setOnInsert': {'created_at': created_at}},
+            upsert=True,
+        ))
+        fallback_operations.append(UpdateOne(
+            {'source_md5': error_doc['source_md5']},
+            {'$set': {'error_message': error_doc['error_message']}},
+        ))
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # the source md5 is unique too: update the error stored under a different url path
+        failed_indexes = [write_error['index'] for write_error in e.details.get('writeErrors', [])]
+        retry_operations = [fallback_operations[index] for index in failed_indexes]
+        if retry_operations:
+            collection.bulk_write(retry_operations, ordered=False)
 
 def get_annotation(md5_checksum: str) -> GenomeAnnotation:
     """
@@ -92,36 +109,71 @@ def fetch_from_url(url: str) -> list[AnnotationToProcess]:
     return annotations
     
 
-def save_annotations(annotations: list[GenomeAnnotation], annotations_path: str) -> list[str]:
+def save_annotations(annotations: list[GenomeAnnotation], annotations_path: str) -> tuple[list[str], dict[str, str]]:
     """
-    Save the annotations to the database, delete the annotation errors and return the ids of the saved annotations
-    if the url path is the same but the md5 checksum is different, the annotation is deleted and the new one is saved
-    return the ids of the saved annotations
+    Upsert the annotations in bulk by url path and delete the related annotation errors.
+    if the url path is the same but the md5 checksum is different, the stored annotation is replaced by the new one.
+    Each document is written independently: a failing document does not affect the rest of the batch,
+    its files and sequence maps are removed.
+    return a tuple with the ids of the saved annotations and a dict url_path:error of the failed ones
     """
-    saved_annotations_ids = []
-    #fetch potential existing url paths
-    url_paths = [annotation.source_file_info.url_path for annotation in annotations]
-
-    # delete existing annotations where md5 changed and url path is the same
-    # we delete the metadata as the files are already updated
-    GenomeAnnotation.objects(source_file_info__url_path__in=url_paths).delete()
-
-    try:
-        #here we are sure that the annotations are not already in the database
-        GenomeAnnotation.objects.insert(annotations)
+    if not annotations:
+        return [], {}
+    failed: dict[str, str] = {}
+    valid_annotations = []
+    for annotation in annotations:
+        try:
+            annotation.validate()
+            valid_annotations.append(annotation)
+        except Exception as e:
+            failed[annotation.source_file_info.url_path] = f"Invalid annotation document: {e}"
+
+    # annotations stored with the same url path and a different md5 checksum, replaced by the new version
+    new_ids_by_url = {annotation.source_file_info.url_path: annotation.annotation_id for annotation in valid_annotations}
+    previous_annotations = [
+        previous for previous in get_annotations_by_url_paths(list(new_ids_by_url.keys()))
+        if previous['annotation_id'] != new_ids_by_url.get(previous['source_file_info']['url_path'])
+    ]
+
+    operations = [
+        ReplaceOne(
+            {'source_file_info.url_path': annotation.source_file_info.url_path},
+            annotation.to_mongo().to_dict(),
+            upsert=True,
+        )
+        for annotation in valid_annotations
+    ]
+    if operations:
+        try:
+            GenomeAnnotation._get_collection().bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                annotation = valid_annotations[write_error['index']]
+                failed[annotation.source_file_info.url_path] = write_error.get('errmsg', 'Error saving annotation to the database')
+        except Exception as e:
+            print(f"Error saving annotations to the database: {e}")
+            for annotation in valid_annotations:
+                failed[annotation.source_file_info.url_path] = str(e)
 
+    saved_annotations = [annotation for annotation in annotations if annotation.source_file_info.url_path not in failed]
+    failed_annotations = [annotation for annotation in annotations if annotation.source_file_info.url_path in failed]
+    if saved_annotations:
         #those where the md5 checksum of the original file is the same as the one in the errors or the url path
-        source_md5s = [annotation.source_file_info.uncompressed_md5 for annotation in annotations]
-        AnnotationError.objects(Q(source_md5__in=source_md5s) | Q(source_file_info__url_path__in=url_paths)).delete()
-        saved_annotations_ids = [annotation.annotation_id for annotation in annotations]
-    except Exception as e:
-        #remove files from the annotations present in the batch
-        for annotation in annotations:
-            bgzipped_path = file_helper.get_annotation_file_path(annotation)
-            csi_path = f"{bgzipped_path}.csi"
-            file_helper.remove_files([bgzipped_path, csi_path], annotations_path)
-        print(f"Error saving annotations to the database: {e}")
-    return saved_annotations_ids
+        source_md5s = [annotation.source_file_info.uncompressed_md5 for annotation in saved_annotations]
+        url_paths = [annotation.source_file_info.url_path for annotation in saved_annotations]
+        AnnotationError.objects(Q(source_md5__in=source_md5s) | Q(url_path__in=url_paths)).delete()
+    replaced_annotations = [
+        previous for previous in previous_annotations if previous['source_file_info']['url_path'] not in failed
+    ]
+    # never delete the files of the new version, in case both versions point to the same path
+    new_paths = {path for annotation in valid_annotations for path in (annotation.indexed_file_info.bgzipped_path, annotation.indexed_file_info.csi_path)}
+    delete_changed_md5_checksum_annotations(replaced_annotations, annotations_path, new_paths)
+    if failed_annotations:
+        #remove files and sequence maps of the annotations that could not be saved
+        remove_files_from_annotations(failed_annotations, annotations_path)
+        AnnotationSequenceMap.objects(annotation_id__in=[annotation.annotation_id for annotation in failed_annotations]).delete()
+        print(f"Error saving {len(failed_annotations)} annotations to the database")
+    return [annotation.annotation_id for annotation in saved_annotations], failed
 
 def filter_annotations_dict_by_field(annotations: list[AnnotationToProcess], field: str, list_of_values: list[str]) -> list[AnnotationToProcess]:
     """
@@ -129,30 +181,78 @@ def filter_annotations_dict_by_field(annotations: list[AnnotationToProcess], fie
     """
     return [annotation for annotation in annotations if getattr(annotation, field) in list_of_values]
 
-def delete_changed_md5_checksum_annotations(saved_annotations_ids: list[str], annotations_path: str) -> tuple[int, int]:
+def get_annotations_by_url_paths(url_paths: list[str]) -> list[dict]:
+    """
+    Get the id, url path and file paths of the stored annotations with the given url paths
+    """
+    return list(GenomeAnnotation.objects(source_file_info__url_path__in=url_paths).only(
+        'annotation_id', 'source_file_info.url_path', 'indexed_file_info.bgzipped_path', 'indexed_file_info.csi_path'
+    ).as_pymongo())
+
+def delete_changed_md5_checksum_annotations(replaced_annotations: list[dict], annotations_path: str, keep_paths: set[str] | None = None) -> tuple[int, int]:
+    """
+    Handle the annotations which incoming md5 checksum changed: once the metadata is replaced,
+    remove the files and the sequence maps of the previous version
+    return the number of replaced annotations and the number of deleted files
+    """
+    if not replaced_annotations:
+        return 0, 0
+    paths = []
+    for annotation in replaced_annotations:
+        indexed_file_info = annotation.get('indexed_file_info') or {}
+        for relative_path in [indexed_file_info.get('bgzipped_path'), indexed_file_info.get('csi_path')]:
+            if relative_path and relative_path not in (keep_paths or set()):
+                paths.append(file_helper.get_file_path(relative_path))
+    deleted_files = file_helper.remove_files(paths, annotations_path)
+    AnnotationSequenceMap.objects(annotation_id__in=[annotation['annotation_id'] for annotation in replaced_annotations]).delete()
+    print(f"Deleted {len(replaced_annotations)} replaced annotations")
+    print(f"Deleted {len(deleted_files)} files")
+    return len(replaced_annotations), len(deleted_files)
+
+def load_existing_source_files() -> dict[str, str]:
+    """
+    Load the source url path and md5 checksum of every stored annotation in a single query, return a dict url_path:md5
+    """
+    docs = GenomeAnnotation.objects().only('source_file_info.url_path', 'source_file_info.uncompressed_md5').as_pymongo()
+    existing_sources = {}
+    for doc in docs:
+        source_file_info = doc.get('source_file_info') or {}
+        url_path = source_file_info.get('url_path')
+        if url_path:
+            existing_sources[url_path] = source_file_info.get('uncompressed_md5')
+    return existing_sources
+
+def detect_changes(annotations: list[AnnotationToProcess], existing_sources: dict[str, str]) -> tuple[list[AnnotationToProcess], list[AnnotationToProcess]]:
+    """
+    Split the incoming annotations against the stored (url_path, md5) pairs, return a tuple of lists:
+        new: the url path is not in the database
+        changed: the url path is in the database but the md5 checksum of the source file changed
+    annotations matching both url path and md5 checksum are left out
+    """
+    new_annotations = []
+    changed_annotations = []
+    for annotation in annotations:
+        existing_md5 = existing_sources.get(annotation.access_url)
+        if existing_md5 is None:
+            new_annotations.append(annotation)
+        elif existing_md5 != annotation.md5_checksum:
+            changed_annotations.append(annotation)
+    return new_annotations, changed_annotations
+
+def get_removed_url_paths(existing_sources: dict[str, str], fetched_url_paths: set[str]) -> list[str]:
     """
-    Handle the annotations which incoming md5 checksum changed
+    Return the url paths stored in the database that are no longer listed in the fetched annotations
     """
-    urls = [annotation.source_file_info.url_path for annotation in annotations]
-    annotations_to_delete = GenomeAnnotation.objects(source_file_info__url_path__in=urls) #if the path exists, it means the incoming md5 checksum changed 
-    deleted_count = annotations_to_delete.count()
-    deleted_files_count = remove_files_from_annotations(annotations_to_delete, annotations_path)
-    annotations_to_delete.delete()
-    print(f"Deleted {deleted_count} annotations")
-    print(f"Deleted {deleted_files_count} files")
-    return deleted_count, deleted_files_count
+    return [url_path for url_path in existing_sources if url_path not in fetched_url_paths]
 
-def filter_annotations_by_md5_checksum_and_url_path(annotations: list[AnnotationToProcess]) -> list[AnnotationToProcess]:
+def filter_annotations_by_md5_checksum_and_url_path(annotations: list[AnnotationToProcess], existing_sources: dict[str, str] | None = None) -> list[AnnotationToProcess]:
     """
     Filter out the annotations that already exist (perfect match by source url and md5 checksum) in the database
     """
-    urls_to_fetch = [annotation.access_url for annotation in annotations]
-    md5s_to_check = [annotation.md5_checksum for annotation in annotations]
-    md5s_to_skip = GenomeAnnotation.objects(
-        Q(source_file_info__url_path__in=urls_to_fetch) 
-        & Q(source_file_info__uncompressed_md5__in=md5s_to_check)
-        ).scalar('source_file_info__uncompressed_md5')
-    return [annotation for annotation in annotations if annotation.md5_checksum not in md5s_to_skip]
+    if existing_sources is None:
+        existing_sources = load_existing_source_files()
+    new_annotations, changed_annotations = detect_changes(annotations, existing_sources)
+    return new_annotations + changed_annotations
 
 def remove_files_from_annotations(annotations, annotations_path) -> int:
     """
@@ -182,10 +282,11 @@ def init_annotation_file_paths(annotations_dir: str, annotation_to_process: Anno
     relative_path = f"/{sub_path}/{file_to_store}"
     return full_path, relative_path
 
-def process_annotation_file(annotation_to_process: AnnotationToProcess, tmp_subdir_path: str, bgzipped_path: str, existing_md5_checksum: list[str]) -> tuple[str, int]:
+def process_annotation_file(annotation_to_process: AnnotationToProcess, tmp_subdir_path: str, bgzipped_path: str, existing_md5_checksum: set[str], on_stage: Callable[[str], None] | None = None) -> tuple[str, int]:
     """
     Process the annotation file and return the md5 checksum and the bgzipped path.
     Steps: download → sort → compute md5 → bgzip → tabix.
+    on_stage is called with 'fetched' and 'sorted' once the download and the sort | bgzip steps are done
     returns:
         uncompressed_md5_checksum: the md5 checksum of the uncompressed file
         file_size: the size of the bgzipped file
@@ -194,6 +295,8 @@ def process_annotation_file(annotation_to_process: AnnotationToProcess, tmp_subd
     download_gff_file(annotation_to_process, gzipped_downloaded_gff_path)
     if file_helper.file_is_empty_or_does_not_exist(gzipped_downloaded_gff_path):
         raise Exception("Downloaded annotation is empty, skipping...")
+    if on_stage:
+        on_stage('fetched')
 
     md5_path = f"{tmp_subdir_path}/md5.txt"
 
@@ -211,6 +314,8 @@ def process_annotation_file(annotation_to_process: AnnotationToProcess, tmp_subd
             raise Exception(stream_err.decode('utf-8') if stream_err else 'Streaming pipeline failed')
     except subprocess.CalledProcessError as e:
         raise Exception(f"Streaming pipeline error: {e}")
+    if on_stage:
+        on_stage('sorted')
 
     tabix_cmd = f"tabix -p gff --csi {shlex.quote(bgzipped_path)}"
     try:
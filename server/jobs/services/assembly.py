@@ -1,11 +1,22 @@
 import os
-from db.models import BioProject, GenomeAssembly, AssemblyStats, GenomicSequence
+import redis
+from datetime import datetime
+from pymongo import UpdateMany
+from db.database import get_redis_client
+from db.models import BioProject, GenomeAssembly, AssemblyStats, GenomicSequence, GenomeAnnotation
 from clients import ncbi_datasets as ncbi_datasets_client
 from .classes import AnnotationToProcess, AssemblyReportSequence, AssemblyToProcess
 from .utils import create_batches
 import asyncio
 import aiohttp
-from typing import Iterator
+from typing import Iterator, Callable
+
+LIMIT_PER_HOST = int(os.getenv('ASSEMBLY_REPORTS_LIMIT_PER_HOST', '10'))
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=30, sock_read=60)
+#fields of the assemblies copied to their annotations, so that the annotations are filtered with a single query
+ANNOTATION_ASSEMBLY_FIELDS = ['refseq_category', 'assembly_level', 'assembly_status', 'assembly_type', 'bioprojects']
+#set once the fields are copied to all the annotations, until then the API filters them through the assemblies
+ASSEMBLY_FIELDS_SYNCED_KEY = 'annotrieve:annotation_assembly_fields_synced'
 
 
 def get_existing_accessions(accessions: list[str]) -> list[str]:
@@ -15,6 +26,49 @@ def get_existing_accessions(accessions: list[str]) -> list[str]:
     return GenomeAssembly.objects(assembly_accession__in=accessions).scalar('assembly_accession')
 
 
+def to_annotation_assembly_fields(assembly: dict) -> dict:
+    fields = {field: assembly.get(field) for field in ANNOTATION_ASSEMBLY_FIELDS}
+    fields['bioprojects'] = fields['bioprojects'] or []
+    return fields
+
+def get_annotation_assembly_fields(accessions: list[str]) -> dict[str, dict]:
+    """
+    Return the fields copied to the annotations, by assembly accession
+    """
+    assemblies = GenomeAssembly.objects(assembly_accession__in=list(accessions)).only('assembly_accession', *ANNOTATION_ASSEMBLY_FIELDS).as_pymongo()
+    return {assembly['assembly_accession']: to_annotation_assembly_fields(assembly) for assembly in assemblies}
+
+def sync_annotation_assembly_fields(accessions: list[str] | None = None, batch_size: int = 5000) -> int:
+    """
+    Copy the assembly fields to the annotations of the given assemblies (all of them if accessions is None) with bulk $set updates.
+    Return the number of modified annotations
+    """
+    query = {} if accessions is None else {'assembly_accession__in': list(accessions)}
+    assemblies = GenomeAssembly.objects(**query).only('assembly_accession', *ANNOTATION_ASSEMBLY_FIELDS).as_pymongo()
+    collection = GenomeAnnotation._get_collection()
+    operations = []
+    modified = 0
+    for assembly in assemblies:
+        operations.append(UpdateMany({'assembly_accession': assembly['assembly_accession']}, {'$set': to_annotation_assembly_fields(assembly)}))
+        if len(operations) >= batch_size:
+            modified += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        modified += collection.bulk_write(operations, ordered=False).modified_count
+    print(f"Synced the assembly fields of {modified} annotations")
+    if accessions is None:
+        get_redis_client().set(ASSEMBLY_FIELDS_SYNCED_KEY, datetime.now().isoformat())
+    return modified
+
+def annotation_assembly_fields_synced() -> bool:
+    """
+    Whether the assembly fields were copied to all the annotations, False if redis is not reachable
+    """
+    try:
+        return bool(get_redis_client().exists(ASSEMBLY_FIELDS_SYNCED_KEY))
+    except redis.RedisError:
+        return False
+
 def get_assembly_report_path(accession: str, assembly_name: str) -> str:
     assembly_name = assembly_name.replace(' ', '_')
     return f"https://ftp.ncbi.nlm.nih.gov/genomes/all/{accession[0:3]}/{accession[4:7]}/{accession[7:10]}/{accession[10:13]}/{accession}_{assembly_name}/{accession}_{assembly_name}_assembly_report.txt"
@@ -42,9 +96,14 @@ def handle_assemblies(annotations: list[AnnotationToProcess], tmp_dir: str, vali
         for assembly_accession, assembly_name in chrless_assemblies
     ]
     print(f"Fetching {len(report_paths)} assembly reports")
-    fetched_data = asyncio.run(fetch_data_many(report_paths, get_assembly_report))
-    print(f"Fetched {len(fetched_data)} assembly reports")
-    save_chromosomes(fetched_data, acc_to_name, batch_size)
+    #the chromosomes are saved in batches while the remaining reports are fetched
+    fetched_count = asyncio.run(fetch_data_many(
+        report_paths,
+        get_assembly_report,
+        lambda chromosomes_tuples: save_chromosomes(chromosomes_tuples, acc_to_name, batch_size),
+        batch_size=batch_size,
+    ))
+    print(f"Fetched {fetched_count} assembly reports")
     
     return get_existing_accessions(all_accessions)
 
@@ -57,17 +116,26 @@ def fetch_new_assemblies_and_bioprojects(new_accessions: list[str], tmp_dir: str
     bioprojects_to_save = dict() #accession: BioProject to ensure we don't save the same bioproject multiple times
 
     batches = create_batches(new_accessions, batch_size)
+    assemblies_paths = []
     for idx, batch in enumerate(batches):
-
         assemblies_path = os.path.join(tmp_dir, f'assemblies_{idx}_{len(batch)}.txt')
         with open(assemblies_path, 'w') as f:
             for assembly in batch: 
                 f.write(assembly + '\n')
-        cmd = ['genome', 'accession', '--inputfile', assemblies_path]
-        ncbi_report = ncbi_datasets_client.get_data_from_ncbi(cmd)
+        assemblies_paths.append(assemblies_path)
+    #the datasets calls run concurrently at the rate allowed by the shared token bucket
+    commands = [['genome', 'accession', '--inputfile', assemblies_path] for assemblies_path in assemblies_paths]
+    request_counts = [ncbi_datasets_client.count_requests(len(batch)) for batch in batches]
+    try:
+        ncbi_reports = asyncio.run(ncbi_datasets_client.get_reports_many(commands, request_counts=request_counts))
+    finally:
+        for assemblies_path in assemblies_paths:
+            os.remove(assemblies_path)
+
+    for assemblies_path, reports in zip(assemblies_paths, ncbi_reports):
         assemblies_to_save: list[GenomeAssembly] = [
             parse_assembly_from_ncbi(assembly, valid_lineages, bioprojects_to_save) 
-            for assembly in ncbi_report.get('reports', [])
+            for assembly in reports
         ]
         if not assemblies_to_save:
             print(f"No assemblies found in {assemblies_path} from NCBI, continuing...")
@@ -250,32 +318,72 @@ def parse_assembly_report(line_iterator: Iterator[str]) -> list[AssemblyReportSe
 async def fetch_data_many(
     tuples: list[tuple[str, str]], 
     fetch_func: callable, 
-    concurrency: int = 20
-) -> list[tuple[str, list[AssemblyReportSequence]]]:
+    consume_func: Callable[[list[tuple[str, list]]], None],
+    concurrency: int = 20,
+    queue_size: int = 100,
+    batch_size: int = 5000,
+    limit_per_host: int = LIMIT_PER_HOST,
+    timeout: aiohttp.ClientTimeout = FETCH_TIMEOUT,
+) -> int:
     """
-    Generic function to fetch data for multiple URLs with concurrency control.
+    Generic producer/consumer pipeline to fetch data for multiple URLs with bounded memory.
     
     Args:
         tuples: List of (url, unique identifier) tuples
-        fetch_func: Async function that takes (session, url) and returns data
-        concurrency: Maximum number of concurrent requests
+        fetch_func: Async function that takes (session, url) and returns data (a list of items)
+        consume_func: Sync function receiving lists of (unique identifier, data) tuples holding up to batch_size items,
+            run in a thread so that the fetches continue meanwhile
+        concurrency: Number of workers fetching at the same time
+        queue_size: Maximum number of fetched results waiting to be consumed, the workers wait when it is full
+        batch_size: Number of items accumulated before calling consume_func
+        limit_per_host: Maximum number of connections to the same host
+        timeout: Timeouts of each request
     
     Returns:
-        List of (unique identifier, data) tuples for successful requests
+        Number of successful requests
     """
-    results = []
-    sem = asyncio.Semaphore(concurrency)
-    
-    async with aiohttp.ClientSession() as session:
-        async def bound_fetch(session, url, unique_identifier):
-            async with sem:
-                data = await fetch_func(session, url)
-                if data:
-                    results.append((unique_identifier, data))
-        
-        await asyncio.gather(*(bound_fetch(session, url, unique_identifier) for url, unique_identifier in tuples))
+    queue = asyncio.Queue(maxsize=queue_size)
+    pending = iter(tuples) #shared by the workers, each one takes the next url when it is free
+    fetched_count = 0
+
+    async def worker(session):
+        nonlocal fetched_count
+        for url, unique_identifier in pending:
+            data = await fetch_func(session, url)
+            if data:
+                fetched_count += 1
+                await queue.put((unique_identifier, data))
+
+    async def consumer():
+        batch = []
+        items_count = 0
+        while (item := await queue.get()) is not None:
+            batch.append(item)
+            items_count += len(item[1])
+            if items_count >= batch_size:
+                await consume(batch)
+                batch = []
+                items_count = 0
+        if batch:
+            await consume(batch)
+
+    async def consume(batch):
+        try:
+            await asyncio.to_thread(consume_func, batch)
+        except Exception as e:
+            #never stop consuming, otherwise the workers would wait forever on the full queue
+            print(f"Error consuming {len(batch)} fetched results: {e}")
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=limit_per_host)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        consumer_task = asyncio.create_task(consumer())
+        try:
+            await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        finally:
+            await queue.put(None)
+            await consumer_task
     
-    return results
+    return fetched_count
 
 
 async def get_assembly_report(session: aiohttp.ClientSession, ftp_path: str) -> list[AssemblyReportSequence]:
@@ -1,88 +1,91 @@
 import re
+from functools import lru_cache
+from bson import ObjectId
 from helpers import pysam_helper
-from db.models import AnnotationSequenceMap, GenomicSequence, GenomeAnnotation, GenomeAssembly
+from db.models import AnnotationSequenceMap, GenomicSequence, GenomeAnnotation
+
+# Match "chr" + 1–2 characters (digit/letter/underscore)
+CHR_TOKEN_RE = re.compile(r'(chr[0-9A-Za-z_]{1,2})')
+CHR_ZERO_PADDED_RE = re.compile(r'chr0[0-9]$')
+
+class AliasResolver:
+    """
+    Resolve the seqids of the annotations of an assembly to its genomic sequences through a hash index of their aliases
+    """
+    def __init__(self, assembly_accession: str):
+        self.assembly_accession = assembly_accession
+        self.sequence_by_alias: dict[str, ObjectId] = {}
+        sequences = GenomicSequence.objects(assembly_accession=assembly_accession).only('aliases').as_pymongo()
+        for sequence in sequences:
+            for alias in sequence.get('aliases', []):
+                self.sequence_by_alias[alias] = sequence['_id']
+
+    def __len__(self) -> int:
+        return len(self.sequence_by_alias)
+
+    def resolve(self, seqid: str) -> ObjectId | None:
+        """
+        Return the id of the genomic sequence of the seqid, None if it cannot be resolved
+        """
+        sequence_id = self.sequence_by_alias.get(seqid)
+        if sequence_id is None and 'chr' in seqid: #check if chr is contained in the seqid and resolve it to the chromosome
+            chr_name = normalize_chr(seqid)
+            if chr_name:
+                sequence_id = self.sequence_by_alias.get(chr_name)
+        return sequence_id
+
+@lru_cache(maxsize=64)
+def get_alias_resolver(assembly_accession: str) -> AliasResolver:
+    """
+    Return the alias resolver of the assembly, shared by its annotations (the chromosomes are saved before the annotations are processed)
+    """
+    return AliasResolver(assembly_accession)
 
 def handle_alias_mapping(parsed_annotation: GenomeAnnotation, bgzipped_path: str):
     """
     handle the alias mapping for the annotation and store them in the database
     """
     #CHROMOSOMES STEP
-    chromosomes = GenomicSequence.objects(assembly_accession=parsed_annotation.assembly_accession)
-    
-    if chromosomes.count() == 0:
+    resolver = get_alias_resolver(parsed_annotation.assembly_accession)
+    if not resolver:
         return
 
-    chr_aliases_dict = {} #dict with all possible combinations of aliases for the chromosomes
-    chr_map = {} #dict uid to chr
-    for chr in chromosomes:
-        gb = chr.genbank_accession
-        rs = chr.refseq_accession
-        if gb and rs:
-            uid = f"{gb}_{rs}"
-        elif gb:
-            uid = gb
-        elif rs:
-            uid = rs
-        else:
-            uid = str(chr.id)
-    
-        for alias in chr.aliases:
-            chr_aliases_dict[alias] = uid
-        chr_map[uid] = chr
     try:
         sequences_to_save = []
         for contig in pysam_helper.stream_contigs_names(bgzipped_path):
             seqid = contig.strip()
             if not seqid:
                 continue
-
-            if not seqid in chr_aliases_dict and is_number(seqid):
-                seqid = int(seqid) #try with int
-            
-            if seqid in chr_aliases_dict:
-                chr = chr_map[chr_aliases_dict[seqid]]
+            genomic_sequence = resolver.resolve(seqid)
+            if genomic_sequence is not None:
                 sequences_to_save.append(AnnotationSequenceMap(
                     sequence_id=seqid,
                     annotation_id=parsed_annotation.annotation_id,
-                    aliases=chr.aliases,
+                    genomic_sequence=genomic_sequence,
                 ))
-            elif 'chr' in seqid: #check if chr is contained in the seqid and resolve it to the chromosome
-                #get chr and the 2 characters after it
-                chr_name = normalize_chr(seqid)
-                if chr_name and chr_name in chr_aliases_dict:
-                    chr = chr_map[chr_aliases_dict[chr_name]]
-                    sequences_to_save.append(AnnotationSequenceMap(
-                        sequence_id=seqid,
-                        annotation_id=parsed_annotation.annotation_id,
-                        aliases=chr.aliases, 
-                    ))
         if not sequences_to_save:
             # we will try to map the contigs to the chromosomes later
             return 
 
-        AnnotationSequenceMap.objects.insert(sequences_to_save)
+        AnnotationSequenceMap.objects.insert(sequences_to_save, load_bulk=False)
         parsed_annotation.mapped_regions=[sequence_map.sequence_id for sequence_map in sequences_to_save]
     except Exception as e:
         print(f"Error mapping sequences for {parsed_annotation.source_file_info.url_path}: {e}")
         raise e
 
-def is_number(s: str) -> bool:
-    return re.match(r'^\d+$', s) is not None
-
 def normalize_chr(s: str) -> str | None:
-    # Match "chr" + 1–2 characters (digit/letter/underscore)
-    match = re.search(r'(chr[0-9A-Za-z_]{1,2})', s)
+    match = CHR_TOKEN_RE.search(s)
     if not match:
         return None
 
     token = match.group(1)
 
     # Case: chr01 → normalize to chr1
-    if re.match(r'chr0[0-9]$', token):
+    if CHR_ZERO_PADDED_RE.match(token):
         return "chr" + token[-1]
 
     # Case: chrX_ or chr1_ → normalize to chrX or chr1
     if token.endswith("_"):
         return token[:-1]
 
-    return token
\ No newline at end of file
+    return token
@@ -1,6 +1,9 @@
 from db.embedded_documents import GFFStats, GeneCategoryFeatureStats, GenericLengthStats, AssociatedGenesStats, GenericTranscriptTypeStats, SubFeatureStats as SubFeatureStatsDoc
 from helpers import pysam_helper
 
+#bump when compute_features_statistics changes, annotations with another version are recomputed by update_feature_stats
+STATS_VERSION = '2'
+
 GENE_CODES = set([
     "gene",
     "ncRNA_gene",
@@ -0,0 +1,142 @@
+from datetime import datetime
+from pymongo import UpdateOne
+from db.models import ImportJob, ImportJobAnnotation
+from .classes import AnnotationToProcess
+from .utils import create_batches
+
+PENDING = 'pending'
+FETCHED = 'fetched'
+SORTED = 'sorted'
+INDEXED = 'indexed'
+STATS = 'stats'
+SAVED = 'saved'
+ERROR = 'error'
+
+STAGES = [PENDING, FETCHED, SORTED, INDEXED, STATS, SAVED, ERROR]
+FINAL_STAGES = {SAVED, ERROR}
+#stages where the bgzipped and csi files are already on disk and can be reused
+RESUMABLE_STAGES = {INDEXED, STATS}
+
+def get_or_create_job() -> ImportJob:
+    """
+    Return the last unfinished import job (to resume it) or create a new one
+    """
+    job = ImportJob.objects(status='running').order_by('-started_at').first()
+    if job:
+        print(f"Resuming import job {job.id} started at {job.started_at}")
+        return job
+    job = ImportJob(status='running')
+    job.save()
+    print(f"Created import job {job.id}")
+    return job
+
+def finish_job(job: ImportJob):
+    """
+    Mark the import job as finished, the next run will create a new one
+    """
+    now = datetime.now()
+    job.modify(status='finished', finished_at=now, updated_at=now)
+
+def get_states(job: ImportJob) -> dict[tuple[str, str], dict]:
+    """
+    Return the annotation states of the job as a dict (url_path, source_md5):state
+    """
+    states = ImportJobAnnotation.objects(job_id=str(job.id)).exclude('id').as_pymongo()
+    return {(state['url_path'], state['source_md5']): state for state in states}
+
+def register_annotations(job: ImportJob, annotations: list[AnnotationToProcess], batch_size: int=5000) -> dict[tuple[str, str], dict]:
+    """
+    Register the annotations not yet tracked by the job as pending, return the states of the job
+    """
+    states = get_states(job)
+    job_id = str(job.id)
+    new_states = [
+        ImportJobAnnotation(
+            job_id=job_id,
+            url_path=annotation.access_url,
+            source_md5=annotation.md5_checksum,
+            stage=PENDING,
+        )
+        for annotation in annotations
+        if (annotation.access_url, annotation.md5_checksum) not in states
+    ]
+    for batch in create_batches(new_states, batch_size):
+        ImportJobAnnotation.objects.insert(batch, load_bulk=False)
+    if new_states:
+        job.modify(total_annotations=len(states) + len(new_states), updated_at=datetime.now())
+        states = get_states(job)
+    return states
+
+def set_stage(job: ImportJob, annotation_to_process: AnnotationToProcess, stage: str, **fields):
+    """
+    Persist the stage reached by an annotation, extra fields (annotation_id, file_size, error_message) are stored as well
+    """
+    now = datetime.now()
+    updates = {f"set__{key}": value for key, value in fields.items()}
+    ImportJobAnnotation.objects(
+        job_id=str(job.id),
+        url_path=annotation_to_process.access_url,
+        source_md5=annotation_to_process.md5_checksum,
+    ).update_one(set__stage=stage, set__updated_at=now, **updates)
+
+def set_stages(job: ImportJob, annotations: list[AnnotationToProcess], stage: str):
+    """
+    Persist the same stage for several annotations in a single bulk write
+    """
+    if not annotations:
+        return
+    now = datetime.now()
+    #matched on (url_path, source_md5) as in set_stage, the rows of an older version of the same url are left untouched
+    operations = [
+        UpdateOne(
+            {'job_id': str(job.id), 'url_path': annotation.access_url, 'source_md5': annotation.md5_checksum},
+            {'$set': {'stage': stage, 'updated_at': now}},
+        )
+        for annotation in annotations
+    ]
+    ImportJobAnnotation._get_collection().bulk_write(operations, ordered=False)
+    job.modify(updated_at=now)
+
+def get_saved_annotation_ids(job: ImportJob) -> list[str]:
+    """
+    Return the annotation ids saved by the job, in this run or in an interrupted one
+    """
+    return [annotation_id for annotation_id in ImportJobAnnotation.objects(job_id=str(job.id), stage=SAVED).scalar('annotation_id') if annotation_id]
+
+def get_job_status(job: ImportJob | None = None) -> dict | None:
+    """
+    Report the progress of an import job (the last one by default): counts per stage, throughput and ETA
+    """
+    if job is None:
+        job = ImportJob.objects().order_by('-started_at').first()
+    if not job:
+        return None
+    pipeline = [
+        {"$match": {"job_id": str(job.id)}},
+        {"$group": {"_id": "$stage", "count": {"$sum": 1}}},
+    ]
+    counts = {stage: 0 for stage in STAGES}
+    for doc in ImportJobAnnotation.objects.aggregate(pipeline):
+        counts[doc['_id']] = doc['count']
+
+    processed = sum(counts[stage] for stage in FINAL_STAGES)
+    remaining = sum(count for stage, count in counts.items() if stage not in FINAL_STAGES)
+    end = job.finished_at or datetime.now()
+    elapsed_seconds = max((end - job.started_at).total_seconds(), 1)
+    throughput_per_hour = round(processed / elapsed_seconds * 3600, 2)
+    eta_seconds = None
+    if job.status == 'running' and processed > 0:
+        eta_seconds = round(remaining / (processed / elapsed_seconds))
+    return {
+        'job_id': str(job.id),
+        'status': job.status,
+        'started_at': job.started_at,
+        'updated_at': job.updated_at,
+        'finished_at': job.finished_at,
+        'total_annotations': job.total_annotations,
+        'stages': counts,
+        'processed': processed,
+        'remaining': remaining,
+        'throughput_per_hour': throughput_per_hour,
+        'eta_seconds': eta_seconds,
+    }
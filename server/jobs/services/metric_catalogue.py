@@ -0,0 +1,55 @@
+from datetime import datetime
+from pymongo import UpdateOne
+from db.models import GenomeAnnotation, MetricCatalogue
+from helpers import metric_columns
+
+#kind -> (key in features_statistics, metric name -> path inside the category or type stats)
+CATALOGUE_KINDS = {
+    'gene': ('gene_category_stats', metric_columns.GENE_METRIC_PATHS),
+    'transcript': ('transcript_type_stats', metric_columns.TRANSCRIPT_METRIC_PATHS),
+}
+
+def metric_catalogue_pipeline(stats_key: str, metric_paths: dict[str, str], annotation_ids: list[str] | None = None) -> list[dict]:
+    """
+    One group per category (or type) of features_statistics.<stats_key>, with a 0/1 flag per metric present in at least one annotation
+    """
+    match = {'features_statistics': {'$exists': True}}
+    if annotation_ids is not None:
+        match['annotation_id'] = {'$in': annotation_ids}
+    return [
+        {'$match': match},
+        {'$project': {'_id': 0, 'entries': {'$objectToArray': {'$ifNull': [f'$features_statistics.{stats_key}', {}]}}}},
+        {'$unwind': '$entries'},
+        {'$group': {
+            '_id': '$entries.k',
+            **{
+                metric: {'$max': {'$cond': [{'$eq': [{'$ifNull': [f'$entries.v.{path}', None]}, None]}, 0, 1]}}
+                for metric, path in metric_paths.items()
+            },
+        }},
+    ]
+
+def update_metric_catalogue(annotation_ids: list[str] | None = None) -> int:
+    """
+    Add the metrics found in the stats of the given annotations to the catalogue.
+    Without annotation_ids the catalogue is rebuilt from all the annotations, dropping the categories and metrics no longer present
+    """
+    updated = 0
+    for kind, (stats_key, metric_paths) in CATALOGUE_KINDS.items():
+        operations = []
+        names = []
+        for doc in GenomeAnnotation.objects.aggregate(metric_catalogue_pipeline(stats_key, metric_paths, annotation_ids), allowDiskUse=True):
+            metrics = [metric for metric in metric_paths if doc.get(metric)]
+            names.append(doc['_id'])
+            if annotation_ids is None:
+                update = {'$set': {'metrics': metrics, 'updated_at': datetime.now()}}
+            else:
+                update = {'$addToSet': {'metrics': {'$each': metrics}}, '$set': {'updated_at': datetime.now()}}
+            operations.append(UpdateOne({'kind': kind, 'name': doc['_id']}, update, upsert=True))
+        if operations:
+            MetricCatalogue._get_collection().bulk_write(operations, ordered=False)
+        if annotation_ids is None:
+            MetricCatalogue.objects(kind=kind, name__nin=names).delete()
+        updated += len(operations)
+    print(f"Updated the metric catalogue of {updated} gene categories and transcript types")
+    return updated
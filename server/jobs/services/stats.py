@@ -43,9 +43,9 @@ def update_db_stats(saved_annotations_ids: list[str]):
             assemblies_count=GenomeAssembly.objects(bioprojects__in=[bioproject.accession]).count()
         )
 
-def clean_up_empty_models():
+def clean_up_empty_models() -> int:
     """
-    Clean up empty models where annotations_count is 0
+    Clean up empty models where annotations_count is 0, return the number of deleted documents
     """
     annotation_q = Q(annotations_count=0) | Q(annotations_count__exists=False)
     deleted_assemblies_count = GenomeAssembly.objects(annotation_q).delete()
@@ -54,4 +54,5 @@ def clean_up_empty_models():
     assembly_q = Q(assemblies_count=0) | Q(assemblies_count__exists=False)
     deleted_bioprojects_count = BioProject.objects(assembly_q).delete()
     print(f"Deleted {deleted_assemblies_count} assemblies, {deleted_organisms_count} organisms, {deleted_taxon_nodes_count} taxon nodes, {deleted_bioprojects_count} bioprojects")
+    return deleted_assemblies_count + deleted_organisms_count + deleted_taxon_nodes_count + deleted_bioprojects_count
 
@@ -4,8 +4,15 @@ from lxml import etree
 from .classes import AnnotationToProcess, OrganismToProcess
 import os
 from .utils import create_batches
-import gzip
+import asyncio
+import aiohttp
 from itertools import chain
+from collections import defaultdict
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+ENA_CONCURRENCY = int(os.getenv('ENA_CONCURRENCY', '4'))
+ENA_RETRIES = 3
 
 def get_existing_lineages_dict(annotations: list[AnnotationToProcess])->dict[str, list[str]]:
     """
@@ -16,7 +23,7 @@ def get_existing_lineages_dict(annotations: list[AnnotationToProcess])->dict[str
     lineages = {taxid:lineage for taxid, lineage in existing_organisms}
     return lineages
 
-def handle_taxonomy(annotations: list[AnnotationToProcess], tmp_dir: str, batch_size: int=9000) -> dict:
+def handle_taxonomy(annotations: list[AnnotationToProcess], batch_size: int=9000) -> dict:
     """
     Fetch the taxonomy from the a list of AnnotationToProcess and store the lineages in a dictionary taxid:lineage, return the lineages dict
     """    
@@ -27,7 +34,7 @@ def handle_taxonomy(annotations: list[AnnotationToProcess], tmp_dir: str, batch_
         return lineages
 
     print(f"Found {len(new_taxids)} new organisms to fetch")
-    organisms_to_process = fetch_new_organisms(list(new_taxids), tmp_dir, batch_size)
+    organisms_to_process = fetch_new_organisms(list(new_taxids), batch_size)
     # save all the related taxons and return the list of taxids of saved taxons
     saved_taxids = save_organisms(organisms_to_process, batch_size)
     if not saved_taxids:
@@ -40,38 +47,48 @@ def handle_taxonomy(annotations: list[AnnotationToProcess], tmp_dir: str, batch_
     save_taxons(successfully_saved_organisms)
 
     print("Updating taxon hierarchy")
-    organisms_to_update = Organism.objects(taxid__in=saved_taxids)
-    for organism in organisms_to_update:
-        ordered_taxons = get_ordered_taxons(organism.taxon_lineage)
-        update_taxon_hierarchy(ordered_taxons)
-        
-    print("Taxon hierarchy updated")
+    updated_parents = update_taxon_hierarchy(successfully_saved_organisms, batch_size)
+    print(f"Taxon hierarchy updated, {updated_parents} parent taxons")
     lineages = get_existing_lineages_dict(annotations)
     return lineages #return all the valid lineages
 
 
-def fetch_new_organisms(taxids: list[str], tmp_dir: str, batch_size: int=9000)->list[OrganismToProcess]:
+def fetch_new_organisms(taxids: list[str], batch_size: int=9000)->list[OrganismToProcess]:
     """
-    Fetch new organisms from ENA browser in bulk (up to 10k taxids at a time) and parse them into OrganismToProcess objects
+    Fetch new organisms from ENA browser in bulk (up to 10k taxids at a time) and parse them into OrganismToProcess objects.
+    The batches are fetched concurrently and parsed while they are downloaded
     """
     batches = create_batches(taxids, batch_size)
-    organisms_to_process = []
-    for idx, batch in enumerate(batches):
-        # Use index in filename to avoid collisions when different batches have same length
-        path_to_gzipped_xml_file = os.path.join(tmp_dir, f'taxons_{idx}_{len(batch)}.xml.gz')
-        fetch_success = ebi_client.get_xml_from_ena_browser(batch, path_to_gzipped_xml_file)
-        if not fetch_success or not os.path.exists(path_to_gzipped_xml_file) or os.path.getsize(path_to_gzipped_xml_file) == 0:
-            continue
+    parsed_batches = asyncio.run(fetch_organisms_batches(batches))
+    return list(chain(*parsed_batches))
 
-        organisms_to_process.extend(
-            parse_taxons_and_organisms_from_ena_browser(path_to_gzipped_xml_file)
-        )
-        # Best-effort cleanup to save disk space
+async def fetch_organisms_batches(batches: list[list[str]], concurrency: int=ENA_CONCURRENCY)->list[list[OrganismToProcess]]:
+    """
+    Fetch and parse the batches of taxids with at most `concurrency` requests at a time
+    """
+    sem = asyncio.Semaphore(concurrency)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+    async with aiohttp.ClientSession(auto_decompress=False, timeout=timeout) as session:
+        async def bound_fetch(idx, batch):
+            async with sem:
+                return await fetch_organisms_batch(session, idx, batch)
+        return await asyncio.gather(*(bound_fetch(idx, batch) for idx, batch in enumerate(batches)))
+
+async def fetch_organisms_batch(session: aiohttp.ClientSession, idx: int, batch: list[str], retries: int=ENA_RETRIES)->list[OrganismToProcess]:
+    """
+    Stream the XML of a batch of taxids into the parser, a failed batch is retried from scratch with exponential backoff
+    """
+    for attempt in range(1, retries + 1):
+        parser = TaxonXMLParser()
         try:
-            os.remove(path_to_gzipped_xml_file)
-        except Exception:
-            pass
-    return organisms_to_process
+            async for chunk in ebi_client.stream_xml_from_ena_browser(session, batch):
+                parser.feed(chunk)
+            return parser.close()
+        except Exception as e:
+            print(f"Error fetching taxons batch {idx} (attempt {attempt}/{retries}): {e}")
+            if attempt < retries:
+                await asyncio.sleep(2 ** attempt)
+    return []
 
 def save_organisms(organisms_to_process: list[OrganismToProcess], batch_size: int=5000)->list[str]:
     """
@@ -123,115 +140,103 @@ def save_taxons(organisms_to_process: list[OrganismToProcess], batch_size: int=5
         
     print(f"Total taxons saved: {len(saved_taxids)}")
 
-def get_ordered_taxons(taxids: list[str])->list[TaxonNode]:
+def get_children_by_parent(organisms_to_process: list[OrganismToProcess])->dict[str, set[str]]:
     """
-    Reload taxons from database and return them ordered by lineage from species to root
+    Compute the deduplicated child->parent edges of the lineages (ordered from species to root), return a dict parent_taxid:children_taxids
     """
-    reloaded_taxons = TaxonNode.objects(taxid__in=taxids)
-    taxon_map = {t.taxid: t for t in reloaded_taxons}
-    return [taxon_map[t] for t in taxids]
-
+    children_by_parent = defaultdict(set)
+    for organism in organisms_to_process:
+        lineage = organism.taxon_lineage
+        for child_taxid, parent_taxid in zip(lineage, lineage[1:]):
+            children_by_parent[parent_taxid].add(child_taxid)
+    return children_by_parent
 
-def update_taxon_hierarchy(ordered_taxons: list[TaxonNode]):
+def update_taxon_hierarchy(organisms_to_process: list[OrganismToProcess], batch_size: int=5000)->int:
     """
-    Update the taxon hierarchy in a best-effort manner, add the children to the father taxon
+    Update the taxon hierarchy in a best-effort manner, add the children to the father taxons with one $addToSet per father.
+    return the number of father taxons updated
     """
-    for index in range(len(ordered_taxons) - 1):
-        child_taxon = ordered_taxons[index]
-        father_taxon = ordered_taxons[index + 1]
-        father_taxon.modify(add_to_set__children=child_taxon.taxid)
+    operations = [
+        UpdateOne({'taxid': parent_taxid}, {'$addToSet': {'children': {'$each': sorted(children)}}})
+        for parent_taxid, children in get_children_by_parent(organisms_to_process).items()
+    ]
+    for batch in create_batches(operations, batch_size):
+        try:
+            TaxonNode._get_collection().bulk_write(batch, ordered=False)
+        except BulkWriteError as e:
+            print(f"Error updating taxon hierarchy: {len(e.details.get('writeErrors', []))} failed updates")
+    return len(operations)
 
 
-def parse_taxons_and_organisms_from_ena_browser(xml_path: str)->list[OrganismToProcess]:
+class TaxonXMLParser:
     """
-    Parse taxons from ENA browser XML file and return a tuple of list of organisms (with ordered taxon lineages from species to root) and dictionary of taxon lineages
+    Incremental parser of the ENA browser taxon XML, fed with chunks as they are downloaded
     """
-    parsed_organisms = []
-    
-    # Validate file exists and has content
-    if not os.path.exists(xml_path):
-        print(f"XML file does not exist: {xml_path}")
-        return parsed_organisms
-    
-    file_size = os.path.getsize(xml_path)
-    if file_size == 0:
-        print(f"XML file is empty: {xml_path}")
-        return parsed_organisms
-    
-    try:
-        with gzip.open(xml_path, "rb") as f:
+    def __init__(self):
+        self.parser = etree.XMLPullParser(events=("end",), tag="taxon")
+        self.parsed_organisms: list[OrganismToProcess] = []
+
+    def feed(self, data: bytes):
+        self.parser.feed(data)
+        self._read_events()
+
+    def close(self)->list[OrganismToProcess]:
+        self.parser.close()
+        self._read_events()
+        return self.parsed_organisms
+
+    def _read_events(self):
+        for _, elem in self.parser.read_events():
+            parent = elem.getparent()
+            # lineage and children taxons are read from their top-level taxon, they must not be cleared before
+            if parent is None or parent.tag != "TAXON_SET":
+                continue
             try:
-                context = etree.iterparse(f, events=("end",), tag="taxon")
-                
-                for _, elem in context:
-                    try:
-                        parent = elem.getparent()
-                        if parent is None:
-                            continue
-                        if parent.tag == "TAXON_SET":
-                            # Top-level taxon
-                            organism_taxid = str(elem.get("taxId"))
-                            if not organism_taxid or organism_taxid == "None":
-                                continue
-                            
-                            organism_info = OrganismToProcess(
-                                taxid=organism_taxid,
-                                organism_name=elem.get("scientificName"),
-                                common_name=elem.get("commonName"),
-                                taxon_lineage=[],
-                                parsed_taxon_lineage=[]
-                            )
-                            #add the organism to the taxon node
-                            organism_info.taxon_lineage.append(organism_taxid)
-                            organism_info.parsed_taxon_lineage.append(TaxonNode(
-                                taxid=organism_taxid,
-                                scientific_name=organism_info.organism_name,
-                                rank="organism"
-                            ))
-                            # Collect lineage children
-                            lineage_elem = elem.find("lineage")
-                            if lineage_elem is not None:
-                                for lt in lineage_elem.findall("taxon"):
-                                    taxid = str(lt.get("taxId"))
-                                    #we suppose this are ordered from species to root
-                                    if lt.get("scientificName") == "root":
-                                        continue
-                                    organism_info.taxon_lineage.append(taxid)
-                                    organism_info.parsed_taxon_lineage.append(TaxonNode(
-                                        taxid=taxid, 
-                                        scientific_name=lt.get("scientificName"), 
-                                        rank=lt.get("rank") if lt.get("rank") else "other"
-                                    ))
-
-                            parsed_organisms.append(organism_info)
-                        # Clean up element to free memory
-                        elem.clear()
-                        while elem.getprevious() is not None:
-                            del elem.getparent()[0]
-                    except (AttributeError, TypeError) as e:
-                        # Skip malformed elements
-                        print(f"Warning: Skipping malformed element in {xml_path}: {e}")
-                        continue
-                        
-            except etree.XMLSyntaxError as e:
-                print(f"XML syntax error in {xml_path}: {e}")
-                return parsed_organisms
-            except etree.ParseError as e:
-                print(f"XML parse error in {xml_path}: {e}")
-                return parsed_organisms
-            except etree.Error as e:
-                # Catch "no element found" and other lxml errors
-                print(f"XML parsing error in {xml_path}: {e}")
-                return parsed_organisms
-                
-    except gzip.BadGzipFile as e:
-        print(f"Invalid gzip file: {xml_path}, error: {e}")
-        return parsed_organisms
-    except IOError as e:
-        print(f"IO error reading file {xml_path}: {e}")
-        return parsed_organisms
-    except Exception as e:
-        print(f"Unexpected error reading XML file {xml_path}: {e}")
-        return parsed_organisms
-
-    return parsed_organisms
+                organism_info = parse_organism_element(elem)
+                if organism_info:
+                    self.parsed_organisms.append(organism_info)
+            except (AttributeError, TypeError) as e:
+                # Skip malformed elements
+                print(f"Warning: Skipping malformed taxon element: {e}")
+            # Clean up element to free memory
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+def parse_organism_element(elem: etree._Element)->OrganismToProcess | None:
+    """
+    Parse a top-level taxon element into an OrganismToProcess with the taxon lineage ordered from species to root
+    """
+    organism_taxid = str(elem.get("taxId"))
+    if not organism_taxid or organism_taxid == "None":
+        return None
+    
+    organism_info = OrganismToProcess(
+        taxid=organism_taxid,
+        organism_name=elem.get("scientificName"),
+        common_name=elem.get("commonName"),
+        taxon_lineage=[],
+        parsed_taxon_lineage=[]
+    )
+    #add the organism to the taxon node
+    organism_info.taxon_lineage.append(organism_taxid)
+    organism_info.parsed_taxon_lineage.append(TaxonNode(
+        taxid=organism_taxid,
+        scientific_name=organism_info.organism_name,
+        rank="organism"
+    ))
+    # Collect lineage children
+    lineage_elem = elem.find("lineage")
+    if lineage_elem is not None:
+        for lt in lineage_elem.findall("taxon"):
+            taxid = str(lt.get("taxId"))
+            #we suppose this are ordered from species to root
+            if lt.get("scientificName") == "root":
+                continue
+            organism_info.taxon_lineage.append(taxid)
+            organism_info.parsed_taxon_lineage.append(TaxonNode(
+                taxid=taxid, 
+                scientific_name=lt.get("scientificName"), 
+                rank=lt.get("rank") if lt.get("rank") else "other"
+            ))
+    return organism_info
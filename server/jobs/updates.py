@@ -1,12 +1,20 @@
-from celery import shared_task
-from db.models import GenomeAssembly, GenomeAnnotation, AnnotationSequenceMap, BioProject
+from celery import shared_task, group
+from pymongo import UpdateOne
+from db.models import GenomeAssembly, GenomeAnnotation, AnnotationSequenceMap, BioProject, GenomicSequence
 from clients import ncbi_datasets as ncbi_datasets_client
 import os
+import asyncio
+from datetime import datetime
 from .services import assembly as assembly_service
 from .services.utils import create_batches
 from .services import stats as stats_service
 from .services import feature_stats as feature_stats_service
+from .services import contigs as contigs_service
+from .services import metric_catalogue as metric_catalogue_service
 from helpers import file as file_helper
+from celery_app import task_lock
+from .indexes import get_documents
+from helpers import data_generation
 
 TMP_DIR = "/tmp"
 
@@ -19,100 +27,277 @@ def update_assembly_fields():
 
 
 @shared_task(name='update_feature_stats', ignore_result=False)
-def update_feature_stats():
-    """
-    Update the feature stats for the annotations
-    """
-    annotations = GenomeAnnotation.objects()
-    for annotation in annotations:
-        #get full bgzipped path from the indexed file info
-        bgzipped_path = file_helper.get_annotation_file_path(annotation)
-        feature_stats = feature_stats_service.compute_features_statistics(bgzipped_path)
-        #for the moment we keep the old fields for backwards compatibility
-        if annotation.features_statistics:
-            annotation.features_statistics.gene_category_stats = feature_stats.gene_category_stats
-            annotation.features_statistics.transcript_type_stats = feature_stats.transcript_type_stats
-            annotation.save()
-        else:
-            annotation.features_statistics = feature_stats
-            annotation.save()
+@task_lock.singleton('update_feature_stats')
+def update_feature_stats(force: bool = False, batch_size: int = 50):
+    """
+    Recompute the feature stats of the annotations computed by another version of the analyzer (all of them with force).
+    The annotations are split in batches processed in parallel by the workers,
+    the task is not run again (nor queued by the trigger) until every batch finished
+    """
+    query = {} if force else {'stats_version__ne': feature_stats_service.STATS_VERSION}
+    annotation_ids = list(GenomeAnnotation.objects(**query).scalar('annotation_id'))
+    if not annotation_ids:
+        print(f"Feature stats are up to date (version {feature_stats_service.STATS_VERSION})")
+        return {'queued': 0, 'batches': 0}
+    batches = create_batches(annotation_ids, batch_size)
+    task_lock.start_fanout('update_feature_stats', len(batches))
+    group(update_feature_stats_batch.s(batch, force, fanout=True) for batch in batches).apply_async()
+    print(f"Queued {len(annotation_ids)} annotations in {len(batches)} batches")
+    return {'queued': len(annotation_ids), 'batches': len(batches)}
+
+@shared_task(name='update_feature_stats_batch', ignore_result=False)
+def update_feature_stats_batch(annotation_ids: list[str], force: bool = False, fanout: bool = False):
+    """
+    Compute the feature stats of a batch of annotations and write them with targeted $set updates in a single bulk write.
+    Annotations leased by another worker or already up to date are skipped
+    """
+    query = {} if force else {'stats_version__ne': feature_stats_service.STATS_VERSION}
+    leased_ids = [annotation_id for annotation_id in annotation_ids if task_lock.acquire_lease('update_feature_stats', annotation_id)]
+    operations = []
+    updated_ids = []
+    errors = 0
+    try:
+        annotations = GenomeAnnotation.objects(annotation_id__in=leased_ids, **query).only('annotation_id', 'indexed_file_info')
+        for annotation in annotations:
+            try:
+                #get full bgzipped path from the indexed file info
+                bgzipped_path = file_helper.get_annotation_file_path(annotation)
+                feature_stats = feature_stats_service.compute_features_statistics(bgzipped_path).to_mongo().to_dict()
+            except Exception as e:
+                print(f"Error computing feature stats of {annotation.annotation_id}: {e}")
+                errors += 1
+                continue
+            operations.extend(feature_stats_updates(annotation.annotation_id, feature_stats))
+            updated_ids.append(annotation.annotation_id)
+        if operations:
+            GenomeAnnotation._get_collection().bulk_write(operations, ordered=False)
+            metric_catalogue_service.update_metric_catalogue(updated_ids)
+            data_generation.bump_generation('update_feature_stats')
+    finally:
+        task_lock.release_leases('update_feature_stats', leased_ids)
+        if fanout:
+            task_lock.finish_fanout_subtask('update_feature_stats')
+    updated = len(operations) // 2
+    print(f"Updated feature stats of {updated} annotations, {errors} errors, {len(annotation_ids) - len(leased_ids)} leased by other workers")
+    return {'updated': updated, 'errors': errors}
+
+def feature_stats_updates(annotation_id: str, feature_stats: dict) -> list[UpdateOne]:
+    """
+    Updates setting the new stats: the old fields of existing features_statistics are kept for backwards compatibility,
+    a missing or null features_statistics is set as a whole. Exactly one of the two filters matches
+    """
+    stats_version = feature_stats_service.STATS_VERSION
+    return [
+        UpdateOne(
+            {'annotation_id': annotation_id, 'features_statistics': None},
+            {'$set': {'features_statistics': feature_stats, 'stats_version': stats_version}},
+        ),
+        UpdateOne(
+            {'annotation_id': annotation_id, 'features_statistics': {'$ne': None}},
+            {'$set': {
+                'features_statistics.gene_category_stats': feature_stats.get('gene_category_stats', {}),
+                'features_statistics.transcript_type_stats': feature_stats.get('transcript_type_stats', {}),
+                'stats_version': stats_version,
+            }},
+        ),
+    ]
 
 @shared_task(name='update_bioprojects', ignore_result=False)
-def update_bioprojects():
+@task_lock.singleton('update_bioprojects')
+def update_bioprojects(batch_size: int = 5000):
     """
     Import the bioprojects and update assemblies and annotations
     """
     accessions = GenomeAssembly.objects().scalar('assembly_accession')
-    batches = create_batches(accessions, 5000)
+    batches = create_batches(list(accessions), batch_size)
     files_to_delete = []
     all_bp_accessions = set()
     bioprojects_to_save = dict() #accession: BioProject to ensure we don't save the same bioproject multiple times
     assembly_to_bp_accessions = dict() #assembly_accession: list[bioproject_accessions]
-    for idx, accessions_batch in enumerate(batches):
-        assemblies_path = os.path.join(TMP_DIR, f'assemblies_to_update_{idx}_{len(accessions_batch)}.txt')
-        files_to_delete.append(assemblies_path)
-        with open(assemblies_path, 'w') as f:
-            for accession in accessions_batch: 
-                f.write(accession + '\n')
-        cmd = ['genome', 'accession', '--inputfile', assemblies_path]
-        ncbi_report = ncbi_datasets_client.get_data_from_ncbi(cmd)
-        report = ncbi_report.get('reports', [])    
-        if not report:
-            print(f"No report found for {assemblies_path}")
-        for assembly in report:
-            assembly_accession = assembly.get('accession')
-            bioproject_accessions = assembly_service.parse_bioprojects(assembly.get('assembly_info', {}), bioprojects_to_save)
-            assembly_to_bp_accessions[assembly_accession] = bioproject_accessions
-            all_bp_accessions.update(bioproject_accessions)
-    
-    #filter out existing bioprojects
-    existing_bioprojects = BioProject.objects(accession__in=list(all_bp_accessions)).scalar('accession')
-    new_bioprojects = all_bp_accessions - set(existing_bioprojects)
-    bioprojects_to_save = {accession: bioproject for accession, bioproject in bioprojects_to_save.items() if accession in new_bioprojects}
-    #insert the bioprojects to the database
-    if not new_bioprojects:
-        print("No new bioprojects to insert")
-        return
     try:
-        BioProject.objects.insert(list(bioprojects_to_save.values()))
-        for assembly_accession, bioproject_accessions in assembly_to_bp_accessions.items():
-            GenomeAssembly.objects(assembly_accession=assembly_accession).update(bioprojects=bioproject_accessions)
-        print(f"Updated {len(assembly_to_bp_accessions)} assemblies with new bioprojects")
+        for idx, accessions_batch in enumerate(batches):
+            assemblies_path = os.path.join(TMP_DIR, f'assemblies_to_update_{idx}_{len(accessions_batch)}.txt')
+            files_to_delete.append(assemblies_path)
+            with open(assemblies_path, 'w') as f:
+                for accession in accessions_batch: 
+                    f.write(accession + '\n')
+        #the datasets calls run concurrently at the rate allowed by the shared token bucket
+        commands = [['genome', 'accession', '--inputfile', assemblies_path] for assemblies_path in files_to_delete]
+        request_counts = [ncbi_datasets_client.count_requests(len(accessions_batch)) for accessions_batch in batches]
+        ncbi_reports = asyncio.run(ncbi_datasets_client.get_reports_many(commands, request_counts=request_counts))
+        for assemblies_path, report in zip(files_to_delete, ncbi_reports):
+            if not report:
+                print(f"No report found for {assemblies_path}")
+            for assembly in report:
+                assembly_accession = assembly.get('accession')
+                bioproject_accessions = assembly_service.parse_bioprojects(assembly.get('assembly_info', {}), bioprojects_to_save)
+                assembly_to_bp_accessions[assembly_accession] = bioproject_accessions
+                all_bp_accessions.update(bioproject_accessions)
 
-        #update bp counts 
+        #filter out existing bioprojects
+        existing_bioprojects = BioProject.objects(accession__in=list(all_bp_accessions)).scalar('accession')
+        new_bioprojects = all_bp_accessions - set(existing_bioprojects)
+        bioprojects_to_save = {accession: bioproject for accession, bioproject in bioprojects_to_save.items() if accession in new_bioprojects}
+        #insert the bioprojects to the database
+        if new_bioprojects:
+            BioProject.objects.insert(list(bioprojects_to_save.values()))
+            print(f"Inserted {len(new_bioprojects)} new bioprojects")
+        else:
+            print("No new bioprojects to insert")
+
+        operations = [
+            UpdateOne({'assembly_accession': assembly_accession}, {'$set': {'bioprojects': bioproject_accessions}})
+            for assembly_accession, bioproject_accessions in assembly_to_bp_accessions.items()
+        ]
+        for operations_batch in create_batches(operations, batch_size):
+            GenomeAssembly._get_collection().bulk_write(operations_batch, ordered=False)
+        print(f"Updated {len(assembly_to_bp_accessions)} assemblies with their bioprojects")
+        assembly_service.sync_annotation_assembly_fields(list(assembly_to_bp_accessions.keys()), batch_size)
 
-        for bp in BioProject.objects():
-            bp.modify(assemblies_count=GenomeAssembly.objects(bioprojects__in=[bp.accession]).count())
-    
-    #update Bioprojects counts
+        update_bioprojects_counts(batch_size)
+        #after the counts, a request served in between would cache the old counts under the new generation
+        data_generation.bump_generation('update_bioprojects')
     except Exception as e:
-        print(f"Error inserting bioprojects: {e}")
+        print(f"Error updating bioprojects: {e}")
         raise e
     finally:
         #delete the tmp files
         for file_to_delete in files_to_delete:
-            os.remove(file_to_delete)
+            if os.path.exists(file_to_delete):
+                os.remove(file_to_delete)
         print("Updated bioprojects")
 
+def update_bioprojects_counts(batch_size: int = 5000):
+    """
+    Count the assemblies of every bioproject with a single aggregation and write the counts in bulk,
+    bioprojects without assemblies are set to 0
+    """
+    pipeline = [
+        {"$match": {"bioprojects.0": {"$exists": True}}},
+        {"$project": {"bioprojects": {"$setUnion": ["$bioprojects", []]}}},
+        {"$unwind": "$bioprojects"},
+        {"$group": {"_id": "$bioprojects", "count": {"$sum": 1}}},
+    ]
+    counts = {doc['_id']: doc['count'] for doc in GenomeAssembly.objects.aggregate(pipeline, allowDiskUse=True)}
+    operations = [
+        UpdateOne({'accession': accession}, {'$set': {'assemblies_count': count}})
+        for accession, count in counts.items()
+    ]
+    for operations_batch in create_batches(operations, batch_size):
+        BioProject._get_collection().bulk_write(operations_batch, ordered=False)
+    BioProject.objects(accession__nin=list(counts.keys()), assemblies_count__ne=0).update(set__assemblies_count=0)
+    print(f"Updated the assemblies count of {len(counts)} bioprojects")
 
 @shared_task(name='update_annotation_fields', ignore_result=False)
-def update_annotation_fields():
+@task_lock.singleton('update_annotation_fields')
+def update_annotation_fields(batch_size: int = 1000):
     """
-    Update the fields for the annotations
+    Update the mapped regions of the annotations from their sequence maps:
+    one aggregation grouping the sequence ids by annotation, streamed into bulk writes.
+    The last written annotation id is checkpointed, an interrupted run is resumed by the next one.
+    Then copy the assembly fields to all the annotations and rebuild the metric catalogue
     """
-    annotations = GenomeAnnotation.objects()
-    for annotation in annotations:
-        mapped_regions = AnnotationSequenceMap.objects(annotation_id=annotation.annotation_id).scalar('sequence_id')
-        if not mapped_regions:
-            continue
-        annotation.modify(mapped_regions=mapped_regions)
+    checkpoint = task_lock.get_checkpoint('update_annotation_fields') or {
+        'last_annotation_id': None,
+        'updated': 0,
+        'started_at': datetime.now().isoformat(),
+    }
+    if checkpoint['last_annotation_id']:
+        print(f"Resuming from annotation {checkpoint['last_annotation_id']} ({checkpoint['updated']} already updated)")
+    pipeline = []
+    if checkpoint['last_annotation_id']:
+        pipeline.append({"$match": {"annotation_id": {"$gt": checkpoint['last_annotation_id']}}})
+    pipeline.extend([
+        {"$group": {"_id": "$annotation_id", "mapped_regions": {"$push": "$sequence_id"}}},
+        {"$sort": {"_id": 1}},
+    ])
+    collection = GenomeAnnotation._get_collection()
+    operations = []
+    last_annotation_id = None
+    for doc in AnnotationSequenceMap.objects.aggregate(pipeline, allowDiskUse=True):
+        last_annotation_id = doc['_id']
+        operations.append(UpdateOne({'annotation_id': last_annotation_id}, {'$set': {'mapped_regions': doc['mapped_regions']}}))
+        if len(operations) >= batch_size:
+            write_mapped_regions(collection, operations, checkpoint, last_annotation_id)
+            operations = []
+    if operations:
+        write_mapped_regions(collection, operations, checkpoint, last_annotation_id)
+    task_lock.clear_checkpoint('update_annotation_fields')
+    print(f"Updated mapped regions of {checkpoint['updated']} annotations")
+    synced = assembly_service.sync_annotation_assembly_fields(batch_size=batch_size)
+    metric_catalogue_service.update_metric_catalogue()
+    data_generation.bump_generation('update_annotation_fields')
+    return {'updated': checkpoint['updated'], 'assembly_fields_synced': synced}
 
+def write_mapped_regions(collection, operations: list[UpdateOne], checkpoint: dict, last_annotation_id: str):
+    """
+    Write a batch of mapped regions updates and checkpoint the last annotation id of the batch
+    """
+    result = collection.bulk_write(operations, ordered=False)
+    checkpoint['updated'] += result.modified_count
+    checkpoint['last_annotation_id'] = last_annotation_id
+    task_lock.set_checkpoint('update_annotation_fields', checkpoint)
+    print(f"Updated {checkpoint['updated']} annotations, last annotation id {last_annotation_id}")
 
+@shared_task(name='sync_annotation_assembly_fields', ignore_result=False)
+@task_lock.singleton('sync_annotation_assembly_fields')
+def sync_annotation_assembly_fields(batch_size: int = 5000):
+    """
+    Copy the assembly fields to all the annotations, queued when a worker starts until it has run once
+    so that the annotations saved before the fields existed are backfilled
+    """
+    synced = assembly_service.sync_annotation_assembly_fields(batch_size=batch_size)
+    data_generation.bump_generation('sync_annotation_assembly_fields')
+    return {'assembly_fields_synced': synced}
+
+@shared_task(name='compact_sequence_maps', ignore_result=False)
+@task_lock.singleton('compact_sequence_maps')
+def compact_sequence_maps(batch_size: int = 5000):
+    """
+    Replace the aliases copied in the legacy sequence maps with a reference to their genomic sequence,
+    drop the aliases index once no legacy sequence map is left
+    """
+    legacy_query = {'aliases.0': {'$exists': True}}
+    annotation_ids = AnnotationSequenceMap.objects(__raw__=legacy_query).distinct('annotation_id')
+    assemblies = dict(GenomeAnnotation.objects(annotation_id__in=annotation_ids).scalar('annotation_id', 'assembly_accession'))
+    collection = AnnotationSequenceMap._get_collection()
+    operations = []
+    updated = 0
+    for annotation_id in annotation_ids:
+        assembly_accession = assemblies.get(annotation_id)
+        if not assembly_accession:
+            continue #orphan sequence maps, removed by collect_garbage
+        resolver = contigs_service.get_alias_resolver(assembly_accession)
+        sequence_maps = AnnotationSequenceMap.objects(annotation_id=annotation_id, __raw__=legacy_query).only('sequence_id').as_pymongo()
+        for sequence_map in sequence_maps:
+            genomic_sequence = resolver.resolve(sequence_map['sequence_id'])
+            if genomic_sequence is None:
+                continue #kept with its aliases
+            operations.append(UpdateOne(
+                {'_id': sequence_map['_id']},
+                {'$set': {'genomic_sequence': genomic_sequence}, '$unset': {'aliases': ''}},
+            ))
+        if len(operations) >= batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            print(f"Compacted {updated} sequence maps")
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    print(f"Compacted {updated} sequence maps")
+    if not AnnotationSequenceMap.objects(__raw__=legacy_query).first() and 'aliases_1' in collection.index_information():
+        collection.drop_index('aliases_1')
+        print("Dropped the aliases index of the sequence maps")
+    return {'updated': updated}
 
 @shared_task(name='ensure_indexes', ignore_result=False)
 def ensure_indexes():
     """
-    Ensure the indexes are created
+    Ensure the indexes declared in the models are created, for every collection, and drop the redundant ones left by older versions
     """
-    for doc in [GenomeAnnotation, GenomeAssembly]:
+    for doc in get_documents().values():
         doc.ensure_indexes()
+    collection = GenomicSequence._get_collection()
+    if 'assembly_accession_1' in collection.index_information():
+        #redundant with the (assembly_accession, aliases) prefix
+        collection.drop_index('assembly_accession_1')
+        print("Dropped the assembly_accession index of the genomic sequences")
@@ -1,13 +1,19 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from db.database import connect_to_db, close_db_connection
 from celery_app.celery_utils import create_celery
 from api.router import router as api_router
+from helpers import request_context
+from helpers import metrics as metrics_helper
+from helpers import filter_engine
+from helpers import http_cache
+import time
 from jobs.import_annotations import import_annotations
 import os
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Annotrieve API (FastAPI)")
+    app = FastAPI(title="Annotrieve API (FastAPI)", default_response_class=ORJSONResponse)
 
     # Configure CORS to allow requests from GitHub Pages and other origins
     # The browser blocks responses if the Origin header doesn't match allowed origins
@@ -32,6 +38,10 @@ def create_app() -> FastAPI:
     # - https://genome\.crg\.es - production domain
     allow_origin_regex = r"https?://(localhost|127\.0\.0\.1)(:\d+)?|https://.*\.github\.io|https://genome\.crg\.es"
     
+    # ETag / Last-Modified from the data generation bumped by the jobs, conditional GETs answered with a 304.
+    # Registered first so that it is the inner one: the 304s still get the CORS headers and are measured by the metrics
+    app.middleware("http")(http_cache.conditional_requests)
+
     # CORS middleware processes all responses (including errors) and adds appropriate headers
     # It must be added before routes are registered
     # 
@@ -55,9 +65,25 @@ def create_app() -> FastAPI:
         max_age=86400,  # Cache preflight OPTIONS requests for 24 hours
     )
 
+    @app.middleware("http")
+    async def bind_request_context(request: Request, call_next):
+        # request state read by the services (e.g. the route of the query shapes recorded for the index advisor)
+        # and by the metrics: latency per route, mongo commands of the request, slow requests log
+        token = request_context.start_request(request.scope)
+        start = time.perf_counter()
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            metrics_helper.observe_request(request, status_code, time.perf_counter() - start)
+            request_context.end_request(token)
+
     @app.on_event("startup")
     async def startup_event():
-        connect_to_db()
+        connect_to_db(event_listeners=[metrics_helper.MongoCommandListener()])
+        filter_engine.start()
         
     @app.on_event("shutdown")
     async def shutdown_event():
@@ -70,6 +96,27 @@ def create_app() -> FastAPI:
     async def health():
         return {"status": "ok"}
 
+    # Monitoring routes, protected by the auth key and not exposed by the public nginx location:
+    # the slow requests log contains the filter params of the requests
+    def check_auth_key(auth_key: str):
+        if auth_key != os.getenv('AUTH_KEY'):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+    @app.get("/metrics/{auth_key}", include_in_schema=False)
+    async def metrics(auth_key: str):
+        check_auth_key(auth_key)
+        return PlainTextResponse(metrics_helper.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/metrics/slow-requests/{auth_key}", include_in_schema=False)
+    async def slow_requests(auth_key: str):
+        check_auth_key(auth_key)
+        return list(metrics_helper.slow_requests)
+
+    @app.get("/metrics/filter-engine/{auth_key}", include_in_schema=False)
+    async def filter_engine_status(auth_key: str):
+        check_auth_key(auth_key)
+        return filter_engine.get_status()
+
     return app
 
 app = create_app() 
@@ -5,15 +5,29 @@ from helpers import parameters as params_helper
 from helpers import pysam_helper
 from helpers import annotation as annotation_helper
 from helpers import pipelines as pipelines_helper
-from db.models import GenomeAnnotation, AnnotationError, AnnotationSequenceMap, drop_all_collections, TaxonNode, GenomeAssembly, Organism, GenomicSequence, BioProject
+from helpers import query_shapes
+from helpers import filter_engine
+from helpers import data_generation
+from helpers import metric_columns
+from helpers import id_dictionary
+from db.models import GenomeAnnotation, AnnotationError, AnnotationSequenceMap, drop_all_collections, TaxonNode, GenomeAssembly, Organism, GenomicSequence, BioProject, MetricCatalogue
 from fastapi.responses import StreamingResponse, Response
 from fastapi import HTTPException
 from typing import Optional, Dict, Any
 import os
 from jobs.import_annotations import import_annotations
 from jobs.updates import update_annotation_fields, update_feature_stats
+from jobs.cleanup import collect_garbage
+from celery_app import task_lock
+from jobs.services import import_job as import_job_service
+from jobs.services import metric_catalogue as metric_catalogue_service
+from jobs.services import assembly as assembly_service
 import statistics
+import json
+import hashlib
+import redis
 from datetime import datetime
+from db.database import get_redis_client
 
 FIELD_TSV_MAP = {
     'annotation_id': 'annotation_id',
@@ -29,21 +43,39 @@ FIELD_TSV_MAP = {
 }
 
 NO_VALUE_KEY = "no_value"
+#facet field -> filter param selecting values of that field, a facet is counted without its own filter so that the other values stay selectable
+FACET_FILTER_PARAMS = {
+    'database': 'db_sources',
+    'provider': 'providers',
+    'pipeline': 'pipelines',
+    'feature_type': 'feature_types',
+    'feature_source': 'feature_sources',
+    'biotype': 'biotypes',
+    'assembly_accession': 'assembly_accessions',
+}
+DEFAULT_FACETS = ['database', 'provider', 'pipeline', 'feature_type', 'feature_source', 'biotype']
+FACETS_CACHE_PREFIX = 'annotrieve:facets:'
+FACETS_CACHE_TTL = int(os.getenv('FACETS_CACHE_TTL', '300')) #seconds
 def get_annotations(args: dict, field: str = None, response_type: str = 'metadata'):
     try:
         #drop_all_collections()
         limit = args.pop('limit', 20)
         offset = args.pop('offset', 0)
         fields = args.pop('fields', None)
+        top_k = args.pop('top_k', None)
+        if response_type in ('frequencies', 'metadata'):
+            result = get_annotations_from_filter_engine(args, field, response_type, top_k, offset, limit, fields)
+            if result is not None:
+                return result
         annotations = get_annotation_records(**args)
-        total = annotations.count()
         if response_type == 'frequencies':
-            return query_visitors_helper.get_frequencies(annotations, field, type='annotation')
+            return query_visitors_helper.get_frequencies(annotations, field, type='annotation', top_k=top_k)
         elif response_type == 'summary_stats':
             return get_annotations_summary_stats(annotations)
         elif response_type == 'tsv':
             return stream_annotation_tsv(annotations)
         else:
+            total = annotations.count()
             if fields:
                 annotations = annotations.only(*fields.split(','))
             return response_helper.json_response_with_pagination(annotations, total, offset, limit)
@@ -54,6 +86,113 @@ def get_annotations(args: dict, field: str = None, response_type: str = 'metadat
         print(e)
         raise HTTPException(status_code=500, detail=f"Error fetching annotations: {e}")
 
+def get_annotations_from_filter_engine(args: dict, field: str, response_type: str, top_k, offset, limit, fields):
+    """
+    Answer the frequencies and the metadata pages from the in-memory bitmaps, mongo is only queried for the documents of the page.
+    Return None when the engine is disabled, not built yet or a filter is not indexed
+    """
+    snapshot = filter_engine.get_snapshot()
+    if snapshot is None or args.get('sort_by'):
+        return None
+    matches = snapshot.evaluate(args)
+    if matches is None:
+        return None
+    if response_type == 'frequencies':
+        if field not in query_visitors_helper.ALLOWED_FIELDS_MAP:
+            return None
+        return snapshot.frequencies(matches, field, query_visitors_helper.coerce_top_k(top_k))
+    #same pagination as json_response_with_pagination: skip(offset).limit(limit), a limit of 0 returns every match
+    offset, limit = response_helper.coerce_pagination(offset, limit)
+    if offset < 0 or limit < 0:
+        return None
+    total = len(matches)
+    annotation_ids = snapshot.page_ids(matches, offset, limit or total)
+    annotations = GenomeAnnotation.objects(annotation_id__in=annotation_ids).exclude('id')
+    if fields:
+        annotations = annotations.only(*fields.split(','), 'annotation_id')
+    by_id = {document['annotation_id']: document for document in annotations.as_pymongo()}
+    results = [by_id[annotation_id] for annotation_id in annotation_ids if annotation_id in by_id]
+    if fields and 'annotation_id' not in fields.split(','):
+        for document in results:
+            document.pop('annotation_id', None)
+    return response_helper.MongoJSONResponse({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'results': results,
+    })
+
+def get_annotations_facets(args: dict):
+    """
+    Return the frequencies of several fields of the filtered annotations with a single aggregation ($match + $facet).
+    The selected values of a faceted field filter the other facets but not its own one.
+    Answered by the filter engine when enabled, otherwise results are cached in redis for FACETS_CACHE_TTL seconds within a data generation
+    """
+    args = dict(args)
+    fields = params_helper.normalize_to_list(args.pop('fields', None)) or DEFAULT_FACETS
+    top_k = query_visitors_helper.coerce_top_k(args.pop('top_k', None))
+    for key in ['limit', 'offset', 'sort_by', 'sort_order']:
+        args.pop(key, None)
+    args = {key: value for key, value in args.items() if value not in (None, '', [])}
+    own_params = {FACET_FILTER_PARAMS[field] for field in fields if field in FACET_FILTER_PARAMS}
+
+    snapshot = filter_engine.get_snapshot()
+    if snapshot is not None:
+        facets = get_facets_from_filter_engine(snapshot, args, fields, own_params, top_k)
+        if facets is not None:
+            return facets
+
+    #keyed by data generation, the facets of an older catalogue are never served after an import
+    cache_key = FACETS_CACHE_PREFIX + hashlib.sha1(json.dumps({'generation': data_generation.get_generation(), 'fields': fields, 'top_k': top_k, 'params': args}, sort_keys=True, default=str).encode()).hexdigest()
+    try:
+        cached = get_redis_client().get(cache_key)
+        if cached:
+            return json.loads(cached)
+    except redis.RedisError as e:
+        print(f"Facets cache unavailable: {e}")
+
+    try:
+        annotations = get_annotation_records(**{key: value for key, value in args.items() if key not in own_params})
+        field_filters = {}
+        for field in fields:
+            other_params = {key: args[key] for key in own_params if key in args and key != FACET_FILTER_PARAMS.get(field)}
+            if other_params:
+                field_filters[field] = GenomeAnnotation.objects(**annotation_helper.query_params_to_mongoengine_query(**other_params))._query
+        facets = query_visitors_helper.get_frequencies_many(annotations, fields, type='annotation', top_k=top_k, field_filters=field_filters)
+    except HTTPException as e:
+        raise e
+    except TypeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid parameter: {e}")
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=f"Error fetching annotations facets: {e}")
+
+    try:
+        get_redis_client().set(cache_key, json.dumps(facets), ex=FACETS_CACHE_TTL)
+    except redis.RedisError as e:
+        print(f"Facets cache unavailable: {e}")
+    return facets
+
+def get_facets_from_filter_engine(snapshot, args: dict, fields: list[str], own_params: set[str], top_k: int | None):
+    """
+    Same facets as get_annotations_facets from the bitmap cardinalities, None if a filter or a field is not indexed
+    """
+    invalid_fields = [field for field in fields if field not in query_visitors_helper.ALLOWED_FIELDS_MAP]
+    if invalid_fields:
+        return None
+    base = snapshot.evaluate({key: value for key, value in args.items() if key not in own_params})
+    if base is None:
+        return None
+    facets = {}
+    for field in fields:
+        other_params = {key: args[key] for key in own_params if key in args and key != FACET_FILTER_PARAMS.get(field)}
+        matches = snapshot.evaluate(other_params)
+        counts = snapshot.frequencies(base & matches, field, top_k) if matches is not None else None
+        if counts is None:
+            return None
+        facets[field] = counts
+    return facets
+
 def stream_annotation_tsv(annotations):
     def row_iterator():
         header = "\t".join(FIELD_TSV_MAP.keys()) + "\n"
@@ -107,35 +246,37 @@ def get_annotation_records(
         release_date_from=release_date_from,
         release_date_to=release_date_to,
     )
+    assembly_query = {}
+    if refseq_categories:
+        assembly_query['refseq_category__in'] = refseq_categories.split(',') if isinstance(refseq_categories, str) else refseq_categories
+    if assembly_levels:
+        assembly_query['assembly_level__in'] = assembly_levels.split(',') if isinstance(assembly_levels, str) else assembly_levels
+    if assembly_statuses:
+        assembly_query['assembly_status__in'] = assembly_statuses.split(',') if isinstance(assembly_statuses, str) else assembly_statuses
+    if assembly_types:
+        assembly_query['assembly_type__in'] = assembly_types.split(',') if isinstance(assembly_types, str) else assembly_types
+    if bioproject_accessions:
+        assembly_query['bioprojects__in'] = bioproject_accessions.split(',') if isinstance(bioproject_accessions, str) else bioproject_accessions
+    assembly_fields_synced = bool(assembly_query) and assembly_service.annotation_assembly_fields_synced()
+    if assembly_fields_synced:
+        #the assembly fields are copied to the annotations (see sync_annotation_assembly_fields), no lookup of the assemblies is needed
+        mongoengine_query.update(assembly_query)
     annotations = GenomeAnnotation.objects(**mongoengine_query).exclude('id')
-    #check if any assembly related param is present
-    if any([refseq_categories, assembly_levels, assembly_statuses, assembly_types, bioproject_accessions]):
-        query = {}
-        if refseq_categories:
-            query['refseq_category__in'] = refseq_categories.split(',') if isinstance(refseq_categories, str) else refseq_categories
-        if assembly_levels:
-            query['assembly_level__in'] = assembly_levels.split(',') if isinstance(assembly_levels, str) else assembly_levels
-        if assembly_statuses:
-            query['assembly_status__in'] = assembly_statuses.split(',') if isinstance(assembly_statuses, str) else assembly_statuses
-        if assembly_types:
-            query['assembly_type__in'] = assembly_types.split(',') if isinstance(assembly_types, str) else assembly_types
-        if bioproject_accessions:
-            query['bioprojects__in'] = bioproject_accessions.split(',') if isinstance(bioproject_accessions, str) else bioproject_accessions
-        #fetch assemblies from the assemblies collection
-        assemblies = GenomeAssembly.objects(**query).scalar('assembly_accession')
+    if assembly_query and not assembly_fields_synced:
+        #the existing annotations are not backfilled yet, fetch the accessions from the assemblies collection
+        assemblies = GenomeAssembly.objects(**assembly_query).scalar('assembly_accession')
         annotations = annotations.filter(assembly_accession__in=assemblies)
     if filter:
         annotations = annotations.filter(query_visitors_helper.annotation_query(filter))
     if sort_by:
         sort = '-' + sort_by if sort_order == 'desc' else sort_by
         annotations = annotations.order_by(sort)
+    query_shapes.record_query(annotations)
     return annotations
 
 def get_annotation_metadata(md5_checksum):
-    annotation = GenomeAnnotation.objects(annotation_id=md5_checksum).exclude('id').first()
-    if not annotation:
-        raise HTTPException(status_code=404, detail=f"Annotation {md5_checksum} not found")
-    return annotation.to_mongo().to_dict()
+    annotation = GenomeAnnotation._get_collection().find_one({'annotation_id': md5_checksum}, {'_id': 0})
+    return response_helper.document_response(annotation, f"Annotation {md5_checksum} not found")
 
 def get_annotation(md5_checksum):
     annotation = GenomeAnnotation.objects(annotation_id=md5_checksum).first()
@@ -148,8 +289,11 @@ def trigger_annotation_fields_update(auth_key: str):
     if auth_key != os.getenv('AUTH_KEY'):
         raise HTTPException(status_code=401, detail="Unauthorized")
     #queue both tasks
-    update_feature_stats.delay()
-    return {"message": "Feature stats and import annotations task triggered"}
+    feature_stats_queued = task_lock.enqueue_once(update_feature_stats)
+    annotation_fields_queued = task_lock.enqueue_once(update_annotation_fields)
+    if not feature_stats_queued and not annotation_fields_queued:
+        return {"message": "Feature stats and annotation fields tasks already queued or running"}
+    return {"message": "Feature stats and annotation fields tasks triggered"}
 
 
 
@@ -450,13 +594,32 @@ def update_annotation_stats(md5_checksum, payload):
     if transcript_stats:
         annotation.features_statistics.transcript_type_stats = transcript_stats
     annotation.save()
+    data_generation.bump_generation('update_annotation_stats')
 
 def get_mapped_regions(md5_checksum, offset_param, limit_param):
     try:
         regions = AnnotationSequenceMap.objects(annotation_id=md5_checksum)
         count = regions.count()
         offset, limit = params_helper.handle_pagination_params(offset_param, limit_param, count)    
-        return response_helper.json_response_with_pagination(regions, count, offset, limit)
+        page = list(regions.skip(offset).limit(limit).exclude('id').as_pymongo())
+        #the aliases are read from the referenced genomic sequences, legacy maps still store them
+        sequence_ids = [region['genomic_sequence'] for region in page if region.get('genomic_sequence')]
+        sequences = GenomicSequence.objects(id__in=sequence_ids).only('aliases').as_pymongo()
+        aliases_by_sequence = {sequence['_id']: sequence.get('aliases', []) for sequence in sequences}
+        results = [
+            {
+                'sequence_id': region['sequence_id'],
+                'annotation_id': region['annotation_id'],
+                'aliases': region.get('aliases') or aliases_by_sequence.get(region.get('genomic_sequence'), []),
+            }
+            for region in page
+        ]
+        return {
+            'total': count,
+            'offset': offset,
+            'limit': limit,
+            'results': results
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching mapped regions: {e}")
 
@@ -495,7 +658,7 @@ def stream_annotation_tabix(md5_checksum:str, region:str=None, start:int=None, e
         if start is not None and end is not None and start > end:
             raise HTTPException(status_code=400, detail="start must be less than end")
         
-        seq_id = annotation_helper.resolve_sequence_id(region, md5_checksum, file_path) if region else None
+        seq_id = annotation_helper.resolve_sequence_id(region, annotation, file_path) if region else None
 
         #check if biotype, feature_type and feature_source are valid values
         if biotype and biotype not in annotation.features_summary.biotypes:
@@ -537,9 +700,24 @@ def get_annotation_errors(offset_param=0, limit_param=20):
 def trigger_import_annotations(auth_key: str):
     if auth_key != os.getenv('AUTH_KEY'):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    import_annotations.delay()
+    if not task_lock.enqueue_once(import_annotations):
+        return {"message": "Import annotations task already queued or running"}
     return {"message": "Import annotations task triggered"}
 
+def trigger_collect_garbage(auth_key: str, dry_run: bool = True):
+    if auth_key != os.getenv('AUTH_KEY'):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    task = task_lock.enqueue_once(collect_garbage, dry_run=dry_run)
+    if not task:
+        return {"message": "Garbage collection task already queued or running"}
+    return {"message": "Garbage collection task triggered", "task_id": task.id, "dry_run": dry_run}
+
+def get_import_status():
+    status = import_job_service.get_job_status()
+    if not status:
+        raise HTTPException(status_code=404, detail="No import job found")
+    return status
+
 
 def drop_collections(auth_key: str, model: str):
     if auth_key != os.getenv('AUTH_KEY'):
@@ -556,6 +734,7 @@ def drop_collections(auth_key: str, model: str):
     elif model == 'genomes':
         GenomeAssembly.objects().delete()
         GenomicSequence.objects().delete()
+    data_generation.bump_generation(f'drop {model}')
     return {"message": "Collections dropped"}
 
 def get_gene_stats_summary(commons: Dict[str, Any] = None, payload: Dict[str, Any] = None):
@@ -739,9 +918,9 @@ def get_gene_category_details(category: str, commons: Dict[str, Any] = None, pay
         "metrics": ["total_count", "average_mean_length"]
     }
 
-def get_gene_category_metric_values(category: str, metric: str, include_annotations: bool = False, commons: Dict[str, Any] = None, payload: Dict[str, Any] = None):
+def get_gene_category_metric_values(category: str, metric: str, include_annotations: bool = False, commons: Dict[str, Any] = None, payload: Dict[str, Any] = None, bins: int | None = None, packed: bool = False):
     """
-    Get raw values for a specific metric in a specific gene category
+    Get raw values for a specific metric in a specific gene category, or their histogram with bins
     """
     # Validate metric
     valid_metrics = ["total_count", "average_mean_length"]
@@ -751,8 +930,8 @@ def get_gene_category_metric_values(category: str, metric: str, include_annotati
             detail=f"Invalid metric: {metric}. Must be one of: {', '.join(valid_metrics)}"
         )
     
+    bins = metric_columns.coerce_bins(bins)
     params = params_helper.handle_request_params(commons or {}, payload or {})
-    annotations = get_annotation_records(**params)
     
     # Map output category names to possible database keys
     category_mapping = {
@@ -760,128 +939,22 @@ def get_gene_category_metric_values(category: str, metric: str, include_annotati
         "non_coding": ["non_coding", "non_coding_genes"],
         "pseudogene": ["pseudogene", "pseudogenes"]
     }
-    
-    # Find the actual database key for this category
-    db_category = None
-    if category in category_mapping:
-        for db_key in category_mapping[category]:
-            pipeline = [
-                {
-                    "$match": {
-                        f"features_statistics.gene_category_stats.{db_key}": {"$exists": True, "$ne": None}
-                    }
-                },
-                {
-                    "$limit": 1
-                }
-            ]
-            if list(annotations.aggregate(pipeline)):
-                db_category = db_key
-                break
-    else:
-        db_category = category
-    
-    if not db_category:
+    engine_values = get_metric_values_from_filter_engine('gene', category_mapping.get(category, [category]), metric, params, include_annotations)
+    if engine_values is not None:
+        return metric_values_response({"category": category, "metric": metric}, *engine_values, [], include_annotations, bins, packed)
+
+    # Keep the database keys of the category present in the metric catalogue,
+    # the values are read from the first one the filtered annotations have
+    gene_catalogue = get_metric_catalogue('gene')
+    db_categories = [db_key for db_key in category_mapping.get(category, [category]) if db_key in gene_catalogue]
+    annotations = get_annotation_records(**params)
+    db_category, annotation_ids, values = get_metric_values_from_mongo(annotations, 'gene_category_stats', db_categories, metric_columns.GENE_METRIC_PATHS[metric])
+    if not db_category and category in category_mapping:
         raise HTTPException(
             status_code=404,
             detail=f"Gene category '{category}' not found in the queried annotations"
         )
-    
-    # Build field path - map flattened metric names to database paths
-    if metric == "total_count":
-        field_path = f"features_statistics.gene_category_stats.{db_category}.total_count"
-    elif metric == "average_mean_length":
-        field_path = f"features_statistics.gene_category_stats.{db_category}.length_stats.mean"
-    else:
-        field_path = f"features_statistics.gene_category_stats.{db_category}.{metric}"
-    
-    pipeline = [
-        {
-            "$match": {
-                field_path: {"$exists": True, "$ne": None}
-            }
-        },
-        {
-            "$project": {
-                "annotation_id": "$annotation_id",
-                "value": f"${field_path}",
-                "is_empty": {
-                    "$or": [
-                        {"$eq": [{"$ifNull": [f"${field_path}", None]}, None]},
-                        {"$eq": [{"$type": f"${field_path}"}, "missing"]}
-                    ]
-                }
-            }
-        },
-        {
-            "$facet": {
-                "values": [
-                    {
-                        "$match": {
-                            "is_empty": False
-                        }
-                    },
-                    {
-                        "$sort": {"annotation_id": 1}
-                    },
-                    {
-                        "$project": {
-                            "_id": 0,
-                            "annotation_id": 1,
-                            "value": 1
-                        }
-                    }
-                ],
-                "empty_annotations": [
-                    {
-                        "$match": {
-                            "is_empty": True
-                        }
-                    },
-                    {
-                        "$sort": {"annotation_id": 1}
-                    },
-                    {
-                        "$project": {
-                            "_id": 0,
-                            "annotation_id": 1
-                        }
-                    }
-                ]
-            }
-        }
-    ]
-    
-    result = list(annotations.aggregate(pipeline))
-    
-    if result:
-        values_docs = result[0].get("values", [])
-        # Values are already sorted by MongoDB
-        # Use zip to extract both values and annotation_ids in one pass
-        if values_docs:
-            values, annotation_ids = zip(*[(doc["value"], doc["annotation_id"]) for doc in values_docs])
-            values = list(values)
-            annotation_ids = list(annotation_ids)
-        else:
-            values = []
-            annotation_ids = []
-        missing = [doc["annotation_id"] for doc in result[0].get("empty_annotations", [])]
-    else:
-        values = []
-        annotation_ids = []
-        missing = []
-    
-    response = {
-        "category": category,
-        "metric": metric,
-        "values": values,
-        "missing": missing
-    }
-    
-    if include_annotations:
-        response["annotation_ids"] = annotation_ids
-    
-    return response
+    return metric_values_response({"category": category, "metric": metric}, annotation_ids, values, [], include_annotations, bins, packed)
 
 def get_transcript_stats_summary(commons: Dict[str, Any] = None, payload: Dict[str, Any] = None):
     """
@@ -1174,131 +1247,121 @@ def get_transcript_type_details(transcript_type: str, commons: Dict[str, Any] =
         "metrics": metrics
     }
 
-def get_transcript_type_metric_values(transcript_type: str, metric: str, include_annotations: bool = False, commons: Dict[str, Any] = None, payload: Dict[str, Any] = None):
+def get_transcript_type_metric_values(transcript_type: str, metric: str, include_annotations: bool = False, commons: Dict[str, Any] = None, payload: Dict[str, Any] = None, bins: int | None = None, packed: bool = False):
     """
     Get raw values for a transcript type & metric
     Returns tuples of (annotation_id, value) for non-empty values,
     and a list of annotation_ids for empty values.
+    With bins, returns their histogram instead of the values.
     """
+    bins = metric_columns.coerce_bins(bins)
     params = params_helper.handle_request_params(commons or {}, payload or {})
+    if metric in metric_columns.TRANSCRIPT_METRIC_PATHS:
+        engine_values = get_metric_values_from_filter_engine('transcript', [transcript_type], metric, params, include_annotations)
+        if engine_values is not None:
+            return metric_values_response({"type": transcript_type, "metric": metric}, *engine_values, [], include_annotations, bins, packed)
     annotations = get_annotation_records(**params)
-    
-    # Check if transcript type exists and get available metrics
-    type_details = get_transcript_type_details(transcript_type, commons, payload)
-    available_metrics = type_details.get("metrics", [])
-    
-    # Map flattened metric names to database paths
-    metric_mapping = {
-        "total_count": f"features_statistics.transcript_type_stats.{transcript_type}.total_count",
-        "average_mean_length": f"features_statistics.transcript_type_stats.{transcript_type}.length_stats.mean",
-        "associated_genes_total_count": f"features_statistics.transcript_type_stats.{transcript_type}.associated_genes.total_count",
-        "exon_total_count": f"features_statistics.transcript_type_stats.{transcript_type}.exon_stats.total_count",
-        "exon_average_length": f"features_statistics.transcript_type_stats.{transcript_type}.exon_stats.length.mean",
-        "exon_average_concatenated_length": f"features_statistics.transcript_type_stats.{transcript_type}.exon_stats.concatenated_length.mean",
-        "cds_total_count": f"features_statistics.transcript_type_stats.{transcript_type}.cds_stats.total_count",
-        "cds_average_length": f"features_statistics.transcript_type_stats.{transcript_type}.cds_stats.length.mean",
-        "cds_average_concatenated_length": f"features_statistics.transcript_type_stats.{transcript_type}.cds_stats.concatenated_length.mean"
-    }
-    
-    # Validate metric exists for this transcript type
-    if metric not in available_metrics:
+    transcript_catalogue = get_metric_catalogue('transcript')
+    db_types = [transcript_type] if transcript_type in transcript_catalogue else []
+    found_type, annotation_ids, values = get_metric_values_from_mongo(annotations, 'transcript_type_stats', db_types, metric_columns.TRANSCRIPT_METRIC_PATHS.get(metric))
+    if not found_type:
         raise HTTPException(
-            status_code=400,
-            detail=f"Metric '{metric}' is not available for transcript type '{transcript_type}'. Available metrics: {', '.join(available_metrics)}"
+            status_code=404,
+            detail=f"Transcript type '{transcript_type}' not found in the queried annotations"
         )
     
-    if metric not in metric_mapping:
+    # The type is in the filtered annotations but none of them has the metric
+    if not values:
+        available_metrics = [name for name in metric_columns.TRANSCRIPT_METRIC_PATHS if name in transcript_catalogue[transcript_type]]
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid metric: {metric}. Must be one of: {', '.join(metric_mapping.keys())}"
+            detail=f"Metric '{metric}' is not available for transcript type '{transcript_type}'. Available metrics: {', '.join(available_metrics)}"
         )
-    
-    field_path = metric_mapping[metric]
-    
+    return metric_values_response({"type": transcript_type, "metric": metric}, annotation_ids, values, [], include_annotations, bins, packed)
+
+def load_metric_catalogue() -> dict[str, dict[str, set[str]]]:
+    """
+    Return kind -> {gene category or transcript type: available metrics}.
+    An empty catalogue (first deployment) is built once from the annotations
+    """
+    if not MetricCatalogue.objects().count() and GenomeAnnotation.objects(features_statistics__exists=True).count():
+        metric_catalogue_service.update_metric_catalogue()
+    catalogue = {}
+    for entry in MetricCatalogue.objects().as_pymongo():
+        catalogue.setdefault(entry['kind'], {})[entry['name']] = set(entry.get('metrics') or [])
+    return catalogue
+
+#reloaded when the data generation changes
+metric_catalogue_cache = data_generation.GenerationCache(load_metric_catalogue)
+
+def get_metric_catalogue(kind: str) -> dict[str, set[str]]:
+    return metric_catalogue_cache.get().get(kind, {})
+
+def get_metric_values_from_mongo(annotations, stats_key: str, names: list[str], metric_path: str | None):
+    """
+    Read a metric of the first of names (gene category or transcript type keys of features_statistics.<stats_key>)
+    having values in the filtered annotations, with a single aggregation.
+    Return (name, annotation_ids, values) sorted by annotation_id, the name is the first one present when none has the metric
+    and None when the annotations have none of the names
+    """
+    if not names:
+        return None, [], []
+    paths = [f"features_statistics.{stats_key}.{name}" for name in names]
+    projection = {"_id": 0, "annotation_id": 1, "present": [{"$gt": [f"${path}", None]} for path in paths]}
+    if metric_path:
+        projection["values"] = [f"${path}.{metric_path}" for path in paths]
     pipeline = [
-        {
-            "$match": {
-                field_path: {"$exists": True, "$ne": None}
-            }
-        },
-        {
-            "$project": {
-                "annotation_id": "$annotation_id",
-                "value": f"${field_path}",
-                "is_empty": {
-                    "$or": [
-                        {"$eq": [{"$ifNull": [f"${field_path}", None]}, None]},
-                        {"$eq": [{"$type": f"${field_path}"}, "missing"]}
-                    ]
-                }
-            }
-        },
-        {
-            "$facet": {
-                "values": [
-                    {
-                        "$match": {
-                            "is_empty": False
-                        }
-                    },
-                    {
-                        "$sort": {"annotation_id": 1}
-                    },
-                    {
-                        "$project": {
-                            "_id": 0,
-                            "annotation_id": 1,
-                            "value": 1
-                        }
-                    }
-                ],
-                "empty_annotations": [
-                    {
-                        "$match": {
-                            "is_empty": True
-                        }
-                    },
-                    {
-                        "$sort": {"annotation_id": 1}
-                    },
-                    {
-                        "$project": {
-                            "_id": 0,
-                            "annotation_id": 1
-                        }
-                    }
-                ]
-            }
-        }
+        {"$match": {"$or": [{path: {"$exists": True, "$ne": None}} for path in paths]}},
+        {"$sort": {"annotation_id": 1}},
+        {"$project": projection},
     ]
-    
-    result = list(annotations.aggregate(pipeline))
-    
-    if result:
-        values_docs = result[0].get("values", [])
-        # Values are already sorted by MongoDB
-        # Use zip to extract both values and annotation_ids in one pass
-        if values_docs:
-            values, annotation_ids = zip(*[(doc["value"], doc["annotation_id"]) for doc in values_docs])
-            values = list(values)
-            annotation_ids = list(annotation_ids)
-        else:
-            values = []
-            annotation_ids = []
-        missing = [doc["annotation_id"] for doc in result[0].get("empty_annotations", [])]
-    else:
-        values = []
-        annotation_ids = []
-        missing = []
-    
-    response = {
-        "type": transcript_type,
-        "metric": metric,
-        "values": values,
-        "missing": missing
-    }
-    
+    documents = list(annotations.aggregate(pipeline, allowDiskUse=True))
+    found = None
+    for idx, name in enumerate(names):
+        if not any(document["present"][idx] for document in documents):
+            continue
+        found = found or name
+        pairs = [(document["annotation_id"], document["values"][idx]) for document in documents if metric_path and document["values"][idx] is not None]
+        if pairs:
+            annotation_ids, values = zip(*pairs)
+            return name, list(annotation_ids), list(values)
+    return found, [], []
+
+def get_metric_values_from_filter_engine(kind: str, names: list[str], metric: str, params: dict, include_annotations: bool = False):
+    """
+    Read the values of a gene category (or transcript type) metric from the columns of the filter engine snapshot,
+    for the first of names present in the filtered annotations. Return (annotation_ids, values) sorted by annotation_id,
+    None when the engine is disabled, not built yet or a filter is not indexed
+    """
+    snapshot = filter_engine.get_snapshot()
+    if snapshot is None:
+        return None
+    matches = snapshot.evaluate(params)
+    if matches is None:
+        return None
+    mask = snapshot.metrics.mask(matches)
+    for name in names:
+        result = snapshot.metrics.values((kind, name, metric), mask)
+        if result is not None:
+            ordinals, values = result
+            annotation_ids = [snapshot.annotation_ids[ordinal] for ordinal in ordinals] if include_annotations else []
+            return annotation_ids, values
+    return None
+
+def metric_values_response(response: dict, annotation_ids, values, missing: list[str], include_annotations: bool, bins: int | None, packed: bool = False):
+    """
+    With bins return the histogram, quantiles and mean of the values instead of the values.
+    With packed return the values as binary, the annotation ids as indices into the id dictionary
+    """
+    if bins:
+        response.update(metric_columns.summarize(values, bins))
+        return response
+    if packed:
+        indices, dictionary = id_dictionary.get_indices(list(annotation_ids) + list(missing))
+        annotation_indices = indices[:len(annotation_ids)] if include_annotations else None
+        return response_helper.packed_values_response(values, annotation_indices, indices[len(annotation_ids):], dictionary.etag)
+    response["values"] = metric_columns.to_list(values)
+    response["missing"] = missing
     if include_annotations:
-        response["annotation_ids"] = annotation_ids
-    
-    return response
\ No newline at end of file
+        response["annotation_ids"] = list(annotation_ids)
+    return response
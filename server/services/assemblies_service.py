@@ -20,7 +20,8 @@ def get_assemblies(filter: str = None,
                     assembly_levels: str = None,
                     refseq_categories: str = None,
                     assembly_statuses: str = None,
-                    assembly_types: str = None
+                    assembly_types: str = None,
+                    top_k: int = None
                     ):
     try:
 
@@ -47,7 +48,7 @@ def get_assemblies(filter: str = None,
         if response_type == 'frequencies':
             if not field:
                 raise HTTPException(status_code=400, detail=f"Field is required for frequencies response")
-            return query_visitors_helper.get_frequencies(assemblies, field, type='assembly')
+            return query_visitors_helper.get_frequencies(assemblies, field, type='assembly', top_k=top_k)
 
         if sort_by:
             sort = '-' + sort_by if sort_order == 'desc' else sort_by
@@ -66,18 +67,18 @@ def trigger_assemblies_update(auth_key: str):
 
 
 def get_assembly(assembly_accession: str):
-    assembly = GenomeAssembly.objects(assembly_accession=assembly_accession).exclude('id').first()
-    if not assembly:
-        raise HTTPException(status_code=404, detail=f"Assembly {assembly_accession} not found")
-    return assembly
+    assembly = GenomeAssembly._get_collection().find_one({'assembly_accession': assembly_accession}, {'_id': 0})
+    return response_helper.document_response(assembly, f"Assembly {assembly_accession} not found")
 
 def get_assembled_molecules(assembly_accession: str, offset: int = 0, limit: int = 20):
     genomic_sequences = GenomicSequence.objects(assembly_accession=assembly_accession).exclude('id').skip(offset).limit(limit).as_pymongo()
     return response_helper.json_response_with_pagination(genomic_sequences, genomic_sequences.count(), offset, limit)
 
 def get_paired_assembly(assembly_accession: str):
-    assembly = get_assembly(assembly_accession)
-    paired_assembly_accession = assembly.paired_assembly_accession
+    assembly = GenomeAssembly._get_collection().find_one({'assembly_accession': assembly_accession}, {'paired_assembly_accession': 1})
+    if not assembly:
+        raise HTTPException(status_code=404, detail=f"Assembly {assembly_accession} not found")
+    paired_assembly_accession = assembly.get('paired_assembly_accession')
     if not paired_assembly_accession:
         raise HTTPException(status_code=404, detail=f"Assembly {assembly_accession} is not a paired assembly")
     return get_assembly(paired_assembly_accession)
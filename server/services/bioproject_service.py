@@ -3,6 +3,7 @@ from db.models import BioProject
 from helpers import response as response_helper, query_visitors as query_visitors_helper
 import os
 from jobs.updates import update_bioprojects
+from celery_app import task_lock
 
 
 def get_bioprojects(filter: str = None, offset: int = 0, limit: int = 20, sort_by: str = None, sort_order: str = 'desc'):
@@ -36,5 +37,6 @@ def trigger_bioprojects_update(auth_key: str):
     """
     if auth_key != os.getenv('AUTH_KEY'):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    update_bioprojects.delay()
+    if not task_lock.enqueue_once(update_bioprojects):
+        return {"message": "Bioprojects update task already queued or running"}
     return {"message": "Bioprojects update task triggered"}
\ No newline at end of file
@@ -0,0 +1,30 @@
+from fastapi import HTTPException
+import os
+from celery_app import task_lock
+from jobs import indexes as indexes_job
+from clients import ncbi_datasets as ncbi_datasets_client
+
+def get_locks_status():
+    try:
+        return task_lock.get_locks_status()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching task locks: {e}")
+
+def get_ncbi_metrics():
+    try:
+        return ncbi_datasets_client.get_rate_limiting_stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching NCBI client metrics: {e}")
+
+def get_index_advisor_report():
+    report = indexes_job.get_report()
+    if not report:
+        raise HTTPException(status_code=404, detail="No index advisor report found")
+    return report
+
+def trigger_index_advisor(auth_key: str, create: bool = False):
+    if auth_key != os.getenv('AUTH_KEY'):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not task_lock.enqueue_once(indexes_job.advise_indexes, create=create):
+        return {"message": "Index advisor task already queued or running"}
+    return {"message": "Index advisor task triggered", "create": create}